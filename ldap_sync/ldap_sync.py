@@ -8,6 +8,7 @@ import argparse
 
 from libs import common as c
 from libs import sync_process as sp
+from libs import sync_plan as plan
 
 VERSION = '0.25.0' 
 
@@ -21,25 +22,50 @@ def main():
         
         parser = argparse.ArgumentParser()
         parser.add_argument('-c', '--config', dest='config_file_path', type=str, help='Configuration YAML file path')
+        parser.add_argument('-m', '--mode', dest='mode', choices=['sync', 'plan', 'apply'], default='sync', 
+                            help="'sync' (default) computes and applies the changes, 'plan' writes the changes in the plan file, 'apply' executes the plan file")
+        parser.add_argument('-p', '--plan-file', dest='plan_file_path', type=str, help='Sync plan file path (plan/apply modes)')
         args = parser.parse_args()
 
         # initialize the common variables and perform the start-up checks (if negative exit)
         c.init(args.config_file_path, VERSION)  
 
+        c.sync_mode = args.mode
+        c.plan_filename = plan.plan_filename(args.plan_file_path or c.config.get('plan_file'))
+
+        if c.sync_mode == 'apply':
+            # apply a sync plan (one-shot)
+            c.logger.info("LDAP Sync apply plan [%s]" % c.plan_filename)
+            sys.exit(0 if sp.apply_plan(c.plan_filename) else 1)
+
+        # event-driven sync: LDAP change notifications watchers
+        notify = c.sync_mode == 'sync' and 'notify' in c.ldap_config and c.ldap_config['notify'].get('enabled', False) \
+                 and c.ldap_config.get('sync_freq', 0) > 0 and sp.start_ldap_watchers()
+
         # LDAP query loop 
         while True:
             c.logger.info("LDAP Sync process execution start")
 
             _st =c.start_time()
 
-            sp.main_loop()
+            plan_ok = sp.main_loop()
                     
             c.logger.debug("Execution time %s" % c.stop_time(_st, to_str=True))
 
+            if not plan_ok:
+                # plan mode: the sync plan is not written
+                c.logger.error("LDAP Sync plan not written - exit")
+                sys.exit(1)
+
             if 'sync_freq' in c.ldap_config and c.ldap_config['sync_freq'] > 0:
-                # wait 
-                c.logger.info("LDAP Sync process execution end - waiting %sS" % c.ldap_config['sync_freq'] )
-                time.sleep(c.ldap_config['sync_freq'])  # in seconds
+                if notify:
+                    # sync the notified LDAP changes up to the next full reconcile
+                    c.logger.info("LDAP Sync process execution end - waiting for LDAP changes - next full reconcile in %sS" % c.ldap_config['sync_freq'] )
+                    sp.sync_ldap_changes(c.ldap_config['sync_freq'])  # in seconds
+                else:
+                    # wait 
+                    c.logger.info("LDAP Sync process execution end - waiting %sS" % c.ldap_config['sync_freq'] )
+                    time.sleep(c.ldap_config['sync_freq'])  # in seconds
             else:
                 # one-shot
                 c.logger.info("LDAP Sync process execution end - exit")
@@ -56,6 +82,10 @@ def main():
             c.logger.error("Exception: %s - exit" % e)
             sys.exit(1) # General error
 
+    finally:
+        # release the resources (pooled LDAP connections) on any exit
+        sp.shutdown()
+
 
 # start
 if __name__ == '__main__':
@@ -0,0 +1,350 @@
+#
+# Async API module
+# asyncio I/O engine (httpx) for the SCIM and Determined APIs traffic (scim_api.engine: async)
+# The requests are built and the responses parsed by the synchronous helpers (scim_helper,
+# det_api_helper), that are still available to the plugins.
+#
+
+import asyncio
+import httpx
+
+from libs import common as c
+from libs import scim_helper as sh
+from libs import det_api_helper as det
+from libs import rate_limiter as rl
+from libs import json_codec as jc
+
+class AsyncAPIClient:
+    """ Async SCIM and Determined APIs client: an httpx.AsyncClient for each API (keep-alive
+        connections pool) and a semaphore limiting the requests in flight (scim_api.max_concurrency).
+        To be created and closed in the running event loop (see run, close).
+    """
+
+    def __init__(self, max_concurrency=100):
+        """ Args:
+                max_concurrency: (optional, default: 100) max requests in flight
+        """
+        access = c.scim_client.access
+        timeout_config = c.scim_config.get('timeout', {})
+        timeout = httpx.Timeout(timeout_config.get('read', 60), connect=timeout_config.get('connect', 10))
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+
+        self.scim_url = c.scim_client.url
+        self.scim_users_url = c.scim_client.users_url
+        self.scim = httpx.AsyncClient(auth=access['credentials'], headers=access['headers'],
+                                      timeout=timeout, limits=limits)
+        self.det_url = c.det_config.get('url')
+        self.det = httpx.AsyncClient(headers={'Content-Type': 'application/json'},
+                                     timeout=timeout, limits=limits)
+        self.det_token = None
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def aclose(self):
+        """ Closes the connections pools
+        """
+        await self.scim.aclose()
+        await self.det.aclose()
+
+    async def _scim_request(self, method, url, **kwargs):
+        """ (priv) Executes a SCIM API request through the rate limiter (see rate_limiter.acall)
+        """
+        async def _send():
+            async with self.semaphore:
+                return await self.scim.request(method, url, **kwargs)
+
+        return await rl.acall('scim', url[len(self.scim_url):], _send, httpx.TimeoutException, method, httpx.ConnectTimeout)
+
+    async def _det_request(self, method, api, **kwargs):
+        """ (priv) Executes a Det API request through the rate limiter (see rate_limiter.acall)
+        """
+        async def _send():
+            async with self.semaphore:
+                return await self.det.request(method, self.det_url + api, **kwargs)
+
+        return await rl.acall('det', api, _send, httpx.TimeoutException, method, httpx.ConnectTimeout)
+
+    # SCIM API
+
+    async def _get_scim_users_page(self, start_index, page_size, keys):
+        """ (priv) Requests a SCIM user list page (see scim_helper.users_page)
+        """
+        try:
+            resp = await self._scim_request('GET', self.scim_users_url, params=sh.users_page_params(start_index, page_size))
+        except httpx.HTTPError as e:
+            c.logger.error("Error contacting SCIM service - error: %s", e)
+            return None, None
+
+        return resp.status_code, sh.users_page(resp.status_code, resp.content, keys)
+
+    async def _get_scim_users_pages(self, page_size, keys):
+        """ (priv) Requests the SCIM user list: the first page returns totalResults, then the other 
+            pages are requested concurrently (see scim_helper._get_scim_users_pages)
+        """
+        status_code, page = await self._get_scim_users_page(1, page_size, keys)
+        if page is None:
+            return status_code, None, None
+
+        total, users = page
+        pages = [users]
+        totals = [total]
+
+        next_index = sh.users_page_next(1, page_size, total, users)
+        if next_index is not None:
+            # the other pages (by the first page size, the server can limit count)
+            page_len = len(users)
+            results = await asyncio.gather(*[self._get_scim_users_page(start_index, page_size, keys) 
+                                             for start_index in range(next_index, total + 1, page_len)])
+
+            for status_code, page in results:
+                if page is None:
+                    return status_code, None, None
+                totals.append(page[0])
+                pages.append(page[1])
+
+        # the pages are requested at fixed offsets: duplicates and missing users (list changed 
+        # while paging) are detected by totalResults
+        seen_ids = set()
+        return status_code, [sh.users_page_unique(users, seen_ids) for users in pages], totals
+
+    async def get_scim_users(self, handle_users=None):
+        """ Async get_scim_users (see scim_helper.get_scim_users): the first page returns
+            totalResults, then the other pages are requested concurrently
+        """
+        c.logger.debug("Invoke SCIM REST API call to get user list")
+        c.curr_local_users = [] # reset
+
+        page_size = c.scim_config.get('page_size', 1000)
+        keys = sh.scim_user_keys()
+
+        # list changed while paging: requested again, no partial lists (see scim_helper.users_list_page_size)
+        attempt = 0
+        attempt_page_size = page_size
+        while attempt_page_size is not None:
+            status_code, pages, totals = await self._get_scim_users_pages(attempt_page_size, keys)
+            if pages is None:
+                return {'http_status': status_code, 'scim_user_list': {}}
+
+            if sh.users_list_complete(totals, sum(len(users) for users in pages)):
+                break
+
+            attempt += 1
+            attempt_page_size = sh.users_list_page_size(attempt, page_size)
+        else:
+            c.logger.error("SCIM user list changed while paging - attempts: %d - list discarded" % attempt)
+            return {'http_status': None, 'scim_user_list': {}}
+
+        for users in pages:
+            c.curr_local_users.extend(users)
+            if handle_users is not None:
+                handle_users(users)
+
+        c.logger.debug("Returned SCIM Users count: %d" % len(c.curr_local_users))
+        return {'http_status': status_code, 'scim_user_list': {'totalResults': len(c.curr_local_users), 'Resources': c.curr_local_users}}
+
+    async def lookup_scim_users(self, users, handle_users=None):
+        """ Async lookup_scim_users (see scim_helper.lookup_scim_users): the batches are requested concurrently
+        """
+        c.logger.debug("Invoke SCIM REST API call to look up %d users" % len(users))
+
+        async def _lookup(batch):
+            try:
+                resp = await self._scim_request('GET', self.scim_users_url, params=batch[1])
+                return resp.status_code, resp.content
+            except httpx.HTTPError as e:
+                c.logger.error("Error contacting SCIM service - error: %s", e)
+                return None, None
+
+        results = await asyncio.gather(*[_lookup(batch) for batch in sh.lookup_batches(users)])
+        return sh.lookup_results(results, sh.scim_user_keys(), handle_users)
+
+    async def get_bulk_config(self):
+        """ Async get_bulk_config (see scim_helper.get_bulk_config), discovered once per SCIM client
+        """
+        if not sh.is_bulk_enabled():
+            return None
+
+        if c.scim_client.bulk is None:
+            try:
+                resp = await self._scim_request('GET', self.scim_url + sh.SERVICE_PROVIDER_CONFIG_URI)
+            except httpx.HTTPError as e:
+                c.logger.error("Error contacting SCIM service - error: %s", e)
+                return None
+            c.scim_client.bulk = sh.bulk_config(resp.status_code, resp.content)
+
+        return c.scim_client.bulk or None
+
+    async def exec_scim_bulk_req(self, chunk):
+        """ Async exec_scim_bulk_req (see scim_helper.exec_scim_bulk_req)
+        """
+        chunk_items, body = chunk
+        c.logger.debug("Invoke SCIM REST API Bulk call - operations: %d - payload: %d bytes" % (len(chunk_items), len(body)))
+
+        try:
+            resp = await self._scim_request('POST', self.scim_url + sh.BULK_URI, content=body)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # not sent: single requests
+            c.logger.error("Error contacting SCIM service - error: %s", e)
+            return sh.bulk_results(chunk_items, None, None)
+        except httpx.HTTPError as e:
+            c.logger.error("Error contacting SCIM service - error: %s", e)
+            return sh.bulk_unknown_results(chunk_items, None)
+
+        return sh.bulk_results(chunk_items, resp.status_code, resp.content)
+
+    async def exec_scim_user_api_req(self, user, op='get', changed_attrs=None):
+        """ Async exec_scim_user_api_req (see scim_helper.exec_scim_user_api_req)
+        """
+        c.logger.debug("Invoke SCIM REST API call to [%s] user: %s" % (op, user))
+
+        try:
+            op, method, url, kwargs = sh.build_user_request(user, op, self.scim_users_url, changed_attrs)
+            if 'data' in kwargs:
+                kwargs['content'] = kwargs.pop('data')
+
+            resp = await self._scim_request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            c.logger.error("Error contacting SCIM service - error: %s", e)
+            return {'http_status': None, 'scim_user': {}}
+
+        return sh.user_response(op, resp.status_code, resp.content)
+
+    # Determined API
+
+    async def api_call(self, api, method='GET', payload={}, bearer=None):
+        """ Async Det API call (see det_api_helper.api_call)
+        """
+        if self.det_url is None:
+            c.logger.error("No Det APIs endpoint URL provided")
+            return {'http_status': None, 'response': {}}
+
+        headers = {'Authorization': 'Bearer ' + bearer} if bearer is not None else {}
+
+        # GET, PUT, other methods as POST (see det_api_helper.api_call)
+        method = method.upper() if method.upper() in ['GET', 'PUT'] else 'POST'
+
+        try:
+            if method == 'GET':
+                resp = await self._det_request(method, api, headers=headers)
+            else:
+                resp = await self._det_request(method, api, headers=headers, content=jc.dumps(payload))
+        except httpx.HTTPError as e:
+            c.logger.error(f"API call: {api} - Error: {e}")
+            return {'http_status': None, 'response': {}}
+
+        return det.api_response(api, resp.status_code, resp.content)
+
+    async def det_login(self):
+        """ Async Det API login (see det_api_helper.login)
+        """
+        if self.det_token is not None:
+            await self.det_logout()
+
+        if 'auth' in c.det_config \
+            and 'username' in c.det_config['auth'] \
+            and 'password' in c.det_config['auth']:
+
+            payload = {
+                "username": c.det_config['auth']['username'],
+                "password": c.det_config['auth']['password'],
+            }
+
+            res = await self.api_call('/api/v1/auth/login', 'POST', payload)
+
+            if res['http_status'] == 200 and 'token' in res['response']:
+                c.logger.debug("Det API login executed")
+                self.det_token = res['response']['token']
+                return True
+            else:
+                c.logger.error("Det API login error")
+                self.det_token = None
+                return False
+
+        else:
+            c.logger.error('Det APIs mandatory connection info are omitted')
+            return False
+
+    async def det_logout(self):
+        """ Async Det API logout (see det_api_helper.logout)
+        """
+        if self.det_token is not None:
+            await self.api_call('/api/v1/auth/logout', 'POST', bearer=self.det_token)
+            self.det_token = None
+        return True
+
+    async def det_get_users(self):
+        """ Async Det API users (see det_api_helper.get_users)
+        """
+        res = await self.api_call('/api/v1/users?limit=0', 'GET', bearer=self.det_token)
+        return det.parse_users(res)
+
+    async def det_get_groups(self):
+        """ Async Det API groups (see det_api_helper.get_groups)
+        """
+        res = await self.api_call('/api/v1/groups/search', 'POST', payload={"limit": -1}, bearer=self.det_token)
+        return det.parse_groups(res)
+
+    async def det_get_group_users_byid(self, group_id):
+        """ Async Det API group users (see det_api_helper.get_group_users_byid)
+        """
+        res = await self.api_call(f'/api/v1/groups/{group_id}?orderBy=ORDER_BY_DESC&limit=-1', 'GET', bearer=self.det_token)
+        return det.parse_group_users(res)
+
+    async def det_group_add_rm_users(self, group_id, add_user_ids=[], rm_user_ids=[]):
+        """ Async Det API group assignments (see det_api_helper.group_add_rm_users)
+        """
+        payload = {
+            "addUsers": add_user_ids,
+            "removeUsers": rm_user_ids
+        }
+        res = await self.api_call(f'/api/v1/groups/{group_id}', 'PUT', payload=payload, bearer=self.det_token)
+        return res['response'].get('group', {}).get('users', []) if res['http_status'] == 200 else []
+
+_loop = None      # event loop, kept for the life of the process (see run, close)
+_client = None    # AsyncAPIClient, kept for the life of the process (see run, close)
+
+async def _new_client():
+    """ (priv) Returns a new AsyncAPIClient, created in the running event loop
+    """
+    return AsyncAPIClient(c.scim_config.get('max_concurrency', 100))
+
+def run(coro_func, *args):
+    """ Runs a coroutine function with the AsyncAPIClient (first argument) in the event loop.
+        The event loop and the client (keep-alive connections pools) are created by the first run 
+        and reused by the next ones, up to close()
+
+        Args:
+            coro_func: coroutine function(client, *args)
+            args: other coroutine function arguments
+
+        Returns:
+            the coroutine result
+    """
+    global _loop, _client
+
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+
+    if _client is None:
+        _client = _loop.run_until_complete(_new_client())
+
+    return _loop.run_until_complete(coro_func(_client, *args))
+
+def close():
+    """ Closes the AsyncAPIClient and the event loop (if created by run)
+    """
+    global _loop, _client
+
+    if _loop is None:
+        return
+
+    try:
+        if _client is not None:
+            _loop.run_until_complete(_client.aclose())
+        _loop.run_until_complete(_loop.shutdown_asyncgens())
+        _loop.run_until_complete(_loop.shutdown_default_executor())
+    except Exception as e:
+        c.logger.error("Error closing the async engine - error: %s" % e)
+    finally:
+        _loop.close()
+        _loop = None
+        _client = None
@@ -13,6 +13,10 @@ import re
 from datetime import datetime
 
 from libs import plugin as plg
+from libs import sync_state as ss
+from libs import ldap_plugin_common as lpc
+from libs import mapping_cache as mc
+from libs import scim_helper as sh
 
 # define common global consts
 LOGGER_NAME = 'ldap_sync'
@@ -37,17 +41,41 @@ ldap_plugin = None      # plugin vendor-dependent for LDAP entries processing an
 custom_plugin = None    # (optional) plugin to execute operations before and after users update on the Determined platform 
 curr_dir = ""           # main file current directory
 
+# compiled scim_api.attr_mapping
+scim_mappers = []       # per-key mapper functions (see ldap_plugin_common.compile_attr_mapping)
+ldap_mapping_attrs = [] # LDAP attributes required by the mapping
+
+scim_client = None      # SCIM API client (scim_helper.SCIMClient), pooled HTTP connections
+
 # user list
 ldap_users = []         # raw users data retrieved from LDAP
 local_users = []        # user list coming from LDAP to be sent to the Determined platform. It contains users mapped/converted from LDAP to SCIM struct, 
-                        # and it is also used by the Determined APIs functionality
-curr_local_users = []   # user list coming from the Determined platform, by SCIM
+                        # and it is also used by the Determined APIs functionality (compact scim.UserRecord items)
+curr_local_users = []   # user list coming from the Determined platform, by SCIM (compact scim.UserRecord items)
+curr_users_total = None # users on the platform at the last full SCIM user list (targeted lookups selection)
+
+# incremental sync (ldap.incremental)
+ldap_delta_cycle = False    # True if the current cycle retrieves only the LDAP entries changed since the last watermark
+ldap_changed_dns = set()    # targeted delta cycle - DNs of the changed LDAP entries (LDAP change notifications)
+local_users_delta = []      # users mapped in the current delta cycle (subset of local_users)
+local_users_cache = {}      # full view of the mapped users (by externalId or userName) merged cycle by cycle
 
 # SCIM user list with operations to be executed on the SCIM API interface
 local_users_ops = { 'add': [],
                     'update': [],
                     'delete': []
 } 
+local_users_changed_attrs = {}  # SCIM id -> changed fields of the users to update (field-level PATCH)
+
+# MLDE groups assignments computed by auto_assign_mlde_groups in plan mode
+local_groups_ops = { 'add': {},     # group id -> userNames to add
+                     'rm': {}       # group id -> userNames to remove
+}
+
+# run mode (main file --mode): 'sync' computes and applies the changes, 
+# 'plan' writes the computed changes in the plan file, 'apply' executes the plan file
+sync_mode = 'sync'
+plan_filename = ""      # sync plan file full pathname (plan/apply modes)
 
 # common general purpose functions 
 
@@ -128,7 +156,7 @@ def init(config_file_path=None, version=''):
     
     global logger, config, ldap_plugin, custom_plugin, curr_dir, \
            ldap_config, ldap_config_auth, ldap_config_users, \
-           scim_config, det_config
+           scim_config, det_config, scim_mappers, ldap_mapping_attrs, scim_client
 
     # set current dir
     curr_dir = os.path.dirname(os.path.abspath(__file__))
@@ -231,12 +259,21 @@ def init(config_file_path=None, version=''):
         logger.error("Config does not contain [scim_api] key - exit")
         sys.exit(1) # General error
 
+    # SCIM API client (created once, HTTP connections reused by all the calls)
+    scim_client = sh.create_scim_client()
+    if scim_client is None:
+        logger.error("Cannot create the SCIM API client (scim_api.url or scim_api.auth) - exit")
+        sys.exit(1) # General error
+
     if 'det_api' in config:
         det_config = config['det_api']
     else:
         logger.error("Config does not contain [det_api] key - exit")
         sys.exit(1) # General error
 
+    # load the local state file (incremental sync watermarks, etc.)
+    ss.load(config.get('state_file'))
+
     # plugins loader
     if 'ldap_plugin' in ldap_config:
         logger.info("LDAP plugin [%s] enabled" % ldap_config['ldap_plugin'])
@@ -249,6 +286,18 @@ def init(config_file_path=None, version=''):
         logger.error("LDAP plugin (ldap_plugin key) not defined in configuration - exit")
         sys.exit(1) # General error
 
+    # compile the SCIM attributes mapping (LDAP plugin specific mappers, if any)
+    if 'attr_mapping' in scim_config:
+        field_mappers = ldap_plugin.ldap_field_mappers() if hasattr(ldap_plugin, 'ldap_field_mappers') else None
+        scim_mappers, ldap_mapping_attrs = lpc.compile_attr_mapping(scim_config['attr_mapping'], field_mappers)
+        logger.debug("SCIM attributes mapping compiled - LDAP attributes: %s" % ldap_mapping_attrs)
+
+        # cross-cycle cache of the mapped users (invalidated if attr_mapping changes)
+        mc.init(scim_config.get('mapping_cache'), scim_config['attr_mapping'])
+    else:
+        logger.error("Config does not contain [scim_api.attr_mapping] key - exit")
+        sys.exit(1) # General error
+
     if 'custom_plugin' in config:
         if config['custom_plugin'] is None:
             logger.info("Customization plugin disabled")
@@ -4,9 +4,10 @@
 #
 
 import requests
-import json
 
 from libs import common as c
+from libs import rate_limiter as rl
+from libs import json_codec as jc
 
 token = None
 
@@ -28,29 +29,32 @@ def api_call(api, method='GET', payload={}, bearer=None):
             'Authorization': 'Bearer '+bearer
         }
         
-    try:
+    def _send():
         if method.upper() == 'GET':
             #in api if GET also set eventual parameters
-            resp = requests.get(url+api , 
+            return requests.get(url+api , 
                                  headers=headers)
 
         elif method.upper() == 'POST':
-            resp = requests.post(url+api , 
+            return requests.post(url+api , 
                                     headers=headers,
-                                    json=payload)
+                                    data=jc.dumps(payload))
 
         elif method.upper() == 'PUT':
-            resp = requests.put(url+api , 
+            return requests.put(url+api , 
                                     headers=headers,
-                                    json=payload)
+                                    data=jc.dumps(payload))
         else:
             # TODO implement other methods
-            resp = requests.post(url+api , 
+            return requests.post(url+api , 
                                     headers=headers,
-                                    json=payload)
-            
+                                    data=jc.dumps(payload))
+
+    try:
+        # through the rate limiter (det_api.rate_limit, throttled requests retried, see rate_limiter)
+        resp = rl.call('det', api, _send, requests.exceptions.Timeout, method, requests.exceptions.ConnectTimeout)
+
     except requests.exceptions.Timeout:
-        # Maybe set up for a retry, or continue in a retry loop
         c.logger.error(f"API call: {api} - Error: Timeout")
         return {'http_status': None, 'response': {}} 
     except requests.exceptions.TooManyRedirects:
@@ -63,15 +67,28 @@ def api_call(api, method='GET', payload={}, bearer=None):
 
 
     # Manage REST response
-    if resp.status_code in [200,201,202]:   # http ok, created, accepted
-        content = json.loads(resp.text)
-        c.logger.debug(f"API call: {api} - HTTP ok - status: {resp.status_code}")
-        return {'http_status': resp.status_code, 'response': content}
+    return api_response(api, resp.status_code, resp.content)
+
+def api_response(api, status_code, text):
+    """ Manages the HTTP response of a Det API call (see api_call)
+
+        Args:
+            api: API path
+            status_code: HTTP status
+            text: HTTP response body
+
+        Returns:
+            {'http_status': <HTTP status>, 'response': {<the response content>}}
+    """
+    if status_code in [200,201,202]:   # http ok, created, accepted
+        content = jc.loads(text)
+        c.logger.debug(f"API call: {api} - HTTP ok - status: {status_code}")
+        return {'http_status': status_code, 'response': content}
         
     else:
         c.curr_local_users = [] # reset
-        c.logger.error(f"API call: {api} - HTTP error - status: {resp.status_code}")
-        return {'http_status': resp.status_code, 'response': {}}
+        c.logger.error(f"API call: {api} - HTTP error - status: {status_code}")
+        return {'http_status': status_code, 'response': {}}
 
 
 def login():
@@ -132,11 +149,7 @@ def get_users():
     if token is not None:
 
         res = api_call('/api/v1/users?limit=0', 'GET', bearer=token)
-
-        if res['http_status'] == 200 and 'users' in res['response']:
-            for user in res['response']['users']:
-                users_byid[user['id']] = user
-                users_byname[user['username']] = user
+        users_byid, users_byname = parse_users(res)
 
     else:
         c.logger.error('Det APIs token is not available')
@@ -159,12 +172,8 @@ def get_groups():
         }
 
         res = api_call('/api/v1/groups/search', 'POST', payload=payload,  bearer=token)
+        groups_byid, groups_byname = parse_groups(res)
 
-        if res['http_status'] == 200 and 'groups' in res['response']:
-
-            for group in res['response']['groups']:
-                groups_byid[group['group']['groupId']] = group['group']
-                groups_byname[group['group']['name']] = group['group']
     else:
         c.logger.error('Det APIs token is not available')
 
@@ -178,12 +187,8 @@ def get_group_users_byid(group_id):
     if token is not None:
 
         res = api_call(f'/api/v1/groups/{group_id}?orderBy=ORDER_BY_DESC&limit=-1', 'GET', bearer=token)
+        users_byid = parse_group_users(res)
 
-        if res['http_status'] == 200 and 'group' in res['response'] \
-            and 'users' in res['response']['group']:
-
-            for user in res['response']['group']['users']:
-                users_byid[user['id']] = user
     else:
         c.logger.error('Det APIs token is not available')
 
@@ -215,3 +220,54 @@ def group_add_rm_users(group_id, add_user_ids=[], rm_user_ids=[]):
     else:
         c.logger.error('Det APIs token is not available')
         return []
+
+
+# responses parsing (shared with the async engine, see async_api)
+
+def parse_users(res):
+    """ Returns the users maps of a /api/v1/users response
+
+        Returns:
+            (users by id, users by name)
+    """
+    users_byid = {}
+    users_byname = {}
+
+    if res['http_status'] == 200 and 'users' in res['response']:
+        for user in res['response']['users']:
+            users_byid[user['id']] = user
+            users_byname[user['username']] = user
+
+    return users_byid, users_byname
+
+def parse_groups(res):
+    """ Returns the groups maps of a /api/v1/groups/search response
+
+        Returns:
+            (groups by id, groups by name)
+    """
+    groups_byid = {}
+    groups_byname = {}
+
+    if res['http_status'] == 200 and 'groups' in res['response']:
+        for group in res['response']['groups']:
+            groups_byid[group['group']['groupId']] = group['group']
+            groups_byname[group['group']['name']] = group['group']
+
+    return groups_byid, groups_byname
+
+def parse_group_users(res):
+    """ Returns the group users map of a /api/v1/groups/{group_id} response
+
+        Returns:
+            users by id
+    """
+    users_byid = {}
+
+    if res['http_status'] == 200 and 'group' in res['response'] \
+        and 'users' in res['response']['group']:
+
+        for user in res['response']['group']['users']:
+            users_byid[user['id']] = user
+
+    return users_byid
@@ -0,0 +1,70 @@
+#
+# JSON codec module
+# JSON encoding/decoding of the SCIM and Determined API requests and responses:
+# orjson if installed (optional dependency), the standard json module otherwise
+#
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+def _default(o):
+    """ (priv) Returns the JSON serializable value of an object not managed by the backend
+
+        Raises:
+            TypeError if the object is not JSON serializable
+    """
+    if hasattr(o, 'to_dict'):
+        return o.to_dict()      # e.g., scim.UserRecord
+    if hasattr(o, '__dict__'):
+        return o.__dict__       # e.g., scim.SCIMObject
+    raise TypeError("Object of type %s is not JSON serializable" % type(o).__name__)
+
+if orjson is not None:
+
+    def dumps(obj, sort_keys=False):
+        """ Returns the compact JSON encoding of obj
+
+            Args:
+                obj: JSON serializable object
+                sort_keys: (optional, default: False) if True the dict keys are sorted (canonical 
+                           encoding, e.g. for hashing)
+
+            Returns:
+                UTF-8 encoded JSON (bytes)
+
+            Raises:
+                TypeError if obj is not JSON serializable
+        """
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+
+    def loads(data):
+        """ Returns the object decoded from JSON
+
+            Args:
+                data: JSON (bytes or str)
+
+            Returns:
+                decoded object
+
+            Raises:
+                ValueError if data is not valid JSON
+        """
+        return orjson.loads(data)
+
+else:
+
+    def dumps(obj, sort_keys=False):
+        """ Returns the compact JSON encoding of obj (see orjson dumps)
+        """
+        return json.dumps(obj, default=_default, separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys).encode('utf-8')
+
+    def loads(data):
+        """ Returns the object decoded from JSON (see orjson loads)
+        """
+        return json.loads(data)
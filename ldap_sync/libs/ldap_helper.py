@@ -1,12 +1,33 @@
 #
 # LDAP helper module
 #
+import re
 import codecs
 import uuid
+import time
+import queue
+import threading
+import contextlib
 import ldap
 
+from concurrent.futures import ThreadPoolExecutor
+
+from ldap.controls import SimplePagedResultsControl
+
 from libs import common as c
 
+SHARD_CHARS = 'abcdefghijklmnopqrstuvwxyz0123456789'  # first characters of the sharding attribute
+
+_SHARD_DONE = object()  # end of shard marker (parallel searches)
+
+FAILOVER_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR)   # errors that move the requests to the next DC
+LATENCY_EWMA_ALPHA = 0.3    # weight of the last measure in the DC latency score
+
+RANGE_ATTR_RE = re.compile(r'^(.+);range=(\d+)-(\d+|\*)$', re.IGNORECASE)   # ranged attribute, e.g., memberOf;range=0-1499
+
+_pools = {}                 # LDAP connection pools by (url, user, tls)
+_pools_lock = threading.Lock()
+
 def handle_ldap_entry(entry):
     """ Default LDAP entry handler - logs the user (entry) attributes
         Convert objectGUID, UUID to readable strings.
@@ -31,6 +52,619 @@ def handle_ldap_entry(entry):
 
         c.logger.debug("  %-20s %s" % (k, es)) 
 
+def ldap_connect(ldap_url, ldap_user, ldap_password, ldap_tls=False, timeout=None):
+    """ Opens and binds an LDAP connection
+
+        Args:
+            ldap_url: URL of the LDAP endpoint (e.g., ldap://hostname...)
+            ldap_user: DN of the LDAP user 
+            ldap_password: password LDAP user 
+            ldap_tls: (optional, default: False) TLS layer active 
+            timeout: (optional, default: None) network and operations timeout in seconds (None = no timeout)
+
+        Returns:
+            bound LDAP connection
+
+        Raises:
+            ldap.LDAPError exceptions 
+    """
+
+    # TODO: activate and test the TLS functionality
+
+    c.logger.debug("Contacting LDAP [%s]" % ldap_url) 
+    l = ldap.initialize(ldap_url)
+
+    try:
+        l.protocol_version = ldap.VERSION3
+
+        if timeout is not None:
+            # a down or unreachable DC fails fast instead of waiting for the TCP timeout
+            l.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+            l.set_option(ldap.OPT_TIMEOUT, timeout)
+
+        l.simple_bind_s(ldap_user, ldap_password) 
+
+    except ldap.LDAPError:
+        # the connection is not returned to the caller - close it
+        try:
+            l.unbind_s()
+        except ldap.LDAPError:
+            pass
+        raise
+
+    return l
+
+class LDAPConnectionPool:
+    """ Pool of bound LDAP connections reused across the sync cycles
+        (it saves the connection, TLS handshake and bind of every cycle).
+
+        The idle connections are health-checked (whoami) before reuse if idle for more than 
+        idle_check seconds, and transparently replaced if the server dropped them.
+        A connection that raises a failover error (FAILOVER_ERRORS) while in use is discarded.
+
+        Multi-DC: if a list of LDAP URLs is provided, the DCs are probed and scored by the observed 
+        bind and search latency (EWMA), new connections go to the fastest healthy DC.
+        A failed DC is skipped for failure_backoff seconds.
+        A DC can be pinned (see pin): it is preferred while healthy (e.g., the DC of the incremental 
+        sync watermark, uSNChanged is local to each DC).
+
+        Usage:
+            pool = ldap_get_pool(url, user, password)
+            with pool.connection() as l:
+                l.search_ext(...)
+    """
+
+    def __init__(self, ldap_url, ldap_user, ldap_password, ldap_tls=False, max_size=4, idle_check=30,
+                 timeout=None, probe_interval=300, failure_backoff=60):
+        """ 
+            Args:
+                ldap_url: URL or list of URLs of the LDAP endpoints (DCs)
+                ldap_user, ldap_password, ldap_tls: LDAP connection params (see ldap_connect)
+                max_size: (optional, default: 4) max connections (in use + idle)
+                idle_check: (optional, default: 30) seconds of idle after which a connection is health-checked
+                timeout: (optional, default: None) network and operations timeout in seconds
+                probe_interval: (optional, default: 300) seconds between DCs latency probes (multi-DC only)
+                failure_backoff: (optional, default: 60) seconds a failed DC is skipped
+        """
+        self.ldap_urls = [ldap_url] if isinstance(ldap_url, str) else list(ldap_url)
+        self.ldap_user = ldap_user
+        self.ldap_password = ldap_password
+        self.ldap_tls = ldap_tls
+        self.idle_check = idle_check
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self.failure_backoff = failure_backoff
+        self.pinned_url = None  # preferred DC (see pin)
+        self.served_urls = set()    # DCs that served the entries of the last users retrieval (see ldap_retrieve_users)
+
+        self._idle = []         # list of (connection, last used time)
+        self._conn_url = {}     # DC of each open connection (by id)
+        self._latency = {}      # DC latency score (EWMA, seconds)
+        self._failed = {}       # DC failure time
+        self._probed = None     # last probe time
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _record_latency(self, url, seconds):
+        with self._lock:
+            prev = self._latency.get(url)
+            self._latency[url] = seconds if prev is None else (1 - LATENCY_EWMA_ALPHA) * prev + LATENCY_EWMA_ALPHA * seconds
+            self._failed.pop(url, None)
+
+    def mark_failed(self, url):
+        """ Marks a DC as failed, it is skipped for failure_backoff seconds (if other DCs are available)
+
+            Args:
+                url: LDAP URL of the DC
+        """
+        c.logger.warning("LDAP server [%s] marked as failed" % url)
+
+        with self._lock:
+            self._failed[url] = time.time()
+            failed_idle = [(l, t) for l, t in self._idle if self._conn_url.get(id(l)) == url]
+            self._idle = [(l, t) for l, t in self._idle if self._conn_url.get(id(l)) != url]
+
+        for l, _ in failed_idle:
+            self._unbind(l)
+
+    def is_failed(self, url):
+        """ Checks if a DC failed in the last failure_backoff seconds
+
+            Args:
+                url: LDAP URL of the DC
+        """
+        with self._lock:
+            return url in self._failed and time.time() - self._failed[url] < self.failure_backoff
+
+    def pin(self, url):
+        """ Pins a DC: it is preferred to the faster ones while healthy
+
+            Args:
+                url: LDAP URL of the DC, None to unpin
+        """
+        self.pinned_url = url
+
+    def _preferred_urls(self):
+        # ranked DCs, the pinned one first if healthy
+        urls = self.ranked_urls()
+        if self.pinned_url in urls and not self.is_failed(self.pinned_url):
+            urls.remove(self.pinned_url)
+            urls.insert(0, self.pinned_url)
+        return urls
+
+    def url_of(self, l):
+        """ Returns the DC URL of a connection of the pool
+        """
+        return self._conn_url.get(id(l))
+
+    def ranked_urls(self):
+        """ Returns the DCs URLs ordered by preference: healthy DCs first, by latency score 
+            (DCs never measured first, to measure them), then the failed ones
+        """
+        now = time.time()
+        with self._lock:
+            def _rank(url):
+                failed = url in self._failed and now - self._failed[url] < self.failure_backoff
+                latency = self._latency.get(url)
+                return (failed, latency is not None, latency or 0)
+
+            return sorted(self.ldap_urls, key=_rank)
+
+    def probe(self):
+        """ Probes all the DCs measuring bind and rootDSE search latency (multi-DC only)
+        """
+        self._probed = time.time()
+
+        if len(self.ldap_urls) < 2:
+            return
+
+        for url in self.ldap_urls:
+            try:
+                _st = c.start_time()
+                l = ldap_connect(url, self.ldap_user, self.ldap_password, self.ldap_tls, self.timeout)
+                l.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['supportedLDAPVersion'])
+                self._record_latency(url, c.stop_time(_st))
+                self._unbind(l)
+            except ldap.LDAPError as e:
+                c.logger.warning("LDAP server [%s] probe failed - error: %s" % (url, e))
+                self.mark_failed(url)
+
+        c.logger.debug("LDAP servers latency: %s" % self._latency)
+
+    def _is_alive(self, l):
+        try:
+            l.whoami_s()
+            return True
+        except ldap.LDAPError as e:
+            c.logger.debug("LDAP pooled connection dropped - error: %s" % e)
+            return False
+
+    def _connect(self):
+        # connect to the fastest healthy DC, failover to the next ones
+        error = None
+        for url in self._preferred_urls():
+            try:
+                _st = c.start_time()
+                l = ldap_connect(url, self.ldap_user, self.ldap_password, self.ldap_tls, self.timeout)
+                self._record_latency(url, c.stop_time(_st))
+                self._conn_url[id(l)] = url
+                return l
+            except FAILOVER_ERRORS as e:
+                c.logger.warning("LDAP server [%s] connection failed - error: %s" % (url, e))
+                self.mark_failed(url)
+                error = e
+
+        raise error
+
+    def acquire(self):
+        """ Gets an idle connection of the best DC (or opens a new one), it waits if max_size connections are in use
+
+            Returns:
+                bound LDAP connection
+
+            Raises:
+                ldap.LDAPError exceptions 
+        """
+        self._slots.acquire()
+
+        try:
+            if self._probed is None or time.time() - self._probed > self.probe_interval:
+                self.probe()
+
+            best_url = self._preferred_urls()[0]
+
+            while True:
+                with self._lock:
+                    # idle connections of the best DC only
+                    idle = [i for i, (l, _) in enumerate(self._idle) if self._conn_url.get(id(l)) == best_url]
+                    if not idle:
+                        break
+                    l, last_used = self._idle.pop(idle[-1])
+
+                if time.time() - last_used < self.idle_check or self._is_alive(l):
+                    return l
+
+                self._unbind(l)
+
+            return self._connect()
+
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, l, discard=False):
+        """ Returns a connection to the pool
+
+            Args:
+                l: LDAP connection (from acquire)
+                discard: (optional, default: False) if True the connection is closed
+        """
+        if discard:
+            self._unbind(l)
+        else:
+            with self._lock:
+                self._idle.append((l, time.time()))
+
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Context manager - acquires a connection and releases it 
+            (discarded and DC marked as failed in case of failover errors, discarded if 
+            a search generator using it is closed before the end of the search)
+        """
+        l = self.acquire()
+        discard = False
+        try:
+            yield l
+        except FAILOVER_ERRORS:
+            discard = True
+            self.mark_failed(self.url_of(l))
+            raise
+        except GeneratorExit:
+            discard = True
+            raise
+        finally:
+            self.release(l, discard)
+
+    def close(self):
+        """ Closes the idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for l, _ in idle:
+            self._unbind(l)
+
+    def _unbind(self, l):
+        self._conn_url.pop(id(l), None)
+        try:
+            l.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+def ldap_get_pool(ldap_url, ldap_user, ldap_password, ldap_tls=False):
+    """ Returns the connection pool of the LDAP endpoint/user (created at the first call)
+        Pool params from configuration: ldap.auth.pool_size, pool_idle_check, timeout, probe_interval, failure_backoff
+
+        Args:
+            ldap_url: URL or list of URLs of the LDAP endpoints (DCs)
+            ldap_user, ldap_password, ldap_tls: LDAP connection params (see ldap_connect)
+
+        Returns:
+            LDAPConnectionPool
+    """
+    key = (tuple(ldap_url) if isinstance(ldap_url, list) else ldap_url, ldap_user, ldap_tls)
+
+    with _pools_lock:
+        pool = _pools.get(key)
+
+        if pool is None or pool.ldap_password != ldap_password:
+            if pool is not None:
+                pool.close()
+
+            pool = LDAPConnectionPool(ldap_url, ldap_user, ldap_password, ldap_tls,
+                                      max_size=c.ldap_config_auth.get('pool_size', 4),
+                                      idle_check=c.ldap_config_auth.get('pool_idle_check', 30),
+                                      timeout=c.ldap_config_auth.get('timeout'),
+                                      probe_interval=c.ldap_config_auth.get('probe_interval', 300),
+                                      failure_backoff=c.ldap_config_auth.get('failure_backoff', 60))
+            _pools[key] = pool
+
+    return pool
+
+def ldap_get_config_pool():
+    """ Returns the connection pool of the configured LDAP endpoint/s and user (ldap.auth)
+
+        Returns:
+            LDAPConnectionPool
+    """
+    return ldap_get_pool(c.ldap_config_auth['url'],
+                         c.ldap_config_auth['user'],
+                         c.ldap_config_auth['password'],
+                         c.ldap_config_auth['tls'])
+
+def ldap_close_pools():
+    """ Closes the idle connections of all the pools
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+
+def ldap_search_failover(pool, shards, scope, attrs, page_size=0, served_urls=None):
+    """ Executes the shards searches on a pooled connection; if the DC fails during a search
+        the search is restarted on the next DC, without restarting the sync cycle.
+        The completed shards are not searched again, the entries of the restarted shard 
+        are returned again (the caller skips the DNs already processed).
+
+        Args:
+            pool: LDAPConnectionPool 
+            shards: list of (base DN, filter) (see ldap_search_shards)
+            scope: search scope (e.g., ldap.SCOPE_SUBTREE)
+            attrs: list of LDAP attributes to retrieve
+            page_size: (optional, default: 0) entries per page, 0 = paging disabled
+            served_urls: (optional, default: None) set filled with the DCs that returned entries 
+                         or completed a search
+
+        Yields:
+            (dn, entry) of each received LDAP entry
+
+        Raises:
+            ldap.LDAPError exceptions (if all the DCs failed)
+    """
+    pending = list(shards)
+    failures = 0
+
+    while pending:
+        try:
+            with pool.connection() as l:
+                url = pool.url_of(l)
+                while pending:
+                    base_dn, search_filter = pending[0]
+                    for item in ldap_search_entries(l, base_dn, scope, search_filter, attrs, page_size):
+                        if served_urls is not None:
+                            served_urls.add(url)
+                        yield item
+                    if served_urls is not None:
+                        served_urls.add(url)
+                    pending.pop(0)
+
+        except FAILOVER_ERRORS as e:
+            failures += 1
+            if failures >= len(pool.ldap_urls):
+                raise
+
+            c.logger.warning("LDAP search failed - error: %s - failover to the next LDAP server" % e)
+
+def ldap_search_entries(l, base_dn, scope, search_filter, attrs, page_size=0, serverctrls=None, result_ctrls=None):
+    """ Asynchronous LDAP search generator 
+        The search is sent by search_ext() and every entry is returned by result3() as soon as it is 
+        received (message-id API), so the caller processes the received entries while the next ones are 
+        still arriving.
+        If page_size > 0 it uses the RFC 2696 Simple Paged Results control, the next page is requested 
+        when the current one is completed.
+
+        Args:
+            l: bound LDAP connection
+            base_dn: search base DN
+            scope: search scope (e.g., ldap.SCOPE_SUBTREE)
+            search_filter: LDAP filter 
+            attrs: list of LDAP attributes to retrieve
+            page_size: (optional, default: 0) entries per page, 0 = paging disabled
+            serverctrls: (optional, default: None) list of additional LDAP server controls (e.g., DirSync)
+            result_ctrls: (optional, default: None) list filled with the server controls returned 
+                          by the last search result message
+
+        If the generator is closed before the end of the search, the search is abandoned.
+
+        Yields:
+            (dn, entry) of each received LDAP entry (referrals are skipped)
+
+        Raises:
+            ldap.LDAPError exceptions 
+    """
+
+    if page_size is not None and page_size > 0:
+        page_ctrl = SimplePagedResultsControl(True, size=page_size, cookie='')
+    else:
+        page_ctrl = None    # not paged
+
+    page_num = 0
+
+    while True:
+        ctrls = list(serverctrls or [])
+        if page_ctrl is not None:
+            ctrls.append(page_ctrl)
+
+        msgid = l.search_ext(base_dn, scope, search_filter, attrs, serverctrls=ctrls or None)
+        
+        page_num += 1
+        entries = 0
+        completed = False
+
+        # get the entries one at a time (all=0) up to the search result message
+        try:
+            while True:
+                rtype, rdata, _, resp_ctrls = l.result3(msgid, all=0)
+
+                if rtype == ldap.RES_SEARCH_RESULT:
+                    completed = True
+                    break
+
+                if rtype == ldap.RES_SEARCH_ENTRY:
+                    for dn, entry in rdata:
+                        entries += 1
+                        yield dn, entry
+        finally:
+            if not completed:
+                # closed by the caller or failed before the end of the search - the pending 
+                # results are not left on the connection
+                try:
+                    l.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+
+        c.logger.debug('LDAP page %d - entries: %d' % (page_num, entries))
+
+        if result_ctrls is not None:
+            result_ctrls[:] = resp_ctrls
+
+        if page_ctrl is None:
+            break
+
+        # get the cookie of the next page (empty if last page)
+        page_ctrls = [ctrl for ctrl in resp_ctrls if ctrl.controlType == SimplePagedResultsControl.controlType]
+        if not page_ctrls:
+            c.logger.warning('LDAP server ignored the paged results control')
+            break
+
+        if not page_ctrls[0].cookie:
+            break   # last page
+
+        page_ctrl.cookie = page_ctrls[0].cookie
+
+def ldap_search_shards(user_dn, user_filter, shard_attr=None):
+    """ Splits the users search in shards: one for each base DN and, if shard_attr is provided, 
+        one for each first character of the shard_attr value (SHARD_CHARS) plus the remainder
+
+        Args:
+            user_dn: base DN or list of base DNs
+            user_filter: LDAP filter
+            shard_attr: (optional, default: None) attribute used to partition the filter (e.g., sAMAccountName)
+
+        Returns:
+            list of (base DN, filter)
+    """
+    base_dns = [user_dn] if isinstance(user_dn, str) else list(user_dn)
+
+    if shard_attr:
+        filters = ['(&%s(%s=%s*))' % (user_filter, shard_attr, ch) for ch in SHARD_CHARS]
+        filters.append('(&%s(!(|%s)))' % (user_filter, ''.join('(%s=%s*)' % (shard_attr, ch) for ch in SHARD_CHARS)))
+    else:
+        filters = [user_filter]
+
+    return [(base_dn, f) for base_dn in base_dns for f in filters]
+
+def ldap_parallel_search_entries(pool, shards, scope, attrs, page_size=0, max_workers=4, served_urls=None):
+    """ Executes the shards searches at the same time on a bounded thread pool, each worker
+        on its own LDAP connection (from the LDAP connection pool). The entries are merged in a queue and returned to the 
+        caller thread (the entry handlers are not required to be thread-safe).
+
+        Args:
+            pool: LDAPConnectionPool 
+            shards: list of (base DN, filter) (see ldap_search_shards)
+            scope: search scope (e.g., ldap.SCOPE_SUBTREE)
+            attrs: list of LDAP attributes to retrieve
+            page_size: (optional, default: 0) entries per page, 0 = paging disabled
+            max_workers: (optional, default: 4) max concurrent searches / LDAP connections
+            served_urls: (optional, default: None) set filled with the DCs that served the shards 
+                         (see ldap_search_failover)
+
+        Yields:
+            (dn, entry) of each received LDAP entry
+
+        Raises:
+            ldap.LDAPError exceptions of the shard searches
+    """
+    entries = queue.Queue(maxsize=max(page_size, 1000))
+    stop = threading.Event()
+
+    def _put(item):
+        # bounded queue - stop waiting if the consumer is closed
+        while not stop.is_set():
+            try:
+                entries.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _search_shard(base_dn, search_filter):
+        try:
+            for item in ldap_search_failover(pool, [(base_dn, search_filter)], scope, attrs, page_size, served_urls):
+                if not _put(item):
+                    break
+        finally:
+            _put(_SHARD_DONE)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_search_shard, base_dn, search_filter) for base_dn, search_filter in shards]
+
+        try:
+            pending = len(futures)
+            while pending > 0:
+                item = entries.get()
+                if item is _SHARD_DONE:
+                    pending -= 1
+                else:
+                    yield item
+        finally:
+            stop.set()
+
+        for future in futures:
+            future.result()     # raises the shard search errors
+
+def ldap_has_ranged_attrs(entry):
+    """ Checks if an LDAP entry contains ranged attributes (e.g., memberOf;range=0-1499):
+        MS A/D returns the multi-valued attributes above MaxValRange values (default 1500) by ranges
+
+        Args:
+            entry: LDAP entry
+
+        Returns:
+            True if the entry contains ranged attributes
+    """
+    return any(';range=' in k for k in entry)
+
+def ldap_resolve_ranged_attrs(l, entries, batch_size=100):
+    """ Completes the ranged attributes of the entries (e.g., memberOf;range=0-1499 -> memberOf)
+        fetching the remaining ranges (attr;range=<next>-*). The requests of a batch of entries 
+        are all sent before reading the results (pipelined on the connection), until all the 
+        ranges are completed. The entries are changed in place.
+
+        Args:
+            l: bound LDAP connection
+            entries: list of (dn, entry) 
+            batch_size: (optional, default: 100) max pipelined requests
+
+        Raises:
+            ldap.LDAPError exceptions 
+    """
+
+    def _merge_ranges(dn, entry, ranged_entry, attr=None):
+        # merge the ranged values in the plain attr and returns the next ranges to fetch
+        next_ranges = []
+        for k in list(ranged_entry):
+            m = RANGE_ATTR_RE.match(k)
+            if m is None or (attr is not None and m.group(1).lower() != attr.lower()):
+                continue
+
+            range_attr = attr or m.group(1)
+            entry.setdefault(range_attr, []).extend(ranged_entry[k])
+            if ranged_entry is entry:
+                del entry[k]
+
+            if m.group(3) != '*':
+                next_ranges.append((dn, entry, range_attr, int(m.group(3)) + 1))
+
+        return next_ranges
+
+    pending = []    # (dn, entry, attr, next range low)
+    for dn, entry in entries:
+        pending.extend(_merge_ranges(dn, entry, entry))
+
+    while pending:
+        batch, pending = pending[:batch_size], pending[batch_size:]
+
+        msgids = [(l.search_ext(dn, ldap.SCOPE_BASE, '(objectClass=*)', ['%s;range=%d-*' % (attr, low)]), dn, entry, attr)
+                  for dn, entry, attr, low in batch]
+
+        for msgid, dn, entry, attr in msgids:
+            _, rdata, _, _ = l.result3(msgid)
+            for _, ranged_entry in rdata:
+                if ranged_entry is not None:
+                    pending.extend(_merge_ranges(dn, entry, ranged_entry, attr))
+
 def ldap_retrieve_users(ldap_url, 
                         ldap_user, 
                         ldap_password, 
@@ -38,18 +672,36 @@ def ldap_retrieve_users(ldap_url,
                         user_attr=['cn', 'mail' ,'objectGUID'], 
                         user_filter="", 
                         ldap_tls=False, 
-                        handle_entry=handle_ldap_entry):
+                        handle_entry=handle_ldap_entry,
+                        page_size=0,
+                        shard_attr=None,
+                        max_workers=1,
+                        range_batch_size=100):
     """ Get users from an LDAP endpoint
         
         Args:
-            ldap_url: URL of the LDAP endpoint (e.g., ldap://hostname...)
+            ldap_url: URL of the LDAP endpoint (e.g., ldap://hostname...) or list of URLs (DCs, see LDAPConnectionPool)
             ldap_user: DN of the LDAP user 
             ldap_password: password LDAP user 
-            user_dn: users to retrieve DN 
+            user_dn: users to retrieve DN or list of DNs
             user_attr: (optional, default: ['cn', 'mail' ,'objectGUID']) list of users' LDAP attributes to retrieve
             user_filter: (optional, default: "") LDAP filter 
             ldap_tls: (optional, default: False) TLS layer active 
             handle_entry: (optional, default: handle_ldap_entry) LDAP entries' processing handler
+            page_size: (optional, default: 0) if > 0 entries are retrieved by pages of page_size entries 
+                       (RFC 2696 Simple Paged Results)
+            shard_attr: (optional, default: None) attribute used to partition the filter (see ldap_search_shards)
+            max_workers: (optional, default: 1) if > 1 the shards (base DNs / filter partitions) are 
+                         retrieved at the same time on max_workers LDAP connections
+            range_batch_size: (optional, default: 100) max pipelined requests to complete the 
+                              ranged attributes (see ldap_resolve_ranged_attrs)
+
+        Each entry is passed to handle_entry as soon as it is received (see ldap_search_entries),
+        the entries with ranged attributes (e.g., memberOf above 1500 values) are completed in 
+        batches and passed to handle_entry at the end of the search.
+
+        The DCs that served the entries are stored in the pool served_urls (e.g., the incremental 
+        sync watermark is valid only if a single DC served all the entries).
 
         Returns:
             True if LDAP retrieval ok
@@ -59,27 +711,55 @@ def ldap_retrieve_users(ldap_url,
             N/A
     """
 
-    # TODO: activate and test the TLS functionality
     # TODO: export the ldap.SCOPE_SUBTREE as parameter
 
-    try:
-        c.logger.debug("Contacting LDAP") 
-        l = ldap.initialize(ldap_url)
+    shards = ldap_search_shards(user_dn, user_filter, shard_attr)
 
-        l.protocol_version = ldap.VERSION3
-        l.simple_bind_s(ldap_user, ldap_password) 
+    # bound connections are reused across the sync cycles
+    pool = ldap_get_pool(ldap_url, ldap_user, ldap_password, ldap_tls)
+
+    # base DNs could overlap or a search could be restarted on another DC - skip the entries already processed 
+    dedup = (not isinstance(user_dn, str) and len(user_dn) > 1) or len(pool.ldap_urls) > 1
+    processed_dns = set()
+    ranged_entries = []
+    served_urls = set()
+    pool.served_urls = set()
 
+    try:
         #this will scope the entire subtree Users
         searchScope = ldap.SCOPE_SUBTREE
 
-        res = l.search_s(user_dn, searchScope, user_filter, user_attr)
-    
-        for dn, entry in res:
+        if len(shards) > 1 and max_workers > 1:
+            c.logger.debug("LDAP parallel search - shards: %d - workers: %d" % (len(shards), max_workers))
+            entries = ldap_parallel_search_entries(pool, shards, searchScope, user_attr, page_size, max_workers, served_urls)
+        else:
+            entries = ldap_search_failover(pool, shards, searchScope, user_attr, page_size, served_urls)
+
+        for dn, entry in entries:
+            if dedup:
+                if dn in processed_dns:
+                    continue
+                processed_dns.add(dn)
+
+            if ldap_has_ranged_attrs(entry):
+                ranged_entries.append((dn, entry))
+                continue
+
             c.logger.debug('Processing LDAP entry: %s' % dn)
             handle_entry(entry)
-        
-        l.unbind_s()
-        
+
+        # entries with ranged attributes (the search connections are released)
+        if ranged_entries:
+            c.logger.debug('LDAP entries with ranged attributes: %d' % len(ranged_entries))
+
+            with pool.connection() as l:
+                ldap_resolve_ranged_attrs(l, ranged_entries, range_batch_size)
+
+            for dn, entry in ranged_entries:
+                c.logger.debug('Processing LDAP entry: %s' % dn)
+                handle_entry(entry)
+
+        pool.served_urls = served_urls
         return True
 
     except ldap.INVALID_CREDENTIALS:
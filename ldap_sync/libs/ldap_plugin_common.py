@@ -5,7 +5,16 @@
 import codecs
 import uuid
 
+from ldap.filter import escape_filter_chars
+
 from libs import common as c
+from libs import scim
+from libs import sync_state as ss
+from libs import ldap_helper as lh
+
+_cycle_watermark = None # watermark of the current delta cycle query (of the _cycle_url DC)
+_next_watermark = None  # highest watermark attr value retrieved in the current cycle
+_cycle_url = None       # DC pinned for the current cycle (see incremental_cycle_start)
 
 def is_ldap_field(value):
     """ Checks if the value is an LDAP field - syntax: ${LDAP_filed_name}
@@ -118,4 +127,347 @@ def scim_common_mapping(k, v, scim_user, ldap_user):
         # common assignment key, value
         scim_user[k] = get_config_mapping_value(v, ldap_user)
     
-    return scim_user
\ No newline at end of file
+    return scim_user
+
+# attr_mapping compiler
+
+def compile_ldap_field_decoder(f):
+    """ Returns the decoder function of an LDAP field (same conversion of get_config_mapping_value):
+        objectGUID, UUID binary content to a human-readable string, other fields to UTF-8 string
+
+        Args:
+            f: LDAP field name
+
+        Returns:
+            function(ldap_user) -> decoded value ('' if the field does not exist in the ldap_user)
+    """
+    is_guid = f.lower() in ['objectguid', 'uuid']
+
+    def _decode(ldap_user):
+        values = ldap_user.get(f)
+
+        if values is None:
+            c.logger.error('LDAP field [%s] does not exist in the LDAP User: %s' % (f, ldap_user))
+            return ''
+
+        if is_guid:
+            # converts binary guid in a human-readable string
+            return str(uuid.UUID(bytes=values[0]))
+        else:
+            return codecs.decode(values[0], 'utf-8').strip()
+
+    return _decode
+
+def compile_common_mapper(k, v):
+    """ Compiles the common mapping of a SCIM key (see scim_common_mapping) 
+
+        Args:
+            k: SCIM key to map (from config)
+            v: const value or LDAP field to map (from config)
+
+        Returns:
+            function(ldap_user, scim_user) assigning the SCIM key of scim_user
+    """
+    if isinstance(v, str) and is_ldap_field(v):
+        decode = compile_ldap_field_decoder(get_ldap_field(v))
+
+        if k in ['name.givenName', 'name.familyName']:
+            # SCIM define name = { givenName: <value>, familyName: <value> }
+            name_key = k.split('.', 1)[1]
+
+            def _map_name(ldap_user, scim_user):
+                scim_user.setdefault('name', {})[name_key] = decode(ldap_user)
+
+            return _map_name
+
+        elif k == 'emails.work.value':
+            # SCIM define emails = [ (value: email addr, type: 'work|home|...', primary: T|F) ]
+            def _map_email(ldap_user, scim_user):
+                scim_user['emails'] = [{
+                    "value" : decode(ldap_user),
+                    "type" : "work",
+                    "primary" : True
+                }]
+
+            return _map_email
+
+        else:
+            def _map_field(ldap_user, scim_user):
+                scim_user[k] = decode(ldap_user)
+
+            return _map_field
+
+    else:
+        # const value (computed once)
+        const = get_config_mapping_value(v, {})
+
+        def _map_const(ldap_user, scim_user):
+            scim_user[k] = const
+
+        return _map_const
+
+def compile_attr_mapping(attr_mapping, field_mappers=None):
+    """ Compiles the scim_api.attr_mapping configuration in a list of per-key mapper functions
+        (the configuration is interpreted once, not for each user) and derives the list of 
+        LDAP attributes required by the mapping.
+
+        Args:
+            attr_mapping: scim_api.attr_mapping configuration
+            field_mappers: (optional, default: None) LDAP plugin specific mappers (see the 
+                           ldap_field_mappers plugin function): {SCIM key: function(k, v)} 
+                           returning the mapper function, or None if the common mapping applies
+
+        Returns:
+            (list of mapper functions(ldap_user, scim_user), list of LDAP attributes)
+    """
+    mappers = []
+    ldap_attrs = []
+
+    for k, v in attr_mapping.items():
+        # k = SCIM side, v = LDAP field or const
+        mapper = None
+
+        if field_mappers is not None and k in field_mappers:
+            mapper = field_mappers[k](k, v)
+
+        if mapper is None:
+            mapper = compile_common_mapper(k, v)
+
+        mappers.append(mapper)
+
+        if isinstance(v, str) and is_ldap_field(v) and get_ldap_field(v) not in ldap_attrs:
+            ldap_attrs.append(get_ldap_field(v))
+
+    return mappers, ldap_attrs
+
+def map_ldap_user(ldap_user):
+    """ Maps an LDAP user on a SCIM user by the compiled mapping (c.scim_mappers)
+
+        Args:
+            ldap_user: LDAP user entry
+
+        Returns:
+            SCIM user record (scim.UserRecord)
+    """
+    scim_user = {}
+
+    for mapper in c.scim_mappers:
+        mapper(ldap_user, scim_user)
+
+    return scim.UserRecord(scim_user)
+
+# incremental sync (ldap.incremental) 
+
+def is_incremental_enabled():
+    """ Checks if the incremental sync is enabled in configuration (ldap.incremental.enabled)
+
+        Returns:
+            True if enabled, False otherwise
+    """
+    return 'incremental' in c.ldap_config and c.ldap_config['incremental'].get('enabled', False)
+
+def _watermark_attr():
+    """ (private) LDAP attribute used as high-water mark (default: uSNChanged)
+    """
+    return c.ldap_config['incremental'].get('attr', 'uSNChanged')
+
+def _watermark_key(url):
+    """ (private) state key of the watermark: uSNChanged and whenChanged are not replicated between DCs, 
+        so the watermark is stored by attribute and LDAP endpoint (DC)
+    """
+    return '%s|%s' % (_watermark_attr(), url)
+
+def is_notify_enabled():
+    """ Checks if the event-driven sync by LDAP change notifications is enabled in configuration (ldap.notify.enabled)
+
+        Returns:
+            True if enabled, False otherwise
+    """
+    return 'notify' in c.ldap_config and c.ldap_config['notify'].get('enabled', False)
+
+def incremental_cycle_start(changed_dns=None):
+    """ Defines if the current cycle is a delta cycle (c.ldap_delta_cycle = True) or a full reconcile.
+        A full reconcile is executed if there is no watermark, no cached users (e.g., at start-up) 
+        or every ldap.incremental.full_sync_every cycles.
+        The full reconcile also catches the users leaving the filter scope or deleted on LDAP, that 
+        the delta query can not see.
+
+        Targeted cycle (LDAP change notifications): if changed_dns is provided and there are cached 
+        users, the cycle is a delta cycle restricted to the changed entries (the watermark is not changed).
+
+        The watermarks are local to each DC (one per DC in the state file): the cycle DC is pinned 
+        in the LDAP connection pool, a delta cycle runs on the best healthy DC with a watermark, 
+        a full reconcile on the best DC.
+
+        Args:
+            changed_dns: (optional, default: None) set of the changed LDAP entries DNs
+    """
+    global _cycle_watermark, _next_watermark, _cycle_url
+
+    c.ldap_delta_cycle = False
+    c.ldap_changed_dns = set()
+    c.local_users_delta = []
+
+    if changed_dns:
+        if c.local_users_cache:
+            c.ldap_delta_cycle = True
+            c.ldap_changed_dns = set(changed_dns)
+            c.logger.info("Targeted delta cycle - changed entries: %d" % len(changed_dns))
+            return
+        
+        c.logger.info("Targeted delta cycle - no cached users")
+
+    if not is_incremental_enabled():
+        return
+
+    pool = lh.ldap_get_config_pool()
+    watermarks = ss.get('ldap_watermarks', {})
+    ranked_urls = pool.ranked_urls()
+
+    # the best healthy DC with a watermark (multi-DC, see ldap_helper.LDAPConnectionPool)
+    watermark_urls = [url for url in ranked_urls if _watermark_key(url) in watermarks and not pool.is_failed(url)]
+
+    cycles = ss.get('ldap_cycles_since_full', 0)
+    full_sync_every = c.ldap_config['incremental'].get('full_sync_every', 24)
+
+    if not watermark_urls:
+        c.logger.info("Incremental sync - full reconcile: no watermark of a healthy LDAP server")
+    elif not c.local_users_cache:
+        c.logger.info("Incremental sync - full reconcile: no cached users")
+    elif full_sync_every > 0 and cycles >= full_sync_every:
+        c.logger.info("Incremental sync - full reconcile: %d cycles since the last one" % cycles)
+    else:
+        c.ldap_delta_cycle = True
+
+    if c.ldap_delta_cycle:
+        _cycle_url = watermark_urls[0]
+        _cycle_watermark = watermarks[_watermark_key(_cycle_url)]
+        c.logger.info("Incremental sync - delta cycle [%s]: %s > %s" % (_cycle_url, _watermark_attr(), _cycle_watermark))
+    else:
+        _cycle_url = ranked_urls[0]
+        _cycle_watermark = None
+
+    # the cycle searches are executed on the cycle DC (while healthy)
+    pool.pin(_cycle_url)
+    _next_watermark = _cycle_watermark
+
+def incremental_cycle_end(ok):
+    """ Stores the new watermark in the state file if the cycle is completed.
+        The watermark is stored only if a single DC served all the entries of the cycle, for that DC:
+        if the searches failed over to other DCs (or a delta cycle was not served by the DC of its 
+        watermark) the watermark is not stored.
+
+        Args:
+            ok: True if the cycle is completed
+    """
+    if not is_incremental_enabled() or not ok or c.ldap_changed_dns:
+        return
+
+    served_urls = lh.ldap_get_config_pool().served_urls
+
+    if len(served_urls) > 1:
+        c.logger.warning("Incremental sync - cycle served by more LDAP servers %s - watermark not stored" % sorted(served_urls))
+    elif c.ldap_delta_cycle and served_urls and _cycle_url not in served_urls:
+        c.logger.warning("Incremental sync - delta cycle served by %s instead of [%s] - watermark not stored" % (sorted(served_urls), _cycle_url))
+    elif _next_watermark is not None:
+        served_url = next(iter(served_urls)) if served_urls else _cycle_url
+        watermarks = ss.get('ldap_watermarks', {})
+        watermarks[_watermark_key(served_url)] = _next_watermark
+        ss.set('ldap_watermarks', watermarks)
+
+    if c.ldap_delta_cycle:
+        ss.set('ldap_cycles_since_full', ss.get('ldap_cycles_since_full', 0) + 1)
+    else:
+        ss.set('ldap_cycles_since_full', 0)
+
+    ss.save()
+
+def get_users_filter():
+    """ Returns the LDAP users filter (ldap.users.filter), 
+        in a delta cycle restricted to the entries changed since the last watermark
+        or, in a targeted delta cycle, to the changed entries DNs
+
+        Returns:
+            LDAP filter string
+    """
+    user_filter = c.ldap_config_users['filter']
+
+    if c.ldap_changed_dns:
+        clause = '(|%s)' % ''.join('(distinguishedName=%s)' % escape_filter_chars(dn) for dn in sorted(c.ldap_changed_dns))
+        user_filter = '(&%s%s)' % (user_filter, clause)
+
+    elif c.ldap_delta_cycle:
+        attr = _watermark_attr()
+
+        if attr.lower() == 'usnchanged':
+            # uSNChanged is an integer (>= only)
+            clause = '(%s>=%d)' % (attr, int(_cycle_watermark) + 1)
+        else:
+            # generalized time (e.g., whenChanged) - entries changed in the same second are retrieved again
+            clause = '(%s>=%s)' % (attr, _cycle_watermark)
+
+        user_filter = '(&%s%s)' % (user_filter, clause)
+
+    return user_filter
+
+def get_users_attrs():
+    """ Returns the LDAP users attributes to retrieve: the attributes required by the mapping 
+        (c.ldap_mapping_attrs), plus the optional ldap.users.attr ones, plus the watermark 
+        attribute if the incremental sync is enabled
+
+        Returns:
+            list of LDAP attributes
+    """
+    attrs = list(c.ldap_mapping_attrs)
+
+    for attr in c.ldap_config_users.get('attr', []):
+        if attr not in attrs:
+            attrs.append(attr)
+
+    if is_incremental_enabled() and _watermark_attr() not in attrs:
+        attrs.append(_watermark_attr())
+
+    return attrs
+
+def track_watermark(ldap_user):
+    """ Updates the watermark of the current cycle with the LDAP entry value (to be called by the entry handlers)
+
+        Args:
+            ldap_user: LDAP user entry
+    """
+    global _next_watermark
+
+    if not is_incremental_enabled():
+        return
+
+    attr = _watermark_attr()
+    if attr not in ldap_user:
+        return
+
+    value = codecs.decode(ldap_user[attr][0], 'utf-8')
+    if attr.lower() == 'usnchanged':
+        value = int(value)
+
+    if _next_watermark is None or value > _next_watermark:
+        _next_watermark = value
+
+def merge_incremental_users():
+    """ Merges the users mapped in the current cycle (c.local_users) in the cached full view.
+        In a delta cycle c.local_users_delta contains the changed users only and c.local_users 
+        the full view, so the SCIM diff works as in a full cycle.
+        In a full reconcile the cached view is replaced.
+    """
+    if not is_incremental_enabled() and not is_notify_enabled():
+        return
+
+    if c.ldap_delta_cycle:
+        c.local_users_delta = c.local_users
+    else:
+        c.local_users_cache = {}    # reset
+
+    for user in c.local_users:
+        c.local_users_cache[user.get('externalId') or user.get('userName')] = user
+
+    c.local_users = list(c.local_users_cache.values())
+
+    c.logger.debug("Incremental sync - changed users: %d - cached users: %d" % (len(c.local_users_delta), len(c.local_users)))
@@ -0,0 +1,181 @@
+#
+# Mapping cache module
+# Cross-cycle LRU cache of the SCIM users mapped from the LDAP entries (scim_api.mapping_cache),
+# optionally persisted to disk (JSON) to survive the restarts
+#
+
+import os
+import hashlib
+
+from collections import OrderedDict
+
+from libs import common as c
+from libs import scim
+from libs import json_codec as jc
+
+MAX_SIZE = 200000   # default max cached users
+
+enabled = False
+max_size = MAX_SIZE
+mapping_hash = ""       # hash of the scim_api.attr_mapping config (cache validity)
+cache = OrderedDict()   # LDAP entry hash -> mapped SCIM user record (LRU order)
+cache_filename = ""     # (optional) persistence file full pathname
+dirty = False           # cache changed since the last save
+hits = 0
+misses = 0
+
+def _mapping_config_hash(attr_mapping):
+    """ (priv) Returns the hash of the attr_mapping configuration
+
+        Args:
+            attr_mapping: scim_api.attr_mapping configuration
+
+        Returns:
+            hex digest
+    """
+    return hashlib.sha1(jc.dumps(attr_mapping, sort_keys=True)).hexdigest()
+
+def entry_key(ldap_user):
+    """ Returns the cache key of an LDAP entry: hash of the raw values of the LDAP attributes
+        used by the mapping (c.ldap_mapping_attrs), the mapping output depends only on them.
+
+        NOTE: whenChanged is not used as key because back-link attributes (e.g., memberOf)
+              change without updating it
+
+        Args:
+            ldap_user: raw LDAP entry
+
+        Returns:
+            hex digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+
+    for attr in c.ldap_mapping_attrs:
+        values = ldap_user.get(attr)
+        if values is None:
+            h.update(b'\x00')
+            continue
+
+        h.update(b'\x01%d' % len(values))
+        for value in values:
+            h.update(b'\x02%d:' % len(value))
+            h.update(value)
+
+    return h.hexdigest()
+
+def init(cache_config, attr_mapping):
+    """ Initializes the mapping cache and loads the persisted one (if configured and
+        generated by the same attr_mapping configuration)
+
+        Args:
+            cache_config: scim_api.mapping_cache configuration (None: cache disabled)
+            attr_mapping: scim_api.attr_mapping configuration
+    """
+    global enabled, max_size, mapping_hash, cache, cache_filename, dirty, hits, misses
+
+    cache = OrderedDict()
+    dirty = False
+    hits = 0
+    misses = 0
+
+    enabled = cache_config is not None and cache_config.get('enabled', False)
+    if not enabled:
+        return
+
+    max_size = cache_config.get('max_size', MAX_SIZE)
+    mapping_hash = _mapping_config_hash(attr_mapping)
+
+    cache_file = cache_config.get('file')
+    if cache_file is None or not isinstance(cache_file, str) or len(cache_file) == 0:
+        cache_filename = ""
+        return
+
+    cache_filename = cache_file if os.path.isabs(cache_file) else os.path.join(c.curr_dir, cache_file)
+
+    if not os.path.exists(cache_filename):
+        c.logger.info("Mapping cache file [%s] not found - empty cache" % cache_filename)
+        return
+
+    try:
+        with open(cache_filename, 'rb') as fd:
+            data = jc.loads(fd.read())
+
+        if data.get('mapping_hash') != mapping_hash:
+            c.logger.info("Mapping cache file [%s] discarded - attr_mapping changed" % cache_filename)
+            dirty = True
+            return
+
+        for key, scim_user in data.get('users', []):
+            cache[key] = scim.UserRecord(scim_user)
+
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+        c.logger.info("Mapping cache file [%s] loaded - cached users: %d" % (cache_filename, len(cache)))
+
+    except Exception as e:
+        c.logger.error("Error loading mapping cache file [%s] - error: %s - empty cache" % (cache_filename, e))
+        cache = OrderedDict()
+
+def map_user(ldap_user, map_fn):
+    """ Returns the SCIM user mapped from the LDAP entry, from the cache if the
+        LDAP attributes used by the mapping did not change
+
+        Args:
+            ldap_user: raw LDAP entry
+            map_fn: mapping function(ldap_user) -> SCIM user record
+
+        Returns:
+            SCIM user record (a copy of the cached one, the caller can change it)
+    """
+    global dirty, hits, misses
+
+    if not enabled:
+        return map_fn(ldap_user)
+
+    key = entry_key(ldap_user)
+    scim_user = cache.get(key)
+
+    if scim_user is not None:
+        cache.move_to_end(key)
+        hits += 1
+    else:
+        scim_user = map_fn(ldap_user)
+        cache[key] = scim_user
+        dirty = True
+        misses += 1
+
+        if len(cache) > max_size:
+            cache.popitem(last=False)   # LRU eviction
+
+    return scim_user.copy()
+
+def save():
+    """ Saves the mapping cache file (if configured and changed) and logs the cache statistics
+
+        Returns:
+            True if saved, False otherwise
+    """
+    global dirty, hits, misses
+
+    if not enabled:
+        return False
+
+    c.logger.debug("Mapping cache - hits: %d - misses: %d - cached users: %d" % (hits, misses, len(cache)))
+    hits = 0
+    misses = 0
+
+    if not cache_filename or not dirty:
+        return False
+
+    try:
+        tmp_filename = cache_filename + '.tmp'
+        with open(tmp_filename, 'wb') as fd:
+            fd.write(jc.dumps({ 'mapping_hash': mapping_hash, 'users': [(key, scim_user.to_dict()) for key, scim_user in cache.items()] }))
+        os.replace(tmp_filename, cache_filename)
+        dirty = False
+        return True
+
+    except Exception as e:
+        c.logger.error("Error saving mapping cache file [%s] - error: %s" % (cache_filename, e))
+        return False
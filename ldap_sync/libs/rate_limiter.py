@@ -0,0 +1,335 @@
+#
+# Rate limiter module
+# Adaptive (AIMD) concurrency and QPS limiting of the SCIM and Determined API requests:
+# the limits are decreased (multiplicative) on 429/503 responses and timeouts and increased
+# (additive) on success, the throttled requests are retried honouring Retry-After.
+# Timeouts are retried only if the request can be sent again without side effects: idempotent
+# methods, or connect timeouts (the request is not sent).
+#
+# Budgets by API (scim_api.rate_limit, det_api.rate_limit - opt-in: rate_limit.enabled) and, 
+# optionally, by endpoint path prefix (rate_limit.endpoints), e.g.:
+#   rate_limit:
+#     enabled: true
+#     max_concurrency: 8
+#     endpoints:
+#       /Bulk:
+#         max_concurrency: 2
+#
+
+import time
+import asyncio
+import threading
+
+from email.utils import parsedate_to_datetime
+
+from libs import common as c
+
+THROTTLE_STATUS = frozenset([429, 503])     # too many requests, service unavailable
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])  # timeouts retried
+
+MAX_CONCURRENCY = 100   # default max requests in flight (the callers limit them too)
+MAX_RETRIES = 3         # default retries of the throttled requests
+MAX_RETRY_AFTER = 60    # default max wait (seconds) honouring Retry-After
+BACKOFF = 1.0           # wait (seconds) after a throttled request without Retry-After
+DECREASE = 0.5          # multiplicative decrease factor
+POLL_INTERVAL = 0.01    # (async) wait (seconds) for a free slot
+
+OK = 'ok'
+THROTTLED = 'throttled'
+ERROR = 'error'
+
+_limiters = {}  # (api, endpoint) -> AdaptiveLimiter
+_limiters_lock = threading.Lock()
+
+def retry_after_seconds(value):
+    """ Returns the seconds to wait from a Retry-After header value: seconds or HTTP date
+
+        Args:
+            value: Retry-After header value (None if missing)
+
+        Returns:
+            seconds (>= 0), None if missing or not valid
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveLimiter:
+    """ AIMD limiter of an API endpoint: window of requests in flight (concurrency) and, if
+        max_qps is set, requests per second. Throttled requests (429/503, timeouts) halve the
+        limits and block the endpoint for the Retry-After time (or BACKOFF), successful ones
+        increase the concurrency by one request per window and the QPS by one per second.
+        Thread safe, usable by the event loop too (see aacquire).
+    """
+
+    def __init__(self, name, max_concurrency=MAX_CONCURRENCY, min_concurrency=1, max_qps=0, min_qps=1,
+                 max_retries=MAX_RETRIES, max_retry_after=MAX_RETRY_AFTER):
+        """ Args:
+                name: limiter name (logs)
+                max_concurrency: (optional, default: MAX_CONCURRENCY) max requests in flight
+                min_concurrency: (optional, default: 1) min requests in flight after the decreases
+                max_qps: (optional, default: 0) max requests per second - 0 = unlimited
+                min_qps: (optional, default: 1) min requests per second after the decreases
+                max_retries: (optional, default: MAX_RETRIES) retries of the throttled requests
+                max_retry_after: (optional, default: MAX_RETRY_AFTER) max wait honouring Retry-After
+        """
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_qps = max_qps
+        self.min_qps = min(min_qps, max_qps) if max_qps > 0 else 0
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+
+        self.concurrency = float(self.max_concurrency)  # current window
+        self.qps = float(max_qps)                       # current rate
+        self.in_flight = 0
+        self.next_slot = 0.0        # (monotonic) time of the next request (QPS)
+        self.blocked_until = 0.0    # (monotonic) end of the throttling wait
+        self.cond = threading.Condition()
+
+    def _try_acquire(self):
+        """ (priv) Takes a request slot if available, to be called holding the lock
+
+            Returns:
+                0 if taken, otherwise the seconds to wait (None: until a request is completed)
+        """
+        now = time.monotonic()
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        if self.in_flight >= int(self.concurrency):
+            return None
+
+        if self.qps > 0:
+            if now < self.next_slot:
+                return self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + 1.0 / self.qps
+
+        self.in_flight += 1
+        return 0
+
+    def acquire(self):
+        """ Waits for a request slot
+        """
+        with self.cond:
+            while True:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return
+                self.cond.wait(wait)
+
+    async def aacquire(self):
+        """ Waits for a request slot without blocking the event loop
+        """
+        while True:
+            with self.cond:
+                wait = self._try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait if wait is not None else POLL_INTERVAL)
+
+    def release(self, outcome=OK, retry_after=None):
+        """ Releases a request slot adapting the limits to the request outcome
+
+            Args:
+                outcome: (optional, default: OK) OK, THROTTLED (429/503, timeouts), ERROR (other errors, limits unchanged)
+                retry_after: (optional, default: None) seconds to wait (Retry-After) if THROTTLED
+        """
+        with self.cond:
+            self.in_flight -= 1
+
+            if outcome == THROTTLED:
+                self.concurrency = max(self.min_concurrency, self.concurrency * DECREASE)
+                if self.max_qps > 0:
+                    self.qps = max(self.min_qps, self.qps * DECREASE)
+
+                wait = min(retry_after if retry_after is not None else BACKOFF, self.max_retry_after)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + wait)
+
+                c.logger.info("Rate limiter [%s] throttled - wait: %.1fs - concurrency: %d - qps: %.1f" % (self.name, wait, int(self.concurrency), self.qps))
+
+            elif outcome == OK:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+                if self.max_qps > 0:
+                    self.qps = min(self.max_qps, self.qps + 1.0 / self.qps)
+
+            self.cond.notify_all()
+
+    def _outcome(self, resp):
+        """ (priv) Returns the outcome and the Retry-After seconds of a response
+        """
+        if resp.status_code in THROTTLE_STATUS:
+            return THROTTLED, retry_after_seconds(resp.headers.get('Retry-After'))
+        return OK, None
+
+    def _retry_timeout(self, e, attempt, method, connect_timeout_errors):
+        """ (priv) Returns True if a timed out request is to be retried: idempotent method 
+            or connect timeout (the request is not sent), up to max_retries
+        """
+        if attempt == self.max_retries:
+            return False
+        if (method or '').upper() in IDEMPOTENT_METHODS or isinstance(e, connect_timeout_errors):
+            return True
+
+        c.logger.debug("Rate limiter [%s] %s timeout - not retried" % (self.name, method))
+        return False
+
+    def call(self, send, timeout_errors=(), method=None, connect_timeout_errors=()):
+        """ Executes a request in a slot, retrying the throttled ones (up to max_retries).
+            The timeouts are throttled requests too (the limits are decreased), but they are retried 
+            only for the idempotent methods or if the request is not sent (connect timeouts)
+
+            Args:
+                send: function() -> HTTP response (status_code, headers)
+                timeout_errors: (optional) timeout exception types
+                method: (optional) HTTP method of the request (timeouts retried if idempotent)
+                connect_timeout_errors: (optional) connect timeout exception types (always retried)
+
+            Returns:
+                the HTTP response (the last one if still throttled)
+
+            Raises:
+                send exceptions (timeouts not retried or after the retries)
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                resp = send()
+            except timeout_errors as e:
+                self.release(THROTTLED)
+                if not self._retry_timeout(e, attempt, method, connect_timeout_errors):
+                    raise
+                continue
+            except Exception:
+                self.release(ERROR)
+                raise
+
+            outcome, retry_after = self._outcome(resp)
+            self.release(outcome, retry_after)
+
+            if outcome == OK or attempt == self.max_retries:
+                return resp
+
+            c.logger.debug("Rate limiter [%s] HTTP status: %d - retry: %d" % (self.name, resp.status_code, attempt + 1))
+
+    async def acall(self, send, timeout_errors=(), method=None, connect_timeout_errors=()):
+        """ Async call (see call)
+
+            Args:
+                send: coroutine function() -> HTTP response (status_code, headers)
+                timeout_errors: (optional) timeout exception types
+                method: (optional) HTTP method of the request (timeouts retried if idempotent)
+                connect_timeout_errors: (optional) connect timeout exception types (always retried)
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire()
+            try:
+                resp = await send()
+            except timeout_errors as e:
+                self.release(THROTTLED)
+                if not self._retry_timeout(e, attempt, method, connect_timeout_errors):
+                    raise
+                continue
+            except Exception:
+                self.release(ERROR)
+                raise
+
+            outcome, retry_after = self._outcome(resp)
+            self.release(outcome, retry_after)
+
+            if outcome == OK or attempt == self.max_retries:
+                return resp
+
+            c.logger.debug("Rate limiter [%s] HTTP status: %d - retry: %d" % (self.name, resp.status_code, attempt + 1))
+
+def _api_config(api):
+    """ (priv) Returns the rate_limit configuration of an API ('scim': scim_api, 'det': det_api)
+    """
+    api_config = c.scim_config if api == 'scim' else c.det_config
+    return (api_config or {}).get('rate_limit', {}) or {}
+
+def _endpoint(rate_limit_config, path):
+    """ (priv) Returns the configured endpoint (longest path prefix) of a request path, '' if none
+    """
+    endpoint = ''
+    for prefix in rate_limit_config.get('endpoints', {}) or {}:
+        if path.startswith(prefix) and len(prefix) > len(endpoint):
+            endpoint = prefix
+    return endpoint
+
+def get_limiter(api, path=''):
+    """ Returns the limiter of an API endpoint, created at the first request from the API
+        rate_limit configuration (disabled by default) merged with the endpoint one
+
+        Args:
+            api: 'scim' (scim_api.rate_limit) or 'det' (det_api.rate_limit)
+            path: (optional) request path relative to the API URL
+
+        Returns:
+            AdaptiveLimiter, None if disabled
+    """
+    rate_limit_config = _api_config(api)
+
+    if not rate_limit_config.get('enabled', False):
+        return None
+
+    endpoint = _endpoint(rate_limit_config, path)
+    key = (api, endpoint)
+
+    limiter = _limiters.get(key)
+    if limiter is not None:
+        return limiter
+
+    with _limiters_lock:
+        if key not in _limiters:
+            config = {k: v for k, v in rate_limit_config.items() if k not in ['enabled', 'endpoints']}
+            if endpoint:
+                config.update(rate_limit_config['endpoints'][endpoint] or {})
+
+            _limiters[key] = AdaptiveLimiter(api + endpoint,
+                                             max_concurrency=config.get('max_concurrency', MAX_CONCURRENCY),
+                                             min_concurrency=config.get('min_concurrency', 1),
+                                             max_qps=config.get('max_qps', 0),
+                                             min_qps=config.get('min_qps', 1),
+                                             max_retries=config.get('max_retries', MAX_RETRIES),
+                                             max_retry_after=config.get('max_retry_after', MAX_RETRY_AFTER))
+        return _limiters[key]
+
+def call(api, path, send, timeout_errors=(), method=None, connect_timeout_errors=()):
+    """ Executes a request through the API endpoint limiter (see AdaptiveLimiter.call),
+        directly if the rate limiting is disabled
+
+        Args:
+            api: 'scim' or 'det'
+            path: request path relative to the API URL
+            send: function() -> HTTP response
+            timeout_errors: (optional) timeout exception types
+            method: (optional) HTTP method of the request (timeouts retried if idempotent)
+            connect_timeout_errors: (optional) connect timeout exception types (always retried)
+
+        Returns:
+            the HTTP response
+    """
+    limiter = get_limiter(api, path)
+    if limiter is None:
+        return send()
+    return limiter.call(send, timeout_errors, method, connect_timeout_errors)
+
+async def acall(api, path, send, timeout_errors=(), method=None, connect_timeout_errors=()):
+    """ Async call (see call)
+    """
+    limiter = get_limiter(api, path)
+    if limiter is None:
+        return await send()
+    return await limiter.acall(send, timeout_errors, method, connect_timeout_errors)
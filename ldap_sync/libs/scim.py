@@ -3,7 +3,9 @@
 #
 # from: https://github.com/adharmad/scim-client-python
 
+import sys
 import json
+import hashlib
    
 class SCIMObject:
     def __init__(self, *initial_data, **kwargs):
@@ -57,17 +59,68 @@ class User(SCIMObject):
             setattr(self, key, kwargs[key])
 
     def __setattr__(self, name, value):
-        if name in User.ENTERPRISE_ATTRS:
-            self.schemas += [User.ENTERPRISE_USER_SCHEMA]
-        elif name in User.IDCS_ATTRS:
-            self.schemas += [User.IDCS_USER_SCHEMA]
-        elif name in User.PASSWORDSTATE_ATTRS:
-            self.schemas += [User.PASSWORDSTATE_USER_SCHEMA]
-        elif name in User.USERSTATE_ATTRS:
-            self.schemas += [User.USERSTATE_USER_SCHEMA]
+        schema = User.ATTR_SCHEMAS.get(name)
+        if schema is not None and schema not in self.schemas:
+            self.schemas = self.schemas + [schema]
 
         self.__dict__[name] = value
 
+# extension schema URN of the extension attributes
+User.ATTR_SCHEMAS = {}
+for _schema, _attrs in [(User.ENTERPRISE_USER_SCHEMA, User.ENTERPRISE_ATTRS),
+                        (User.IDCS_USER_SCHEMA, User.IDCS_ATTRS),
+                        (User.PASSWORDSTATE_USER_SCHEMA, User.PASSWORDSTATE_ATTRS),
+                        (User.USERSTATE_USER_SCHEMA, User.USERSTATE_ATTRS)]:
+    User.ATTR_SCHEMAS.update(dict.fromkeys(_attrs, _schema))
+
+_user_schemas_cache = {}    # frozenset of the user extension attributes -> schemas
+
+def user_schemas(keys):
+    """ Returns the schemas URNs of a SCIM user with the passed attributes: the core schema and
+        the extension schemas of the extension attributes (in the User setattr order), 
+        precomputed by attributes set
+
+        Args:
+            keys: SCIM user attributes
+
+        Returns:
+            list of schemas URNs (shared, not to be changed)
+    """
+    ext_keys = frozenset(k for k in keys if k in User.ATTR_SCHEMAS)
+    schemas = _user_schemas_cache.get(ext_keys)
+
+    if schemas is None:
+        schemas = [User.CORE_USER_SCHEMA]
+        for k in keys:
+            schema = User.ATTR_SCHEMAS.get(k)
+            if schema is not None and schema not in schemas:
+                schemas.append(schema)
+        _user_schemas_cache[ext_keys] = schemas
+
+    return schemas
+
+def user_to_scim(user):
+    """ Returns the SCIM User resource of a user in a single pass (same content of 
+        User(user).to_json(), without the SCIMObject conversion): schemas and the user fields
+
+        Args:
+            user: SCIM user dict or UserRecord
+
+        Returns:
+            SCIM User resource dict (JSON serializable)
+    """
+    items = user.items()
+    resource = {'schemas': None}
+    resource.update(items)
+
+    schemas = user_schemas(resource)
+    if isinstance(resource['schemas'], list):
+        # user provided schemas, completed by the extension ones
+        schemas = resource['schemas'] + [schema for schema in schemas[1:] if schema not in resource['schemas']]
+    resource['schemas'] = schemas
+
+    return resource
+
 class Group(SCIMObject):
     URI = "/Groups"
 
@@ -91,7 +144,248 @@ class Group(SCIMObject):
             setattr(self, key, kwargs[key])
 
     def __setattr__(self, name, value):
-        if name in Group.IDCS_ATTRS:
-            self.schemas += [Group.IDCS_GROUP_SCHEMA]
+        if name in Group.IDCS_ATTRS and Group.IDCS_GROUP_SCHEMA not in self.schemas:
+            self.schemas = self.schemas + [Group.IDCS_GROUP_SCHEMA]
+
+        self.__dict__[name] = value        
+
+_MISSING = object()    # unset field marker
+
+EMAIL_DIGEST_KEYS = frozenset(['value', 'type', 'primary'])   # emails fields compared
+
+def _canonical(v, subkeys=None):
+    """ (priv) Returns the canonical (order and structure independent) value of a SCIM field
+
+        Args:
+            v: SCIM field value
+            subkeys: (optional) nested keys compared (dict values), default: all
+
+        Returns:
+            canonical value (JSON serializable)
+    """
+    if isinstance(v, dict):
+        return sorted([k, _canonical(x)] for k, x in v.items() if subkeys is None or k in subkeys)
+    elif isinstance(v, (list, tuple)):
+        return sorted((_canonical(x, subkeys) for x in v), key=repr)
+    return v
+
+def changed_fields(user, other, fields, subkeys=None):
+    """ Returns the fields with different canonical values in the two SCIM users (see user_digest)
+
+        Args:
+            user: SCIM user dict or UserRecord
+            other: SCIM user dict or UserRecord
+            fields: tuple of the SCIM fields compared
+            subkeys: (optional) {field: set of the compared nested keys}
+
+        Returns:
+            list of the changed fields
+    """
+    subkeys = subkeys or {}
+    changed = []
+    for k in fields:
+        v = _canonical(user.get(k), subkeys.get(k)) if k in user else None
+        other_v = _canonical(other.get(k), subkeys.get(k)) if k in other else None
+        if v != other_v:
+            changed.append(k)
+    return changed
+
+def user_digest(user, fields, subkeys=None):
+    """ Returns the canonical digest of the SCIM user fields: users with the same digest 
+        have the same values (nested structure and list order are not relevant)
+
+        Args:
+            user: SCIM user dict or UserRecord
+            fields: tuple of the SCIM fields compared
+            subkeys: (optional) {field: set of the compared nested keys} (e.g., name: givenName, familyName)
+
+        Returns:
+            hex digest
+    """
+    subkeys = subkeys or {}
+    canonical = [_canonical(user.get(k), subkeys.get(k)) if k in user else None for k in fields]
+    return hashlib.blake2b(json.dumps(canonical, separators=(',', ':'), default=str).encode('utf-8'), 
+                           digest_size=16).hexdigest()
+
+def _read_only(self, *args, **kwargs):
+    """ (priv) Mutator of the read-only nested values of a UserRecord
+    """
+    raise TypeError("UserRecord nested values are read-only - set the whole field, e.g., user['name'] = {...}")
+
+class FrozenDict(dict):
+    """ Read-only dict (nested values of a UserRecord, e.g., name): JSON serializable as a dict, 
+        the mutators raise TypeError. copy() returns a mutable dict.
+    """
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def copy(self):
+        return dict(self)
+
+class FrozenList(list):
+    """ Read-only list (nested values of a UserRecord, e.g., emails, memberOf): JSON serializable 
+        as a list, the mutators raise TypeError. copy() returns a mutable list.
+    """
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def copy(self):
+        return list(self)
+
+class UserRecord:
+    """ Compact SCIM user record (local_users, curr_local_users and related caches)
+
+        The SCIM fields produced by the mapping are stored in slots, the group DNs (memberOf) 
+        are interned, so they are shared between all the users. Other fields are stored in the 
+        extra dict (created only if needed).
+
+        It exposes a dict-compatible interface (user['userName'], user.get('id'), items(), ...).
+        The nested values (name, emails, memberOf) are read-only (FrozenDict, FrozenList), shared 
+        by the record copies and returned without copies: changing them raises TypeError, 
+        a field is changed by setting the whole value (user['name'] = {...}). 
+        JSON conversion: to_dict().
+
+        The canonical digest of the compared fields (see digest()) is cached in the record
+        and reset when a field (but id) changes.
+    """
+    FIELDS = ('id', 'userName', 'externalId', 'active', 'displayName', 'name', 'emails', 'memberOf',
+              'preferredLanguage', 'whenChanged')
+    _FIELD_SET = frozenset(FIELDS)
+
+    __slots__ = FIELDS + ('extra', '_digest')
+
+    def __init__(self, data=None, keys=None):
+        """ Args:
+                data: (optional) SCIM user dict
+                keys: (optional) set of the keys to store (projection), default: all
+        """
+        for field in UserRecord.FIELDS:
+            object.__setattr__(self, field, _MISSING)
+        self.extra = None
+        self._digest = None
+
+        if data is not None:
+            for k, v in data.items():
+                if keys is None or k in keys:
+                    self[k] = v
+
+    @staticmethod
+    def _pack(k, v):
+        """ (priv) Returns the stored value of a slot field: nested values read-only, group DNs interned
+        """
+        if k == 'name':
+            return FrozenDict(v) if isinstance(v, dict) else v
+        elif k == 'emails':
+            if isinstance(v, list):
+                return FrozenList(FrozenDict(e) if isinstance(e, dict) else e for e in v)
+            return v
+        elif k == 'memberOf':
+            if isinstance(v, list):
+                return FrozenList(sys.intern(dn) if isinstance(dn, str) else dn for dn in v)
+            return sys.intern(v) if isinstance(v, str) else v
+        return v
+
+    def __setitem__(self, k, v):
+        if k != 'id':
+            self._digest = None
+
+        if k in UserRecord._FIELD_SET:
+            object.__setattr__(self, k, UserRecord._pack(k, v))
+            return
+
+        if self.extra is None:
+            self.extra = {}
+        self.extra[k] = v
+
+    def __getitem__(self, k):
+        if k in UserRecord._FIELD_SET:
+            v = object.__getattribute__(self, k)
+            if v is not _MISSING:
+                return v
+
+        if self.extra is not None and k in self.extra:
+            return self.extra[k]
+
+        raise KeyError(k)
+
+    def __contains__(self, k):
+        if k in UserRecord._FIELD_SET and object.__getattribute__(self, k) is not _MISSING:
+            return True
+        return self.extra is not None and k in self.extra
+
+    def get(self, k, default=None):
+        try:
+            return self[k]
+        except KeyError:
+            return default
+
+    def pop(self, k, *default):
+        try:
+            v = self[k]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+        if k != 'id':
+            self._digest = None
+
+        if k in UserRecord._FIELD_SET and object.__getattribute__(self, k) is not _MISSING:
+            object.__setattr__(self, k, _MISSING)
+        else:
+            del self.extra[k]
+        return v
+
+    def keys(self):
+        keys = [f for f in UserRecord.FIELDS if object.__getattribute__(self, f) is not _MISSING]
+        if self.extra is not None:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (UserRecord, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def copy(self):
+        """ Returns a shallow copy of the record (the nested values are read-only, so shared)
+        """
+        record = UserRecord.__new__(UserRecord)
+        for field in UserRecord.FIELDS:
+            object.__setattr__(record, field, object.__getattribute__(self, field))
+        record.extra = dict(self.extra) if self.extra is not None else None
+        record._digest = self._digest
+        return record
+
+    def digest(self, fields, subkeys=None):
+        """ Returns the canonical digest of the fields (see user_digest), cached until a field changes
+
+            Args:
+                fields: tuple of the SCIM fields compared
+                subkeys: (optional) {field: set of the compared nested keys}
+
+            Returns:
+                hex digest
+        """
+        if self._digest is None or self._digest[0] != fields:
+            self._digest = (fields, user_digest(self, fields, subkeys))
+        return self._digest[1]
+
+    def to_dict(self):
+        """ Returns the SCIM user dict (JSON serializable)
+        """
+        return dict(self.items())
 
-        self.__dict__[name] = value        
\ No newline at end of file
+    def __repr__(self):
+        return repr(self.to_dict())
@@ -5,8 +5,21 @@
 import requests
 import json
 
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor
+
 from libs import common as c
 from libs import scim 
+from libs import rate_limiter as rl
+from libs import json_codec as jc
+
+PATCH_OP_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:PatchOp"
+PATCH_ATTRS = frozenset(['active', 'emails', 'name'])  # fields supported by the MLDE SCIM PATCH endpoint
+
+BULK_REQUEST_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkRequest"
+SERVICE_PROVIDER_CONFIG_URI = "/ServiceProviderConfig"
+BULK_URI = "/Bulk"
 
 def _get_scim_access_param():
     """ (private) Genereate the SCIM API access parameters starting from configuration
@@ -28,7 +41,7 @@ def _get_scim_access_param():
     if 'url' in c.scim_config:
         url = c.scim_config['url']
     else:
-        c.logger("No SCIM endpoint URL provided")
+        c.logger.error("No SCIM endpoint URL provided")
         return None
 
     if 'auth' in c.scim_config and 'type' in c.scim_config['auth'] \
@@ -71,24 +84,272 @@ def _get_scim_access_param():
         return None
 
 
-def get_scim_users():
-    """ Request the SCIM user list stored on the platform
+class SCIMClient:
+    """ SCIM API client: one HTTP session (keep-alive connections pool) with the prebuilt 
+        access parameters (auth, headers) and timeouts, shared by all the SCIM API calls.
+        Created once by common.init (c.scim_client), see create_scim_client.
+    """
+
+    def __init__(self, access, pool_size=10, timeout=(10, 60), retries=0):
+        """ Args:
+                access: access parameters (see _get_scim_access_param)
+                pool_size: (optional, default: 10) max pooled connections
+                timeout: (optional, default: (10, 60)) connect and read timeouts in seconds
+                retries: (optional, default: 0) connection errors retries
+        """
+        self.access = access
+        self.url = access['url']
+        self.users_url = access['url'] + scim.User.URI
+        self.timeout = timeout
+        self.bulk = None    # Bulk limits (see get_bulk_config), None = not discovered
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.auth = access['credentials']
+        self.session.headers.update(access['headers'])
+
+    def request(self, method, url, **kwargs):
+        """ Executes an HTTP request on the session through the rate limiter (scim_api.rate_limit, 
+            throttled requests retried, see rate_limiter)
+
+            Args:
+                method: HTTP method
+                url: request URL
+                kwargs: requests arguments (data, json, params, ...)
+
+            Returns:
+                requests.Response
+
+            Raises:
+                requests exceptions
+        """
+        return rl.call('scim', url[len(self.url):], 
+                       lambda: self.session.request(method, url, timeout=self.timeout, **kwargs), 
+                       requests.exceptions.Timeout, method, requests.exceptions.ConnectTimeout)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def close(self):
+        """ Closes the pooled connections
+        """
+        self.session.close()
+
+def create_scim_client():
+    """ Creates the SCIM API client from configuration: scim_api.url, scim_api.auth, 
+        and the optional scim_api.pool_size (at least scim_api.max_concurrency), 
+        scim_api.timeout.connect/read, scim_api.retries
+
+        Returns:
+            SCIMClient, None if the access configuration is not valid
+    """
+    access = _get_scim_access_param()
+    if access is None:
+        return None
+
+    timeout_config = c.scim_config.get('timeout', {})
+    timeout = (timeout_config.get('connect', 10), timeout_config.get('read', 60))
+
+    # at least a pooled connection for each concurrent request (see sync_process.send_scim_update)
+    pool_size = max(c.scim_config.get('pool_size', 10), c.scim_config.get('max_concurrency', 1))
+
+    return SCIMClient(access, 
+                      pool_size=pool_size, 
+                      timeout=timeout, 
+                      retries=c.scim_config.get('retries', 0))
+
+def scim_user_keys():
+    """ Returns the SCIM user fields compared with the LDAP users: 
+        the top-level fields of scim_api.attr_mapping (e.g., name.givenName -> name) plus id, userName, active
+
+        Returns:
+            set of SCIM user fields
+    """
+    keys = {'id', 'userName', 'active'}
+    for k in c.scim_config.get('attr_mapping', {}):
+        keys.add(k.split('.', 1)[0])
+    return keys
+
+def users_page_params(start_index, page_size):
+    """ Returns the SCIM user list request parameters of a page (RFC 7644 3.4.2.4 pagination)
+
+        Args:
+            start_index: 1-based index of the first user of the page
+            page_size: users per page (0: no pagination)
+
+        Returns:
+            request parameters dict, None if no pagination
+    """
+    if page_size <= 0:
+        return None
+    return {'startIndex': start_index, 'count': page_size}
+
+def users_page(status_code, text, keys):
+    """ Manages the HTTP response of a SCIM user list page (see get_scim_users)
+
+        Args:
+            status_code: HTTP status
+            text: HTTP response body (the page)
+            keys: SCIM user fields to store (see scim_user_keys)
+
+        Returns:
+            (totalResults, list of scim.UserRecord of the page), None if there is an HTTP error
+    """
+    if status_code not in [200,201,202]:   # http ok, created, accepted
+        c.logger.error("HTTP error - status: %d" % status_code)
+        return None
+
+    page = jc.loads(text)
+    resources = page.get('Resources', [])
+
+    # compact records with only the fields compared with the LDAP users
+    users = [scim.UserRecord(u, keys) for u in resources]
+
+    c.logger.debug("HTTP status: %d - SCIM Users page: %d" % (status_code, len(users)))
+    return page.get('totalResults', len(users)), users
+
+def users_page_next(start_index, page_size, total, users):
+    """ Returns the start index of the next SCIM user list page, None if the page is the last one
+
+        Args:
+            start_index: 1-based index of the first user of the page
+            page_size: users per page (0: no pagination)
+            total: totalResults
+            users: users of the page
+    """
+    if page_size <= 0 or len(users) == 0 or start_index - 1 + len(users) >= total:
+        return None
+    return start_index + len(users)
+
+def users_page_unique(users, seen_ids):
+    """ Returns the users of a SCIM user list page not returned by the previous pages: the pages
+        are requested by offset, if users are created or deleted while paging the offsets shift
+
+        Args:
+            users: users of the page
+            seen_ids: set of the ids of the users of the previous pages (updated)
+
+        Returns:
+            list of the users of the page not already returned
+    """
+    unique = []
+    for user in users:
+        user_id = user.get('id')
+        if user_id not in seen_ids:
+            seen_ids.add(user_id)
+            unique.append(user)
+    return unique
+
+def users_list_complete(totals, count):
+    """ Returns True if the SCIM user list is complete: all the pages returned the same 
+        totalResults and the users (without duplicates) are totalResults
+
+        Args:
+            totals: totalResults of each page
+            count: users returned (without duplicates)
+    """
+    if len(set(totals)) > 1 or count != totals[0]:
+        c.logger.warning("SCIM user list changed while paging - totalResults: %s - users: %d" % (sorted(set(totals)), count))
+        return False
+    return True
+
+def users_list_page_size(attempt, page_size):
+    """ Returns the page size of a SCIM user list attempt: the list is requested again (by pages) up to 
+        scim_api.list_retries times (default: 2) if it changes while paging (see users_list_complete), 
+        then by a single unpaged request
+
+        Args:
+            attempt: 0-based attempt
+            page_size: users per page (0: no pagination)
+
+        Returns:
+            page size of the attempt, None if there are no more attempts
+    """
+    list_retries = c.scim_config.get('list_retries', 2)
+
+    if attempt <= list_retries:
+        return page_size
+    if attempt == list_retries + 1 and page_size > 0:
+        return 0
+    return None
+
+def _get_scim_users_pages(client, page_size, keys):
+    """ (priv) Requests the SCIM user list by pages of page_size users (see get_scim_users)
+
+        Returns:
+            (HTTP status, list of the pages - lists of scim.UserRecord without duplicates -, totalResults of each page)
+            (HTTP status or None, None, None) in case of errors
+    """
+    seen_ids = set()
+    totals = []
+    pages = []
+
+    start_index = 1
+    while start_index is not None:
+
+        # REST API Calls
+        try:
+            resp = client.get(client.users_url, params=users_page_params(start_index, page_size))
+        except requests.exceptions.Timeout:
+            # Maybe set up for a retry, or continue in a retry loop
+            c.logger.error("Error contacting SCIM service - error: Timeout")
+            return None, None, None
+        except requests.exceptions.TooManyRedirects:
+                # Tell the user their URL was bad and try a different one
+            c.logger.error("Error contacting SCIM service - error: Too Many Redirects")
+            return None, None, None
+        except requests.exceptions.RequestException as e:
+            c.logger.error("Error contacting SCIM service - error: %s", e)
+            return None, None, None
+
+        # Manage REST response
+        page = users_page(resp.status_code, resp.content, keys)
+        if page is None:
+            return resp.status_code, None, None
+
+        total, users = page
+        totals.append(total)
+        start_index = users_page_next(start_index, page_size, total, users)
+
+        pages.append(users_page_unique(users, seen_ids))
+
+    return resp.status_code, pages, totals
+
+def get_scim_users(handle_users=None):
+    """ Request the SCIM user list stored on the platform, by pages of scim_api.page_size users
+        (default: 1000, 0: a single request). If the list changes while paging it is requested 
+        again (see users_list_page_size). The users of each page are passed to handle_users when 
+        the list is complete.
+
+        Args:
+            handle_users: (optional, default: None) function(list of scim.UserRecord) called for each page
 
         Returns:
             if resp OK = 20x 
-                {'http_status': 20x, 'scim_user_list': {<the list of SCIM users>}} 
+                {'http_status': 20x, 'scim_user_list': {'totalResults': <count>, 'Resources': <the list of SCIM users>}} 
                 also:
-                    updates the common.curr_scim_users dictionary with the response/Resources user list
+                    updates the common.curr_local_users list with the users of all the pages
 
             if there is an HTTP error resp != 20x
                 {'http_status': <HTTP error>, 'scim_user_list': {}}
                 also:
-                    updates the common.curr_scim_users dictionary = []
+                    updates the common.curr_local_users list = [] (no partial lists)
 
-            any other errors
+            any other errors (also the users count != totalResults at the last attempt, see users_list_complete)
                 {'http_status': None, 'scim_user_list': {}} 
                 also:
-                    updates the common.curr_scim_users dictionary = []
+                    updates the common.curr_local_users list = []
         
         Raises:
             all error exceptions 
@@ -96,61 +357,469 @@ def get_scim_users():
 
     c.logger.debug("Invoke SCIM REST API call to get user list")
 
-    access = _get_scim_access_param()
-    scim_user_obj = scim.User()
-    access['url'] = access['url'] + scim_user_obj.URI 
+    client = c.scim_client
+    page_size = c.scim_config.get('page_size', 1000)
+    keys = scim_user_keys()
 
     c.curr_local_users = [] # reset
 
-    # REST API Calls
+    if client is None or client.access['type'] != 'basic':
+        # TODO: implement oauth method 
+        c.logger.error('Unmanaged SCIM authentication method')
+        return {'http_status': None, 'scim_user_list': {}} 
+
+    attempt = 0
+    attempt_page_size = page_size
+    while attempt_page_size is not None:
+        status_code, pages, totals = _get_scim_users_pages(client, attempt_page_size, keys)
+        if pages is None:
+            return {'http_status': status_code, 'scim_user_list': {}}
+
+        if users_list_complete(totals, sum(len(users) for users in pages)):
+            break
+
+        attempt += 1
+        attempt_page_size = users_list_page_size(attempt, page_size)
+    else:
+        c.logger.error("SCIM user list changed while paging - attempts: %d - list discarded" % attempt)
+        return {'http_status': None, 'scim_user_list': {}} 
+
+    for users in pages:
+        c.curr_local_users.extend(users)
+        if handle_users is not None:
+            handle_users(users)
+
+    c.logger.debug("Returned SCIM Users count: %d" % len(c.curr_local_users))
+    return {'http_status': status_code, 'scim_user_list': {'totalResults': len(c.curr_local_users), 'Resources': c.curr_local_users}}
+
+def lookup_filter(users):
+    """ Returns the SCIM filter matching the users by userName or externalId (renamed users)
+
+        Args:
+            users: list of SCIM users
+
+        Returns:
+            SCIM filter string, e.g.: userName eq "user1" or externalId eq "guid1" or ...
+    """
+    clauses = []
+    for user in users:
+        # JSON string: quoted and escaped as requested by the SCIM filter grammar
+        clauses.append('userName eq %s' % json.dumps(user['userName']))
+        if user.get('externalId'):
+            clauses.append('externalId eq %s' % json.dumps(user['externalId']))
+    return ' or '.join(clauses)
+
+def lookup_batches(users):
+    """ Splits the users to look up in batches of scim_api.lookup.batch_size (default: 50) users
+
+        Args:
+            users: list of SCIM users
+
+        Returns:
+            list of (batch of users, request parameters)
+    """
+    batch_size = max(1, c.scim_config.get('lookup', {}).get('batch_size', 50))
+    batches = []
+    for i in range(0, len(users), batch_size):
+        batch = users[i:i + batch_size]
+        batches.append((batch, {'filter': lookup_filter(batch), 'count': 2 * len(batch)}))
+    return batches
+
+def lookup_results(results, keys, handle_users=None):
+    """ Manages the HTTP responses of the lookup requests (see lookup_scim_users), 
+        updates the common.curr_local_users list
+
+        Args:
+            results: list of (HTTP status, HTTP response body), (None, None) for connection errors
+            keys: SCIM user fields to store (see scim_user_keys)
+            handle_users: (optional, default: None) function(list of scim.UserRecord) called for each batch
+
+        Returns:
+            see lookup_scim_users
+    """
+    c.curr_local_users = [] # reset
+    found_ids = set()
+
+    for status_code, text in results:
+        page = users_page(status_code, text, keys) if status_code is not None else None
+        if page is None:
+            c.curr_local_users = [] # reset (no partial lists)
+            return {'http_status': status_code, 'scim_user_list': {}}
+
+        # a user can match more batches (userName and externalId)
+        users = [u for u in page[1] if u.get('id') not in found_ids]
+        found_ids.update(u.get('id') for u in users)
+
+        c.curr_local_users.extend(users)
+        if handle_users is not None:
+            handle_users(users)
+
+    c.logger.debug("Lookup SCIM Users count: %d" % len(c.curr_local_users))
+    return {'http_status': 200, 'scim_user_list': {'totalResults': len(c.curr_local_users), 'Resources': c.curr_local_users}}
+
+def lookup_scim_users(users, handle_users=None):
+    """ Requests the users on the platform matching the passed users (by userName or externalId) with
+        SCIM filter queries, batched with 'or' clauses (scim_api.lookup.batch_size) and executed 
+        concurrently (scim_api.max_concurrency). Used instead of get_scim_users when few users changed.
+
+        Args:
+            users: list of SCIM users to look up
+            handle_users: (optional, default: None) function(list of scim.UserRecord) called for each batch
+
+        Returns:
+            if resp OK = 20x 
+                {'http_status': 200, 'scim_user_list': {'totalResults': <count>, 'Resources': <the list of matching SCIM users>}} 
+                also:
+                    updates the common.curr_local_users list with the matching users
+
+            any errors
+                {'http_status': <HTTP error or None>, 'scim_user_list': {}} 
+                also:
+                    updates the common.curr_local_users list = []
+    """
+    c.logger.debug("Invoke SCIM REST API call to look up %d users" % len(users))
+
+    client = c.scim_client
+    keys = scim_user_keys()
 
-    if access['type'] == 'basic':
+    if client is None or client.access['type'] != 'basic':
+        c.curr_local_users = [] # reset
+        c.logger.error('Unmanaged SCIM authentication method')
+        return {'http_status': None, 'scim_user_list': {}} 
 
+    def _lookup(batch):
         try:
-            resp = requests.get(access['url'] , 
-                                auth=access['credentials'], 
-                                headers=access['headers'])
-        except requests.exceptions.Timeout:
-            # Maybe set up for a retry, or continue in a retry loop
-            c.logger.error("Error contacting SCIM service - error: Timeout")
-            return {'http_status': None, 'scim_users': {}} 
-        except requests.exceptions.TooManyRedirects:
-                # Tell the user their URL was bad and try a different one
-            c.logger.error("Error contacting SCIM service - error: Too Many Redirects")
-            return {'http_status': None, 'scim_users': {}} 
+            resp = client.get(client.users_url, params=batch[1])
+            return resp.status_code, resp.content
         except requests.exceptions.RequestException as e:
             c.logger.error("Error contacting SCIM service - error: %s", e)
-            return {'http_status': None, 'scim_users': {}} 
+            return None, None
 
-    else:
-        # TODO: implement oauth method 
-        c.logger.error('Unmanaged SCIM authentication method')
-        return {'http_status': None, 'scim_users': {}} 
+    batches = lookup_batches(users)
+    with ThreadPoolExecutor(max_workers=max(1, c.scim_config.get('max_concurrency', 1)), thread_name_prefix='scim_lookup') as executor:
+        results = list(executor.map(_lookup, batches))
 
-    # Manage REST response
+    return lookup_results(results, keys, handle_users)
 
-    if resp.status_code in [200,201,202]:   # http ok, created, accepted
-        curr_scim_user_list = json.loads(resp.text)
+def bulk_config(status_code, text):
+    """ Returns the Bulk limits from the /ServiceProviderConfig response and the optional 
+        scim_api.bulk.max_operations (lower limit than the server one)
 
-        if 'Resources' in curr_scim_user_list:
-            c.curr_local_users = curr_scim_user_list['Resources']
+        Args:
+            status_code: HTTP status (None for connection errors)
+            text: HTTP response body
+
+        Returns:
+            {'max_operations': <n>, 'max_payload_size': <bytes>}, {} if Bulk is not supported
+    """
+    if status_code != 200:
+        c.logger.info("SCIM ServiceProviderConfig not available (HTTP status: %s) - Bulk not used" % status_code)
+        return {}
+
+    try:
+        bulk = jc.loads(text).get('bulk', {})
+    except ValueError as e:
+        c.logger.error("SCIM ServiceProviderConfig - error: %s - Bulk not used" % e)
+        return {}
+
+    max_operations = bulk.get('maxOperations', 0)
+    if not bulk.get('supported', False) or max_operations <= 0:
+        c.logger.info("SCIM Bulk not supported by the service provider")
+        return {}
+
+    config_max_operations = c.scim_config.get('bulk', {}).get('max_operations', 0)
+    if config_max_operations > 0:
+        max_operations = min(max_operations, config_max_operations)
+
+    config = {'max_operations': max_operations, 'max_payload_size': bulk.get('maxPayloadSize', 0)}
+    c.logger.info("SCIM Bulk supported - max operations: %d - max payload size: %d" % (config['max_operations'], config['max_payload_size']))
+    return config
+
+def is_bulk_enabled():
+    """ Checks if the SCIM Bulk endpoint usage is enabled in configuration (scim_api.bulk.enabled, default: False)
+
+        Returns:
+            True if enabled, False otherwise
+    """
+    return c.scim_config.get('bulk', {}).get('enabled', False)
+
+def get_bulk_config():
+    """ Returns the Bulk limits advertised by the service provider (/ServiceProviderConfig), 
+        requested once per SCIM client
+
+        Returns:
+            {'max_operations': <n>, 'max_payload_size': <bytes>}, None if Bulk is not supported or disabled
+    """
+    client = c.scim_client
+
+    if client is None or not is_bulk_enabled():
+        return None
+
+    if client.bulk is None:
+        try:
+            resp = client.get(client.url + SERVICE_PROVIDER_CONFIG_URI)
+            client.bulk = bulk_config(resp.status_code, resp.content)
+        except requests.exceptions.RequestException as e:
+            c.logger.error("Error contacting SCIM service - error: %s", e)
+            return None     # discovered by the next cycle
+
+    return client.bulk or None
+
+def bulk_chunks(items, url, users_url, config):
+    """ Builds the Bulk requests of the user operations: each operation is serialized once and 
+        the operations are chunked by the max operations and the max payload size of the server. 
+        An operation larger than the max payload size is sent alone (the request fails and the 
+        operation falls back to a single request).
+
+        Args:
+            items: list of (user, op, changed_attrs), op: 'add', 'update', 'delete'
+            url: SCIM base URL (Bulk operations paths are relative to it)
+            users_url: SCIM Users endpoint URL
+            config: Bulk limits (see get_bulk_config)
+
+        Returns:
+            list of (chunk items, request body (JSON bytes))
+    """
+    head = b'{"schemas":' + jc.dumps([BULK_REQUEST_SCHEMA]) + b',"Operations":['
+    tail = b']}'
+    max_operations = config['max_operations']
+    max_payload_size = config['max_payload_size'] or float('inf')
+
+    chunks = []
+    chunk_items, chunk_ops, chunk_size = [], [], len(head) + len(tail)
+
+    for n, (user, op, changed_attrs) in enumerate(items):
+        _, method, op_url, body = user_request(user, op, users_url, changed_attrs)
+
+        operation = {'method': method, 'bulkId': str(n), 'path': op_url[len(url):]}
+        if body is not None:
+            operation['data'] = body
+
+        op_json = jc.dumps(operation)
+        op_size = len(op_json) + 1     # + separator
+
+        if chunk_items and (len(chunk_items) >= max_operations or chunk_size + op_size > max_payload_size):
+            chunks.append((chunk_items, head + b','.join(chunk_ops) + tail))
+            chunk_items, chunk_ops, chunk_size = [], [], len(head) + len(tail)
+
+        chunk_items.append((user, op, changed_attrs, operation['bulkId']))
+        chunk_ops.append(op_json)
+        chunk_size += op_size
+
+    if chunk_items:
+        chunks.append((chunk_items, head + b','.join(chunk_ops) + tail))
+
+    return chunks
+
+def _bulk_status(status):
+    """ (priv) Returns the HTTP status of a Bulk operation response: "201" (SCIM 2.0) or {"code": 201} (SCIM 1.1)
+    """
+    if isinstance(status, dict):
+        status = status.get('code')
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+def bulk_unknown_results(chunk_items, status_code):
+    """ Returns the results of the Bulk operations with an unknown outcome (5xx, read timeout, 
+        invalid response): the operations may have been executed, so they are not sent again by 
+        single requests (e.g., duplicated created users), they are left to the next cycle
+
+        Args:
+            chunk_items: list of (user, op, changed_attrs, bulkId) (see bulk_chunks)
+            status_code: HTTP status of the Bulk request (None if there is no response)
+
+        Returns:
+            list of the user operations results {'http_status': <status_code>, 'scim_user': {}}
+    """
+    c.logger.error("SCIM Bulk request unknown result - status: %s - operations: %d left to the next cycle" % (status_code, len(chunk_items)))
+    return [{'http_status': status_code, 'scim_user': {}} for _ in chunk_items]
+
+def bulk_results(chunk_items, status_code, text):
+    """ Maps the Bulk response operations back to the chunk user operations (by bulkId)
+
+        Args:
+            chunk_items: list of (user, op, changed_attrs, bulkId) (see bulk_chunks)
+            status_code: HTTP status of the Bulk request (None if the request is not sent: connection errors)
+            text: HTTP response body
+
+        Returns:
+            list of the user operations results {'http_status': <HTTP status>, 'scim_user': {...}} 
+            (see user_response) in the chunk items order, None for the operations not executed, 
+            to be sent by single requests (the Bulk request is not sent or it is rejected: 4xx, 
+            or the operation is missing in the response). 
+            Unknown outcome (5xx, invalid response): see bulk_unknown_results
+    """
+    if status_code is None or 400 <= status_code < 500:
+        c.logger.error("SCIM Bulk request error - status: %s - operations: %d" % (status_code, len(chunk_items)))
+        return [None] * len(chunk_items)
+
+    if status_code != 200:
+        return bulk_unknown_results(chunk_items, status_code)
+
+    try:
+        operations = jc.loads(text).get('Operations', [])
+    except ValueError as e:
+        c.logger.error("SCIM Bulk response - error: %s" % e)
+        return bulk_unknown_results(chunk_items, status_code)
+
+    results_bybulk_id = {}
+    for operation in operations:
+        op_status = _bulk_status(operation.get('status'))
+        response = operation.get('response')
+        scim_user = response if isinstance(response, dict) and op_status in [200,201,202] else {}
+
+        if op_status in [200,201,202]:
+            # the location of the created/changed user (the response body is optional)
+            if 'id' not in scim_user and operation.get('location'):
+                scim_user = dict(scim_user, id=operation['location'].rstrip('/').rsplit('/', 1)[-1])
+        else:
+            c.logger.error("SCIM Bulk operation [%s %s] HTTP error - status: %s - %s" % (operation.get('method'), operation.get('bulkId'), op_status, response))
+
+        results_bybulk_id[operation.get('bulkId')] = {'http_status': op_status, 'scim_user': scim_user}
+
+    return [results_bybulk_id.get(bulk_id) for _, _, _, bulk_id in chunk_items]
+
+def exec_scim_bulk_req(chunk):
+    """ Executes a Bulk request on the SCIM API (see bulk_chunks)
+
+        Args:
+            chunk: (chunk items, request body)
+
+        Returns:
+            list of the user operations results (see bulk_results)
+    """
+    chunk_items, body = chunk
+    c.logger.debug("Invoke SCIM REST API Bulk call - operations: %d - payload: %d bytes" % (len(chunk_items), len(body)))
+
+    client = c.scim_client
+
+    try:
+        resp = client.post(client.url + BULK_URI, data=body)
+    except requests.exceptions.RequestException as e:
+        c.logger.error("Error contacting SCIM service - error: %s", e)
+        if not is_request_not_sent(e):
+            return bulk_unknown_results(chunk_items, None)
+        return bulk_results(chunk_items, None, None)
+
+    return bulk_results(chunk_items, resp.status_code, resp.content)
+
+def is_request_not_sent(e):
+    """ Returns True if a requests exception is raised before the request is sent (connection 
+        refused, DNS errors, connect timeout), so it can be sent again without duplicates
+
+        Args:
+            e: requests exception
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+
+    # connection errors: the new connection failed (MaxRetryError reason), not an aborted request
+    if isinstance(e, requests.exceptions.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], 'reason', None), NewConnectionError)
+
+    return False
+
+def user_request(user, op, users_url, changed_attrs=None):
+    """ Returns the HTTP request of a get/add/update/delete SCIM API call for the user
+        with the request body as object (see build_user_request)
+
+        Args:
+            user: (dict or scim.UserRecord) with the SCIM user attrs
+            op: 'get', 'add', 'update', 'delete' (unknown ops are 'get')
+            users_url: SCIM Users endpoint URL
+            changed_attrs: (optional list, op 'update' only) changed fields of the user
+
+        Returns:
+            (op, HTTP method, URL, request body object or None)
+    """
+    if op == 'add':
+        user.pop('id', None)
+        scim_user = scim.user_to_scim(user) # convert
+        c.logger.debug("ADD - SCIM User object: %s", scim_user)
+        return op, 'POST', users_url, scim_user
+
+    elif op == 'update' and changed_attrs and PATCH_ATTRS.issuperset(changed_attrs):
+        # field-level update with PATCH user(user_id).<changed attrs> 
+        id = str(user['id']) 
+
+        patch_req = {
+            "schemas": [PATCH_OP_SCHEMA],
+            "Operations": [{"op": "replace", "value": {k: user[k] for k in changed_attrs}}],
+        }
+        c.logger.debug("UPDATE - PATCH user(user_id) - SCIM User id: %s - %s", id, patch_req)
+        return op, 'PATCH', users_url + '/' + id, patch_req
+
+    elif op == 'update':
+        id = str(user['id']) 
+        scim_user = scim.user_to_scim(user) # convert
+        c.logger.debug("UPDATE - SCIM User object: %s", scim_user)
+        return op, 'PUT', users_url + '/' + id, scim_user
+
+    elif op == 'delete':
+        # DELETE of a SCIM user by REST interface is not implemented
+        # id = str(user['id']) 
+        # c.logger.debug("DELETE - SCIM User id: %s" % id)
+        # return op, 'DELETE', users_url + '/' + id, None
+
+        # soft DELETE with PATCH user(user_id).active = false 
+        id = str(user['id']) 
+        c.logger.debug("Soft DELETE - PATCH user(user_id).active=false - SCIM User id: %s" % id)
+
+        patch_req = {
+            "schemas": [PATCH_OP_SCHEMA],
+            "Operations": [{"op": "replace", "value": {"active": False}}],
+        }
+        return op, 'PATCH', users_url + '/' + id, patch_req
 
-        c.logger.debug("HTTP status: %d" % resp.status_code)
-        c.logger.debug("Returned SCIM Users count: %d" % len(c.curr_local_users))
-        return {'http_status': resp.status_code, 'scim_user_list': curr_scim_user_list}
-        
     else:
-        c.curr_local_users = [] # reset
-        c.logger.error("HTTP error - status: %d" % resp.status_code)
-        return {'http_status': resp.status_code, 'scim_user_list': {}}
+        id = str(user['id']) 
+        c.logger.debug("GET - SCIM User id: %s" % id)
+        return 'get', 'GET', users_url + '/' + id, None
 
+def build_user_request(user, op, users_url, changed_attrs=None):
+    """ Builds the HTTP request of a get/add/update/delete SCIM API call for the user
+        (see exec_scim_user_api_req), the body is encoded by json_codec
 
+        Args:
+            user: (dict or scim.UserRecord) with the SCIM user attrs
+            op: 'get', 'add', 'update', 'delete' (unknown ops are 'get')
+            users_url: SCIM Users endpoint URL
+            changed_attrs: (optional list, op 'update' only) changed fields of the user
 
-def exec_scim_user_api_req(user, op='get'):
+        Returns:
+            (op, HTTP method, URL, request kwargs: data (JSON bytes) if there is a body)
+    """
+    op, method, url, body = user_request(user, op, users_url, changed_attrs)
+    return op, method, url, ({'data': jc.dumps(body)} if body is not None else {})
+
+def user_response(op, status_code, text):
+    """ Manages the HTTP response of a get/add/update/delete SCIM API call (see exec_scim_user_api_req)
+
+        Args:
+            op: 'get', 'add', 'update', 'delete'
+            status_code: HTTP status
+            text: HTTP response body
+
+        Returns:
+            {'http_status': <HTTP status>, 'scim_user': {<the SCIM user dict if returned>}}
+    """
+    if op in ['get', 'add', 'update', 'delete'] and status_code in [200,201,202]:   # http ok, created, accepted
+        scim_user = jc.loads(text)
+        c.logger.debug("HTTP status: %d" % status_code)
+        c.logger.debug("Returned SCIM User: %s" % scim_user)
+        return {'http_status': status_code, 'scim_user': scim_user} 
+
+    else:
+        c.logger.error("HTTP error - status: %d" % status_code)
+        return {'http_status': status_code, 'scim_user': {}}
+
+def exec_scim_user_api_req(user, op='get', changed_attrs=None):
     """ Calls the get/add/update/delete SCIM APIs for the user
 
         Args:
-            user:   (dict) with the SCIM user attrs. 
+            user:   (dict or scim.UserRecord) with the SCIM user attrs. 
                     It will be converted to a SCIM User obj.
 
             add:    (optional bool) 
@@ -160,6 +829,10 @@ def exec_scim_user_api_req(user, op='get'):
                         if 'delete' deletes the passed user - id != null 
                         Note: current SCIM REST API does not impement DELETE,
                               so DELETE call was replaced by as soft delete with a call: PATCH user(user_id).active=false
+
+            changed_attrs: (optional list, op 'update' only) changed fields of the user, 
+                    if all supported by the PATCH endpoint (active, emails, name) only they are 
+                    sent by PATCH replace operations, otherwise the whole user is sent by PUT
                         
         Returns: 
             if op is add, update, delete 
@@ -181,62 +854,14 @@ def exec_scim_user_api_req(user, op='get'):
     """
     c.logger.debug("Invoke SCIM REST API call to [%s] user: %s" % (op, user))
     
-    access = _get_scim_access_param()
-    scim_user_obj = scim.User()
-    access['url'] = access['url'] + scim_user_obj.URI 
+    client = c.scim_client
 
-    if access['type'] == 'basic':
+    if client is not None and client.access['type'] == 'basic':
         
         # REST API calls
         try:
-            if op == 'add':
-                user.pop('id', None)
-                user_json = json.dumps(user, sort_keys=False)
-                scim_user_obj = scim_user_obj.from_json(user_json) # convert
-                scim_user_json = scim_user_obj.to_json()
-                c.logger.debug("ADD - SCIM User object: %s" % scim_user_json)
-                resp = requests.post(access['url'] , 
-                                    auth=access['credentials'], 
-                                    headers=access['headers'],
-                                    data=scim_user_json)
-            elif op == 'update':
-                id = str(user['id']) 
-                user_json = json.dumps(user, sort_keys=False)
-                scim_user_obj = scim_user_obj.from_json(user_json) # convert
-                scim_user_json = scim_user_obj.to_json()
-                c.logger.debug("UPDATE - SCIM User object: %s" % scim_user_json)
-                resp = requests.put(access['url'] + '/' + id , 
-                                    auth=access['credentials'], 
-                                    headers=access['headers'],
-                                    data=scim_user_json)
-            elif op == 'delete':
-                # DELETE of a SCIM user by REST interface is not implemented
-                # id = str(user['id']) 
-                # c.logger.debug("DELETE - SCIM User id: %s" % id)
-                # resp = requests.delete(access['url'] + '/' + id , 
-                #                     auth=access['credentials'], 
-                #                     headers=access['headers'])
-
-                # soft DELETE with PATCH user(user_id).active = false 
-                id = str(user['id']) 
-                c.logger.debug("Soft DELETE - PATCH user(user_id).active=false - SCIM User id: %s" % id)
-
-                patch_req = {
-                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
-                    "Operations": [{"op": "replace", "value": {"active": False}}],
-                }
-
-                resp = requests.patch(access['url'] + '/' + id , 
-                                    auth=access['credentials'], 
-                                    headers=access['headers'],
-                                    json=patch_req)
-            else:
-                op='get'
-                id = str(user['id']) 
-                c.logger.debug("GET - SCIM User id: %s" % id)
-                resp = requests.get(access['url'] + '/' + id , 
-                                    auth=access['credentials'], 
-                                    headers=access['headers'])
+            op, method, url, kwargs = build_user_request(user, op, client.users_url, changed_attrs)
+            resp = client.request(method, url, **kwargs)
     
         except requests.exceptions.Timeout:
             # Maybe set up for a retry, or continue in a retry loop
@@ -257,21 +882,7 @@ def exec_scim_user_api_req(user, op='get'):
         
     # Manage REST response 
 
-    if op == 'get' and resp.status_code in [200,201,202]:   # http ok, created, accepted
-        scim_user = json.loads(resp.text)
-        c.logger.debug("HTTP status: %d" % resp.status_code)
-        c.logger.debug("Returned SCIM User: %s" % scim_user)
-        return {'http_status': resp.status_code, 'scim_user': scim_user} 
-
-    elif op in ['add', 'update', 'delete'] and resp.status_code in [200,201,202]:   # http ok, created, accepted
-        scim_user = json.loads(resp.text)
-        c.logger.debug("HTTP status: %d" % resp.status_code)
-        c.logger.debug("Returned SCIM User: %s" % scim_user)
-        return {'http_status': resp.status_code, 'scim_user': scim_user} 
-
-    else:
-        c.logger.error("HTTP error - status: %d" % resp.status_code)
-        return {'http_status': resp.status_code, 'scim_user': {}} 
+    return user_response(op, resp.status_code, resp.content) 
 
 
 
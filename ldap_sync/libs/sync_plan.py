@@ -0,0 +1,147 @@
+#
+# Sync plan module
+# Serializable sync plan (NDJSON): the SCIM users operations (local_users_ops) and the
+# MLDE groups assignments computed by a 'plan' run, executed later by an 'apply' run
+#
+# Plan file lines:
+#   {"type": "header", "version": 1, "created": <ISO date>, "users": {<op>: <count>}, "groups": <count>}
+#   {"type": "user", "op": "delete|update|add", "user": {<SCIM user>}, "changed_attrs": [...]}
+#   {"type": "group", "group_id": <id>, "add": [<userNames>], "rm": [<userNames>]}
+#
+# The groups assignments are stored by userName: the users created by the plan have no 
+# platform id at plan time, the ids are resolved by the apply run (after the users operations)
+#
+
+import os
+
+from datetime import datetime
+
+from libs import common as c
+from libs import json_codec as jc
+
+PLAN_FILE = "ldap_sync_plan.ndjson"    # default path relative to the main file
+PLAN_VERSION = 2
+
+USER_OPS = ['delete', 'update', 'add']  # apply order
+
+def plan_filename(plan_file_path=None):
+    """ Returns the plan file full pathname
+
+        Args:
+            plan_file_path: (optional str) full or relative (to the main file) pathname of the plan file,
+            if not provided plan file path: current dir + '/' + PLAN_FILE
+
+        Returns:
+            plan file full pathname
+    """
+    if plan_file_path is not None and isinstance(plan_file_path, str) and len(plan_file_path) > 0:
+        if os.path.isabs(plan_file_path):
+            return plan_file_path
+        return os.path.join(c.curr_dir, plan_file_path)
+    return os.path.join(c.curr_dir, PLAN_FILE)
+
+def _user_dict(user):
+    """ (priv) Returns the JSON serializable dict of a SCIM user (dict or scim.UserRecord)
+    """
+    return user.to_dict() if hasattr(user, 'to_dict') else user
+
+def write(filename, users_ops, changed_attrs, group_add_user_names, group_rm_user_names):
+    """ Writes the sync plan file (atomic replace)
+
+        Args:
+            filename: plan file full pathname
+            users_ops: SCIM users operations {'add': [users], 'update': [users], 'delete': [users]}
+            changed_attrs: {SCIM id: changed fields} of the users to update
+            group_add_user_names: {group id: [userNames]} users to add to the MLDE groups
+            group_rm_user_names: {group id: [userNames]} users to remove from the MLDE groups
+
+        Returns:
+            True if written, False in case of errors
+    """
+    group_ids = list(group_add_user_names)
+    group_ids += [group_id for group_id in group_rm_user_names if group_id not in group_add_user_names]
+
+    try:
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as fd:
+            header = {
+                "type": "header",
+                "version": PLAN_VERSION,
+                "created": datetime.now().isoformat(),
+                "users": {op: len(users_ops.get(op, [])) for op in USER_OPS},
+                "groups": len(group_ids)
+            }
+            fd.write(jc.dumps(header) + b'\n')
+
+            for op in USER_OPS:
+                for user in users_ops.get(op, []):
+                    line = {"type": "user", "op": op, "user": _user_dict(user)}
+                    if op == 'update' and user.get('id') in changed_attrs:
+                        line['changed_attrs'] = changed_attrs[user['id']]
+                    fd.write(jc.dumps(line) + b'\n')
+
+            for group_id in group_ids:
+                line = {
+                    "type": "group",
+                    "group_id": group_id,
+                    "add": group_add_user_names.get(group_id, []),
+                    "rm": group_rm_user_names.get(group_id, [])
+                }
+                fd.write(jc.dumps(line) + b'\n')
+
+        os.replace(tmp_filename, filename)
+        c.logger.info("Sync plan [%s] written - users: %s - groups: %d" % (filename, header['users'], header['groups']))
+        return True
+
+    except Exception as e:
+        c.logger.error("Error writing sync plan [%s] - error: %s" % (filename, e))
+        return False
+
+def read(filename):
+    """ Reads the sync plan file
+
+        Args:
+            filename: plan file full pathname
+
+        Returns:
+            (users_ops, changed_attrs, group_add_user_names, group_rm_user_names) (see write)
+            None in case of errors
+    """
+    users_ops = {op: [] for op in ['add', 'update', 'delete']}
+    changed_attrs = {}
+    group_add_user_names = {}
+    group_rm_user_names = {}
+
+    try:
+        with open(filename, 'rb') as fd:
+            for n, line in enumerate(fd):
+                if not line.strip():
+                    continue
+
+                item = jc.loads(line)
+
+                if item['type'] == 'header':
+                    if item.get('version') != PLAN_VERSION:
+                        c.logger.error("Sync plan [%s] - unsupported version: %s" % (filename, item.get('version')))
+                        return None
+                    c.logger.info("Sync plan [%s] created: %s - users: %s - groups: %d" % (filename, item['created'], item['users'], item['groups']))
+
+                elif item['type'] == 'user':
+                    users_ops[item['op']].append(item['user'])
+                    if 'changed_attrs' in item:
+                        changed_attrs[item['user']['id']] = item['changed_attrs']
+
+                elif item['type'] == 'group':
+                    if item['add']:
+                        group_add_user_names[item['group_id']] = item['add']
+                    if item['rm']:
+                        group_rm_user_names[item['group_id']] = item['rm']
+
+                else:
+                    c.logger.error("Sync plan [%s] line %d - unknown item type: %s" % (filename, n + 1, item['type']))
+
+    except Exception as e:
+        c.logger.error("Error reading sync plan [%s] - error: %s" % (filename, e))
+        return None
+
+    return users_ops, changed_attrs, group_add_user_names, group_rm_user_names
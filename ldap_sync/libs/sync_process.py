@@ -3,68 +3,238 @@
 #
 
 import re
+import time
+import queue
+import asyncio
+import inspect
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from libs import common as c
+from libs import scim
 from libs import scim_helper as sh
 from libs import det_api_helper as det
+from libs import ldap_helper as lh
 from libs import ldap_plugin_common as lpc
+from libs import mapping_cache as mc
+from libs import sync_plan as plan
+
+_ldap_changes = queue.Queue()   # DNs of the changed LDAP entries (LDAP change notifications)
+_lookup_fallback_logged = False # targeted lookups failure logged (see main_loop)
+
+class CurrUsersIndex:
+    """ Diff index of the users on the platform (by userName and externalId, O(1) matching), 
+        filled page by page with the received users (see get_scim_users, lookup_scim_users) 
+        and used by compare_scim_users
+    """
+
+    def __init__(self, users=None):
+        """ Args:
+                users: (optional) list of SCIM users to index
+        """
+        self.byname = {}
+        self.byextid = {}
 
-def get_scim_users():
-    """ Get existing SCIM users on the platform 
+        if users is not None:
+            self.add(users)
+
+    def add(self, users):
+        """ Adds users on the platform to the index
+
+            Args:
+                users: list of SCIM users (a page of the SCIM user list)
+        """
+        for user in users:
+            self.byname[user.get('userName')] = user
+            if user.get('externalId'):
+                self.byextid[user['externalId']] = user
+
+def get_scim_users(curr_users_index=None):
+    """ Get existing SCIM users on the platform, indexed page by page when the list is complete
+
+        Args:
+            curr_users_index: (optional) CurrUsersIndex filled with the received users
     """
     c.curr_local_users = {}  # reset
 
     _st = c.start_time()
 
-    resp = sh.get_scim_users()
+    resp = sh.get_scim_users(handle_users=curr_users_index.add if curr_users_index is not None else None)
+    if resp['http_status'] in [200,201,202]:
+        c.curr_users_total = len(c.curr_local_users)
+
+    c.logger.debug("Execution time %s" % c.stop_time(_st, to_str=True))
+
+    return resp
+
+def is_scim_lookup_cycle():
+    """ Returns True if the users on the platform are to be looked up by SCIM filter queries (targeted 
+        lookups) instead of the full SCIM user list: delta cycle (incremental sync or LDAP change 
+        notifications) with changed users <= scim_api.lookup.max_ratio (default: 0.05) of the users 
+        on the platform (at the last full list). scim_api.lookup.enabled (default: false).
+
+        In a targeted lookup cycle only the changed users are compared (no deletes, the users deleted 
+        on LDAP are deactivated by the next full reconcile).
+
+        Returns:
+            True if targeted lookups are to be used
+    """
+    lookup_config = c.scim_config.get('lookup', {})
+
+    if not lookup_config.get('enabled', False) or not c.ldap_delta_cycle or c.curr_users_total is None:
+        return False
+
+    return len(c.local_users_delta) <= lookup_config.get('max_ratio', 0.05) * c.curr_users_total
+
+def _log_lookup_fallback(http_status):
+    """ (priv) Logs the fallback to the full SCIM user list when the targeted lookups fail, 
+        once per process (the next ones at debug level)
+
+        Args:
+            http_status: HTTP status of the failed lookups (None: not contacted)
+    """
+    global _lookup_fallback_logged
+
+    msg = "SCIM targeted lookups failed - HTTP status: %s - full SCIM user list used" % http_status
+    if _lookup_fallback_logged:
+        c.logger.debug(msg)
+    else:
+        c.logger.error(msg + " (logged once)")
+        _lookup_fallback_logged = True
+
+def lookup_scim_users(curr_users_index=None):
+    """ Looks up the changed users (c.local_users_delta) on the platform, indexed as they are received
+
+        Args:
+            curr_users_index: (optional) CurrUsersIndex filled with the received users
+    """
+    c.curr_local_users = []  # reset
+
+    _st = c.start_time()
+
+    resp = sh.lookup_scim_users(c.local_users_delta, handle_users=curr_users_index.add if curr_users_index is not None else None)
 
     c.logger.debug("Execution time %s" % c.stop_time(_st, to_str=True))
 
     return resp
 
-def compare_scim_users():
+def get_scim_digest_fields():
+    """ Returns the SCIM fields compared between the LDAP users and the users on the platform:
+        the top-level attr_mapping fields (but the platform assigned id), and the compared nested 
+        keys (name: the mapped ones, emails: value, type, primary). Each user is compared on the 
+        fields returned by the platform for that user (see _user_digest_fields)
+
+        Returns:
+            (tuple of the fields, {field: set of the compared nested keys})
+    """
+    mapping_fields = []
+    subkeys = {}
+
+    for k in c.scim_config['attr_mapping']:
+        field = k.split('.', 1)[0]
+        if field not in mapping_fields:
+            mapping_fields.append(field)
+        if field == 'name' and '.' in k:
+            subkeys.setdefault('name', set()).add(k.split('.', 1)[1])
+
+    subkeys['emails'] = scim.EMAIL_DIGEST_KEYS
+
+    fields = tuple(sorted(f for f in mapping_fields if f != 'id'))
+    return fields, subkeys
+
+def _user_digest_fields(fields, user, curr_user, fields_cache):
+    """ (priv) Returns the compared fields of an LDAP user and its matching user on the platform:
+        the fields present in both (new LDAP fields non present in the SCIM API returned user's 
+        fields are not considered for comparison)
+
+        Args:
+            fields: tuple of the compared fields (see get_scim_digest_fields)
+            user: LDAP user
+            curr_user: matching user on the platform
+            fields_cache: {field presence key: tuple of the fields} (one tuple per field set, 
+                          so the digests cached in the records are reused)
+
+        Returns:
+            tuple of the fields
+    """
+    key = tuple(f in user and f in curr_user for f in fields)
+    user_fields = fields_cache.get(key)
+    if user_fields is None:
+        user_fields = fields_cache[key] = tuple(f for f, present in zip(fields, key) if present)
+    return user_fields
+
+def compare_scim_users(users=None, with_deletes=True, curr_users_index=None):
     """ Compare current SCIM users on the platform with the LDAP's ones assigning accordingly the operation: add, change, activate, deactivate, delete
+
+        Args:
+            users: (optional, default: c.local_users) LDAP users to compare
+            with_deletes: (optional, default: True) if False the users on the platform not matched are 
+                          not deleted (targeted lookups, the platform users list is partial)
+            curr_users_index: (optional) CurrUsersIndex of c.curr_local_users filled page by page by 
+                              get_scim_users / lookup_scim_users, if not provided it is built here
     """
+    if users is None:
+        users = c.local_users
 
     c.local_users_ops = {'add': [],
                          'update': [],
                          'delete': []
     } # reset
+    c.local_users_changed_attrs = {} # reset
+
+    fields, subkeys = get_scim_digest_fields()
+    fields_cache = {}
+
+    # users on the platform indexed by userName and externalId (O(1) matching), 
+    # built page by page by get_scim_users (if not, it is built here)
+    if curr_users_index is None:
+        curr_users_index = CurrUsersIndex(c.curr_local_users)
+
+    curr_users_byname = curr_users_index.byname
+    curr_users_byextid = curr_users_index.byextid
+
+    local_user_names = {user['userName'] for user in users}
+    matched = set()     # platform users matched by an LDAP user (object ids)
 
     # search local_users (user coming from LDAP) in curr_local_users to identify updates
     # or new users if not in curr_local_users
-    for user in c.local_users:  
+    for user in users:  
         # match by userName
-        curr_user_matching = next(filter(lambda d: d.get('userName') == user['userName'], c.curr_local_users), None)
+        curr_user_matching = curr_users_byname.get(user['userName'])
+
+        if curr_user_matching is None and user.get('externalId'):
+            # match by externalId - renamed on LDAP (the old userName is not used by another LDAP user)
+            curr_user_matching = curr_users_byextid.get(user['externalId'])
+
+            if curr_user_matching is not None:
+                if curr_user_matching.get('userName') in local_user_names or id(curr_user_matching) in matched:
+                    curr_user_matching = None
+                else:
+                    c.logger.debug("Renamed user: %s -> %s" % (curr_user_matching.get('userName'), user['userName']))
 
         if curr_user_matching is not None:
+            matched.add(id(curr_user_matching))
+
             # exists and it is different -> update
             user['id'] = curr_user_matching['id']  # complete the id with the id on the platform
    
             # compare the user on the platform [curr_user_matching] with the one from LDAP [scim_users/user]
-            # verifying that each key in [scim_users/user] field is == in [curr_user_matching]
-            changed = False
-            for k,e in user.items():
-                # key don't exists or the value is not matching -> changed / stop
-                # new LDAP fields non present in SCIM API returned user's fields are not considered for comparison
-                if k in curr_user_matching and e != curr_user_matching[k]:      
-                    changed = True
-                    break
+            # by the canonical digest of the compared fields (cached in the records)
+            user_fields = _user_digest_fields(fields, user, curr_user_matching, fields_cache)
+            changed = user.digest(user_fields, subkeys) != curr_user_matching.digest(user_fields, subkeys)
 
             if changed:  
-                # update
+                # update (the changed fields select a PATCH or a PUT)
                 c.local_users_ops['update'].append(user)
+                c.local_users_changed_attrs[user['id']] = scim.changed_fields(user, curr_user_matching, user_fields, subkeys)
         else:
             # does not exist -> add
-            # if an LDAP user change userName is managed as new user
             c.local_users_ops['add'].append(user)
 
-    # search curr_local_users = users already on the platform, that are NOT in the local_users (coming from LDAP) -> delete
-    for user in c.curr_local_users:
-        # match by userName 
-        local_user_matching = next(filter(lambda d: d.get('userName') == user['userName'], c.local_users), None)
-
-        if local_user_matching is None and user['active']:
+    # search curr_local_users = users already on the platform, that are NOT matched by the local_users (coming from LDAP) -> delete
+    for user in (c.curr_local_users if with_deletes else []):
+        if id(user) not in matched and user['active']:
             # if a current user does not exist in local_users -> deleted
             c.local_users_ops['delete'].append({ 
                                         'id': user['id'], 
@@ -74,42 +244,406 @@ def compare_scim_users():
     c.logger.info(f"New users: {len(c.local_users_ops['add'])} - Users to update: {len(c.local_users_ops['update'])} - Users to delete: {len(c.local_users_ops['delete'])}")
     c.logger.info(f"Active Users (LDAP): {len(c.local_users)} - Total Users (SCIM): {len(c.curr_local_users)}")
 
+def _group_users_bykey(users):
+    """ (priv) Groups the users of a phase by id or userName (operations on the same user are serialized)
+
+        Args:
+            users: users of the operation
+
+        Returns:
+            {id or userName: [users]}
+    """
+    users_bykey = {}
+    for user in users:
+        users_bykey.setdefault(user.get('id') or user['userName'], []).append(user)
+    return users_bykey
+
+def _changed_attrs(op, user):
+    """ (priv) Returns the changed fields of a user to update (see compare_scim_users), None for the other operations
+    """
+    return c.local_users_changed_attrs.get(user.get('id')) if op == 'update' else None
+
+def _hook_accepts_resp(hook):
+    """ (priv) Returns True if the after_send_user hook accepts the operation result (resp keyword 
+        or **kwargs), the hooks defined as after_send_user(user, op) are called without it
+    """
+    try:
+        params = inspect.signature(hook).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.kind == p.VAR_KEYWORD or (p.name == 'resp' and p.kind != p.POSITIONAL_ONLY) for p in params)
+
+def _after_send_user(user, op, resp):
+    """ (priv) Calls the custom plugin after_send_user hook (if any) of an executed operation
+
+        Args:
+            user: user of the operation
+            op: operation ('add', 'update', 'delete')
+            resp: operation result ({'http_status': None, 'scim_user': {}} if failed)
+    """
+    if c.custom_plugin is None:
+        return
+
+    hook = c.custom_plugin.after_send_user
+    if _hook_accepts_resp(hook):
+        hook(user, op=op, resp=resp)
+    else:
+        hook(user, op=op)
+
+def _send_scim_ops(op, users, max_concurrency=1):
+    """ (priv) Executes on the SCIM API interface the operations of a phase (add, update, delete)
+        with up to max_concurrency concurrent requests. The operations on the same user are 
+        serialized (same worker, in order). The custom plugin hooks are called by the calling thread: 
+        before_send_user when the operation is submitted, after_send_user (with the operation 
+        result: resp, if the hook accepts it) when it is completed, failed operations included.
+        If the service provider supports the Bulk endpoint the operations are sent by Bulk 
+        requests (see _send_scim_bulk_ops).
+
+        Args:
+            op: operation ('add', 'update', 'delete')
+            users: users of the operation
+            max_concurrency: (optional, default: 1) max concurrent requests - 1 = sequential
+    """
+    bulk = sh.get_bulk_config() if users else None
+    if bulk is not None:
+        _send_scim_bulk_ops(op, users, bulk, max_concurrency)
+        return
+
+    def _exec(user):
+        c.logger.debug("%s user: %s (id: %s)" % (op.capitalize(), user['userName'], user.get('id')))
+        try:
+            return sh.exec_scim_user_api_req(user, op=op, changed_attrs=_changed_attrs(op, user))
+        except Exception as e:
+            c.logger.error("SCIM %s operation - user: %s - error: %s" % (op, user['userName'], e))
+            return {'http_status': None, 'scim_user': {}}
+
+    if max_concurrency <= 1:
+        for user in users:
+            if c.custom_plugin is not None:
+                c.custom_plugin.before_send_user(user, op=op)
+
+            resp = _exec(user)
+
+            _after_send_user(user, op, resp)
+        return
+
+    # operations on the same user (by id or userName) in the same task
+    users_bykey = _group_users_bykey(users)
+
+    def _exec_all(key_users):
+        return [(user, _exec(user)) for user in key_users]
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='scim_' + op) as executor:
+        futures = []
+        for key_users in users_bykey.values():
+            if c.custom_plugin is not None:
+                for user in key_users:
+                    c.custom_plugin.before_send_user(user, op=op)
+
+            futures.append(executor.submit(_exec_all, key_users))
+
+        # the failed operations (see _exec) complete with an error resp
+        for future in as_completed(futures):
+            for user, resp in future.result():
+                _after_send_user(user, op, resp)
+
+def _bulk_rounds(users):
+    """ (priv) Splits the users of a phase in rounds with one operation per user (by id or userName) at most: 
+        the operations on the same user are serialized by the rounds order
+
+        Args:
+            users: users of the operation
+
+        Returns:
+            list of rounds (lists of users)
+    """
+    rounds = []
+    for key_users in _group_users_bykey(users).values():
+        for n, user in enumerate(key_users):
+            if n == len(rounds):
+                rounds.append([])
+            rounds[n].append(user)
+    return rounds
+
+def _send_scim_bulk_ops(op, users, bulk, max_concurrency=1):
+    """ (priv) Executes the operations of a phase by SCIM Bulk requests, chunked by the server limits 
+        (see scim_helper.bulk_chunks), with up to max_concurrency concurrent requests. 
+        The operations not executed by a Bulk request (not sent, rejected) fall back to single requests, 
+        the operations with an unknown outcome (5xx, read timeout) are left to the next cycle.
+        The custom plugin before_send_user hooks of a round are called before its Bulk requests are 
+        built, the Bulk operations results are mapped back to the users for the after_send_user hooks 
+        (see _send_scim_ops), the users of a failed Bulk request with an error resp.
+
+        Args:
+            op: operation ('add', 'update', 'delete')
+            users: users of the operation
+            bulk: Bulk limits (see scim_helper.get_bulk_config)
+            max_concurrency: (optional, default: 1) max concurrent requests
+    """
+    client = c.scim_client
+
+    def _exec_chunk(chunk):
+        results = sh.exec_scim_bulk_req(chunk)
+
+        # fallback: single requests for the operations not executed (not sent, rejected)
+        for n, (user, user_op, changed_attrs, _) in enumerate(chunk[0]):
+            if results[n] is None:
+                results[n] = sh.exec_scim_user_api_req(user, op=user_op, changed_attrs=changed_attrs)
+
+        return [(item[0], resp) for item, resp in zip(chunk[0], results)]
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix='scim_bulk_' + op) as executor:
+        for users_round in _bulk_rounds(users):
+            # the hooks can change the users: called before the operations are serialized
+            if c.custom_plugin is not None:
+                for user in users_round:
+                    c.custom_plugin.before_send_user(user, op=op)
+
+            chunks = sh.bulk_chunks([(user, op, _changed_attrs(op, user)) for user in users_round], 
+                                    client.url, client.users_url, bulk)
+            c.logger.debug("SCIM Bulk %s - operations: %d - requests: %d" % (op, len(users_round), len(chunks)))
+
+            futures = {executor.submit(_exec_chunk, chunk): chunk for chunk in chunks}
+
+            for future in as_completed(futures):
+                try:
+                    users_resp = future.result()
+                except Exception as e:
+                    c.logger.error("SCIM Bulk %s operation - error: %s" % (op, e))
+                    users_resp = [(item[0], {'http_status': None, 'scim_user': {}}) for item in futures[future][0]]
+
+                for user, resp in users_resp:
+                    _after_send_user(user, op, resp)
+
 def send_scim_update():
     """ For each user execute on the SCIM API interface the assigned operation: add, update, delete
+
+        The phases are executed in order (delete, update, add), each one with up to 
+        scim_api.max_concurrency (default: 1, sequential) concurrent requests 
     """
-    
-    # delete / de-activate users
-    for user in c.local_users_ops['delete']:
-        if c.custom_plugin is not None:
-            c.custom_plugin.before_send_user(user, op='delete')
-        
-        c.logger.debug("Delete user: %s (id: %s)" % (user['userName'], user['id']))
-        sh.exec_scim_user_api_req(user, op='delete')
+    max_concurrency = c.scim_config.get('max_concurrency', 1)
 
-        if c.custom_plugin is not None:
-            c.custom_plugin.after_send_user(user, op='delete')
+    # delete / de-activate users
+    _send_scim_ops('delete', c.local_users_ops['delete'], max_concurrency)
 
     # update users
-    for user in c.local_users_ops['update']:
-        if c.custom_plugin is not None:
-            c.custom_plugin.before_send_user(user, op='update')
-        
-        c.logger.debug("Update user: %s (id: %s)" % (user['userName'], user['id']))
-        sh.exec_scim_user_api_req(user, op='update')
-
-        if c.custom_plugin is not None:
-            c.custom_plugin.after_send_user(user, op='update')
+    _send_scim_ops('update', c.local_users_ops['update'], max_concurrency)
 
     # add users
-    for user in c.local_users_ops['add']:
-        if c.custom_plugin is not None:
-            c.custom_plugin.before_send_user(user, op='add')
-        
-        c.logger.debug("Add user: %s" % user['userName'])
-        sh.exec_scim_user_api_req(user, op='add')
+    _send_scim_ops('add', c.local_users_ops['add'], max_concurrency)
+
+def get_users_group_names(det_groups_byname, group_search_re):
+    """ Returns the LDAP group names of each LDAP user 
+
+        det_api.auto_assign_mlde_groups.membership:
+            'user' (default): the group names are extracted from each user memberOf group DNs (direct 
+                              membership) by the group_search_re regex
+            'group': the LDAP plugin resolves the transitive members (nested groups) of the groups 
+                     that exist on the platform only (ldap_get_group_members plugin function)
+
+        Args:
+            det_groups_byname: platform groups by name
+            group_search_re: regex to extract the group name from a memberOf group DN
+
+        Returns:
+            dict {userName: [group names]}
+    """
+    users_group_names = {}
+
+    if c.det_config['auto_assign_mlde_groups'].get('membership', 'user') == 'group':
+        if hasattr(c.ldap_plugin, 'ldap_get_group_members'):
+            group_members = c.ldap_plugin.ldap_get_group_members(list(det_groups_byname))
+
+            if group_members is not None:
+                for group_name, user_names in group_members.items():
+                    for user_name in user_names:
+                        users_group_names.setdefault(user_name, []).append(group_name)
+
+                return users_group_names
+            
+            c.logger.error("LDAP group members not available - memberOf group membership used")
+        else:
+            c.logger.error("LDAP plugin does not support group membership - memberOf group membership used")
+
+    group_re = re.compile(group_search_re)
+    group_names_bydn = {}   # group DN -> group name (each DN parsed once)
+
+    for user in c.local_users:
+        member_of = user.get('memberOf')
+
+        # safety array conversion 
+        # in case the group DN is not passed or it is passed as a string (by LDAP)
+        if member_of is None:
+            member_of =[]
+        if type(member_of) is str:
+            member_of = [member_of]
+
+        group_names = []
+        for m_group in member_of:
+            m_group = str(m_group)
+
+            if m_group not in group_names_bydn:
+                # extracts the group name
+                m = group_re.search(m_group)
+                if m:
+                    group_names_bydn[m_group] = m.group(1)
+                else:
+                    # group name not found in memberOf
+                    c.logger.error(f"No matching group in memberOf field: {m_group} - Skip group assignment")
+                    group_names_bydn[m_group] = None
+
+            if group_names_bydn[m_group] is not None:
+                group_names.append(group_names_bydn[m_group])
+
+        users_group_names[user['userName']] = group_names
+
+    return users_group_names
 
-        if c.custom_plugin is not None:
-            c.custom_plugin.after_send_user(user, op='add')
+def get_mlde_group_ops(det_users_byname, det_groups_byname, det_groups_users_bygroup_id, by_name=False):
+    """ Computes the MLDE groups assignments: the users that are part of an LDAP group that exists 
+        on the platform are assigned to the group, if auto_removal_enabled the remote users that 
+        are not part of the LDAP group anymore are de-assigned
+
+        Args:
+            det_users_byname: platform users by name
+            det_groups_byname: platform groups by name
+            det_groups_users_bygroup_id: platform groups users by group id
+            by_name: (optional, default: False) if True the users are returned by userName (plan mode), 
+                     the users to be created by the plan (not on the platform yet) are included
+
+        Returns:
+            ({group id: [user ids to add]}, {group id: [user ids to remove]}) (by_name: userNames)
+    """
+    # get group name filter string from det_api.auto_assign_mlde_groups config
+    if 'group_string_filter' in c.det_config['auto_assign_mlde_groups']:
+        group_search_re = c.det_config['auto_assign_mlde_groups']['group_string_filter']
+    else:
+        group_search_re = '^CN=(.+?)\,'   # match the first "CN=" up to the first ','
+
+    c.logger.debug(f"Group name filtering regex: {group_search_re}")
+
+    # LDAP group names of each user (by userName)
+    users_group_names = get_users_group_names(det_groups_byname, group_search_re)
+
+    det_group_assigned_user_ids = {}
+    det_group_add_user_ids = {}
+    det_group_rm_user_ids = {}
+
+    c.logger.debug("Users automatic assignment to group/s: enabled")
+
+    # plan mode: the users to be created by the plan are assigned by userName (ids resolved by apply_plan)
+    new_user_names = {user['userName'] for user in c.local_users_ops['add']} if by_name else set()
+
+    # ADD (Assign)
+    # scan can the user that are on LDAP (converted to SIM struct)
+    for user in c.local_users:
+        # local_users user list contains mapped/converted users from LDAP to SCIM struct
+        user_name = user['userName']
+
+        # gets the user id on the platform 
+        if user_name in det_users_byname or user_name in new_user_names:
+            user_id = det_users_byname[user_name]['id'] if user_name in det_users_byname else None
+            user_key = user_name if by_name else user_id
+
+            group_names = users_group_names.get(user_name, [])
+
+            c.logger.debug(f"User name: {user_name} - User id: {user_id}")
+            c.logger.debug(f"User member of group/s: {group_names}")
+
+            # ADD
+            # scan groups the user is member of --> add 
+            for group_name in group_names:
+
+                if group_name in det_groups_byname:
+                    group = det_groups_byname[group_name]   # found
+                    group_id = group['groupId']
+
+                    if group_id in det_groups_users_bygroup_id:
+                        grp_users = det_groups_users_bygroup_id[group_id]
+
+                        if user_id in grp_users:
+                            # found 
+                            c.logger.debug(f"User {user_id} is already in group {group_id} ")
+                        else:
+                            # not found --> add
+                            c.logger.debug(f"User {user_key} to be added to group {group_id} ")
+                            if group_id not in det_group_add_user_ids:
+                                det_group_add_user_ids[group_id] = list()   #init list
+
+                            det_group_add_user_ids[group_id].append(user_key)
+
+                        # update assigned users (both existing and to be added)
+                        if group_id not in det_group_assigned_user_ids:
+                            det_group_assigned_user_ids[group_id] = list()   #init list
+
+                        det_group_assigned_user_ids[group_id].append(user_id)
+
+                else:
+                    # group not found on the platform -> skip
+                    c.logger.debug(f"On LDAP user {user_key} is assigned to a group {group_name} that is not available - Skip group assignment")
+        else:
+            c.logger.error(f"Error - User name: {user_name} has not a matching user id")
+
+    c.logger.debug(f"Users assigned to groups: {det_group_assigned_user_ids} ")
+    c.logger.debug(f"Users to add to groups: {det_group_add_user_ids} ")
+
+    # REMOVE (De-assign)
+    # if enabled scan groups/users, if they are not in the det_group_assigned_user_ids remove the user/s
+    if 'auto_assign_mlde_groups' in c.det_config \
+        and 'enabled' in c.det_config['auto_assign_mlde_groups'] \
+        and c.det_config['auto_assign_mlde_groups']['enabled'] \
+        and 'auto_removal_enabled' in c.det_config['auto_assign_mlde_groups'] \
+        and c.det_config['auto_assign_mlde_groups']['auto_removal_enabled']:
+
+        c.logger.debug("Users automatic removal from groups: enabled")
+
+        for assigned_group_id in det_groups_users_bygroup_id:
+            for assigned_user_id in det_groups_users_bygroup_id[assigned_group_id]:
+                remote_user = det_groups_users_bygroup_id[assigned_group_id][assigned_user_id]['remote']
+                if assigned_user_id not in det_group_assigned_user_ids.get(assigned_group_id, []) and remote_user:
+                    # not found any remote user -> remove
+                    if assigned_group_id not in det_group_rm_user_ids:
+                        det_group_rm_user_ids[assigned_group_id] = list()   #init list
+
+                    rm_user = det_groups_users_bygroup_id[assigned_group_id][assigned_user_id]
+                    det_group_rm_user_ids[assigned_group_id].append(rm_user['username'] if by_name else assigned_user_id)
+                    c.logger.debug(f"User {assigned_user_id} is not in group {assigned_group_id} - remove")
+                else:
+                    # found -> don't remove
+                    if remote_user:
+                        c.logger.debug(f"User {assigned_user_id} is in group {assigned_group_id} - remote user - don't remove")
+                    else:
+                        c.logger.debug(f"User {assigned_user_id} is in group {assigned_group_id} - non-remote user - don't remove")
+
+        c.logger.debug(f"Users to remove from groups: {det_group_rm_user_ids} ")
+
+    else:
+        c.logger.debug("Users automatic removal from groups: disabled")
+
+    return det_group_add_user_ids, det_group_rm_user_ids
+
+def send_mlde_group_ops(det_group_add_user_ids, det_group_rm_user_ids):
+    """ Executes the MLDE groups assignments (see get_mlde_group_ops), in plan mode they are 
+        stored in the plan (c.local_groups_ops)
+
+        Args:
+            det_group_add_user_ids: {group id: [user ids to add]} (plan mode: userNames)
+            det_group_rm_user_ids: {group id: [user ids to remove]} (plan mode: userNames)
+    """
+    if c.sync_mode == 'plan':
+        c.local_groups_ops['add'] = det_group_add_user_ids
+        c.local_groups_ops['rm'] = det_group_rm_user_ids
+        return
+
+    # add users to groups
+    for group_id in det_group_add_user_ids:
+        add_user_ids = det_group_add_user_ids[group_id]
+        det.group_add_rm_users(group_id, add_user_ids=add_user_ids)
+
+    # remove users from groups
+    for group_id in det_group_rm_user_ids:
+        rm_user_ids = det_group_rm_user_ids[group_id]
+        det.group_add_rm_users(group_id, rm_user_ids=rm_user_ids)
 
 def auto_assign_mlde_groups():
     """ For each user checks if is part of an LDAP group and if this group exists on the platform automatically assign/de-assign the user to the group
@@ -134,194 +668,503 @@ def auto_assign_mlde_groups():
             det_groups_users_bygroup_id[group_id] = grp_users_byid
             # sleep 100-200ms to not flood the API ???
             
-        # get group name filter string from det_api.auto_assign_mlde_groups config
-        if 'group_string_filter' in c.det_config['auto_assign_mlde_groups']['group_string_filter']:
-            group_search_re = c.det_config['auto_assign_mlde_groups']['group_string_filter']
-        else:
-            group_search_re = '^CN=(.+?)\,'   # match the first "CN=" up to the first ','
+        # compute and execute the groups assignments
+        det_group_add_user_ids, det_group_rm_user_ids = get_mlde_group_ops(det_users_byname, det_groups_byname, det_groups_users_bygroup_id,
+                                                                           by_name=c.sync_mode == 'plan')
+        send_mlde_group_ops(det_group_add_user_ids, det_group_rm_user_ids)
+
+        # logout
+        det.logout()
+        c.logger.debug("Execution time %s" % c.stop_time(_st, to_str=True))
+        c.logger.debug(80*"*")
+        return True
+    else:
+        # no login
+        return False
+
 
-        c.logger.debug(f"Group name filtering regex: {group_search_re}")
 
-        det_group_assigned_user_ids = {}
-        det_group_add_user_ids = {}
-        det_group_rm_user_ids = {}
+def _group_user_ids(group_user_names, det_users_byname):
+    """ (priv) Resolves the users of the planned MLDE groups assignments (by userName) to the platform ids
 
-        c.logger.debug(f"Users automatic assignment to group/s: enabled")
+        Args:
+            group_user_names: {group id: [userNames]}
+            det_users_byname: platform users by name
 
-        # ADD (Assign)
-        # scan can the user that are on LDAP (converted to SIM struct)
-        for user in c.local_users:
-            # local_users user list contains mapped/converted users from LDAP to SCIM struct
-            user_name = user['userName']
-            member_of = user['memberOf']
+        Returns:
+            {group id: [user ids]} (the users not on the platform are skipped)
+    """
+    group_user_ids = {}
 
-            # gets the user id on the platform 
+    for group_id, user_names in group_user_names.items():
+        for user_name in user_names:
             if user_name in det_users_byname:
-                user = det_users_byname[user_name]   # found
-                user_id = user['id']   # found
-
-                # safety array conversion 
-                # in case the group DN is not passed or it is passed as a string (by LDAP)
-                if member_of is None:
-                    member_of =[]
-                if type(member_of) is str:
-                    member_of = [member_of]
-                
-                c.logger.debug(f"User name: {user_name} - User id: {user_id}")
-                c.logger.debug(f"User member of group/s: {member_of}")
-
-                # ADD
-                # scan groups the user is member of --> add 
-                for m_group in member_of:
-
-                    # extracts the group name
-                    group_name = ""
-                    m = re.search(group_search_re, str(m_group) )
-                    if m:
-                        # found
-                        group_name = m.group(1)
-
-                        if group_name in det_groups_byname:
-                            group = det_groups_byname[group_name]   # found
-                            group_id = group['groupId']
-
-                            if group_id in det_groups_users_bygroup_id:
-                                grp_users = det_groups_users_bygroup_id[group_id]
-
-                                if user_id in grp_users:
-                                    # found 
-                                    c.logger.debug(f"User {user_id} is already in group {group_id} ")
-                                else:
-                                    # not found --> add
-                                    c.logger.debug(f"User {user_id} to be added to group {group_id} ")
-                                    if group_id not in det_group_add_user_ids:
-                                        det_group_add_user_ids[group_id] = list()   #init list
-
-                                    det_group_add_user_ids[group_id].append(user_id)
-
-                                # update assigned users (both existing and to be added)
-                                if group_id not in det_group_assigned_user_ids:
-                                    det_group_assigned_user_ids[group_id] = list()   #init list
-
-                                det_group_assigned_user_ids[group_id].append(user_id)
-                                    
-                        else:
-                            # group not found on the platform -> skip
-                            c.logger.debug(f"On LDAP user {user_id} is assigned to a group {group_name} that is not available - Skip group assignment")
-                    else:
-                        # group name not found in memberOf
-                        c.logger.error(f"No matching group in memberOf field: {str(m_group)} - Skip group assignment")
+                group_user_ids.setdefault(group_id, []).append(det_users_byname[user_name]['id'])
             else:
-                c.logger.error(f"Error - User name: {user_name} has not a matching user id")
-        
-        c.logger.debug(f"Users assigned to groups: {det_group_assigned_user_ids} ")
-        c.logger.debug(f"Users to add to groups: {det_group_add_user_ids} ")
-
-        # add users to groups
-        for group_id in det_group_add_user_ids:
-            add_user_ids = det_group_add_user_ids[group_id]
-            det.group_add_rm_users(group_id, add_user_ids=add_user_ids)
-
-
-        # REMOVE (De-assign)
-        # if enabled scan groups/users, if they are not in the det_group_assigned_user_ids remove the user/s
-        if 'auto_assign_mlde_groups' in c.det_config \
-            and 'enabled' in c.det_config['auto_assign_mlde_groups'] \
-            and c.det_config['auto_assign_mlde_groups']['enabled'] \
-            and 'auto_removal_enabled' in c.det_config['auto_assign_mlde_groups'] \
-            and c.det_config['auto_assign_mlde_groups']['auto_removal_enabled']:
-            
-            c.logger.debug(f"Users automatic removal from groups: enabled")
-
-            for assigned_group_id in det_groups_users_bygroup_id:
-                for assigned_user_id in det_groups_users_bygroup_id[assigned_group_id]:
-                    remote_user = det_groups_users_bygroup_id[assigned_group_id][assigned_user_id]['remote']
-                    if assigned_user_id not in det_group_assigned_user_ids[assigned_group_id] and remote_user:
-                        # not found any remote user -> remove
-                        if assigned_group_id not in det_group_rm_user_ids:
-                            det_group_rm_user_ids[assigned_group_id] = list()   #init list
-
-                        det_group_rm_user_ids[assigned_group_id].append(assigned_user_id) 
-                        c.logger.debug(f"User {assigned_user_id} is not in group {assigned_group_id} - remove")
-                    else:
-                        # found -> don't remove
-                        if remote_user:
-                            c.logger.debug(f"User {assigned_user_id} is in group {assigned_group_id} - remote user - don't remove")
-                        else:
-                            c.logger.debug(f"User {assigned_user_id} is in group {assigned_group_id} - non-remote user - don't remove")
+                c.logger.error(f"Error - User name: {user_name} has not a matching user id - Skip group {group_id} assignment")
 
-            c.logger.debug(f"Users to remove from groups: {det_group_rm_user_ids} ")
-            
-            # remove users from groups
-            for group_id in det_group_rm_user_ids:
-                rm_user_ids = det_group_rm_user_ids[group_id]
-                det.group_add_rm_users(group_id, rm_user_ids=rm_user_ids)
+    return group_user_ids
+
+def apply_plan(plan_filename):
+    """ Apply mode - executes the operations of a sync plan written by a plan run (see sync_plan): 
+        the SCIM users operations, then the MLDE groups assignments (the users planned by userName 
+        are resolved to the platform ids after the users operations, so the created users are included). 
+        No LDAP access, the plan is applied as it is.
+
+        Args:
+            plan_filename: plan file full pathname
+
+        Returns:
+            True if the plan is applied, False if it cannot be read or the DET API login fails
+    """
+    sync_plan = plan.read(plan_filename)
+    if sync_plan is None:
+        return False
+
+    c.local_users_ops, c.local_users_changed_attrs, group_add_user_names, group_rm_user_names = sync_plan
+
+    if c.custom_plugin is not None:
+        c.custom_plugin.before_send_all_users()
+
+    send_scim_update()
+
+    if c.custom_plugin is not None:
+        c.custom_plugin.after_send_all_users()
+
+    if not group_add_user_names and not group_rm_user_names:
+        return True
+
+    if not det.login():
+        return False
+
+    det_users_byid, det_users_byname = det.get_users()
+    group_add_user_ids = _group_user_ids(group_add_user_names, det_users_byname)
+    group_rm_user_ids = _group_user_ids(group_rm_user_names, det_users_byname)
+
+    for group_id, add_user_ids in group_add_user_ids.items():
+        det.group_add_rm_users(group_id, add_user_ids=add_user_ids)
+
+    for group_id, rm_user_ids in group_rm_user_ids.items():
+        det.group_add_rm_users(group_id, rm_user_ids=rm_user_ids)
+
+    det.logout()
+    return True
+
+def start_ldap_watchers():
+    """ Starts the LDAP change notification watchers (ldap.notify), one thread for each watched base DN
+        (ldap.notify.dn, default: ldap.users.dn). The watchers put the changed entries DNs in the 
+        changes queue consumed by sync_ldap_changes(). If a watcher fails it is restarted after 
+        ldap.notify.retry seconds.
+
+        Returns:
+            True if the watchers are started, False if the LDAP plugin does not support notifications
+    """
+    if not hasattr(c.ldap_plugin, 'ldap_watch_changes'):
+        c.logger.error("LDAP plugin does not support change notifications")
+        return False
+
+    notify_config = c.ldap_config['notify']
+    base_dns = notify_config.get('dn', c.ldap_config_users['dn'])
+    if isinstance(base_dns, str):
+        base_dns = [base_dns]
+
+    def _watch(base_dn):
+        while True:
+            try:
+                c.logger.info("LDAP change notifications - watching [%s]" % base_dn)
+                c.ldap_plugin.ldap_watch_changes(base_dn, _ldap_changes.put)
+            except Exception as e:
+                c.logger.error("LDAP change notifications [%s] - error: %s" % (base_dn, e))
+
+            time.sleep(notify_config.get('retry', 30))
+
+    for base_dn in base_dns:
+        threading.Thread(target=_watch, args=(base_dn,), name='ldap_watcher', daemon=True).start()
+
+    return True
+
+def sync_ldap_changes(timeout):
+    """ Waits for LDAP change notifications up to timeout seconds (the next full reconcile).
+        The notifications are coalesced over ldap.notify.debounce seconds, then only the changed
+        entries are synced by a targeted delta cycle (more than ldap.notify.max_targeted changed
+        entries run a regular cycle).
+
+        Args:
+            timeout: seconds to wait
+    """
+    notify_config = c.ldap_config['notify']
+    debounce = notify_config.get('debounce', 5)
+    max_targeted = notify_config.get('max_targeted', 500)
+
+    deadline = time.time() + timeout
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+
+        try:
+            changed_dns = {_ldap_changes.get(timeout=remaining)}
+        except queue.Empty:
+            return
+
+        # debounce window
+        window_end = time.time() + debounce
+        while True:
+            remaining = window_end - time.time()
+            if remaining <= 0:
+                break
+            try:
+                changed_dns.add(_ldap_changes.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        c.logger.info("LDAP change notifications - changed entries: %d" % len(changed_dns))
+
+        _st = c.start_time()
+
+        if len(changed_dns) <= max_targeted:
+            main_loop(changed_dns)
         else:
-            c.logger.debug(f"Users automatic removal from groups: disabled")
+            main_loop()
 
-        # logout
-        det.logout()
         c.logger.debug("Execution time %s" % c.stop_time(_st, to_str=True))
-        c.logger.debug(80*"*")
-        return True
+
+def shutdown():
+    """ Releases the process resources at exit: unbinds the pooled LDAP connections, closes
+        the async engine client and event loop (if used)
+    """
+    lh.ldap_close_pools()
+
+    if c.scim_config.get('engine', 'sync') == 'async':
+        from libs import async_api
+        async_api.close()
+
+# async engine (scim_api.engine: async)
+
+async def aio_send_scim_update(client):
+    """ Async send_scim_update: the operations of each phase (delete, update, add) are executed 
+        concurrently on the event loop (up to scim_api.max_concurrency requests in flight), 
+        the operations on the same user are serialized. By Bulk requests if supported 
+        (see _send_scim_bulk_ops).
+
+        Args:
+            client: async_api.AsyncAPIClient
+    """
+
+    async def _exec_all(op, key_users):
+        for user in key_users:
+            if c.custom_plugin is not None:
+                c.custom_plugin.before_send_user(user, op=op)
+
+            c.logger.debug("%s user: %s (id: %s)" % (op.capitalize(), user['userName'], user.get('id')))
+            try:
+                resp = await client.exec_scim_user_api_req(user, op=op, changed_attrs=_changed_attrs(op, user))
+            except Exception as e:
+                c.logger.error("SCIM %s operation - user: %s - error: %s" % (op, user['userName'], e))
+                resp = {'http_status': None, 'scim_user': {}}
+
+            _after_send_user(user, op, resp)
+
+    async def _exec_chunk(chunk):
+        try:
+            results = await client.exec_scim_bulk_req(chunk)
+        except Exception as e:
+            c.logger.error("SCIM Bulk operation - error: %s" % e)
+            results = [{'http_status': None, 'scim_user': {}}] * len(chunk[0])
+
+        for (user, op, changed_attrs, _), resp in zip(chunk[0], results):
+            # fallback: single requests for the operations not executed (not sent, rejected)
+            if resp is None:
+                try:
+                    resp = await client.exec_scim_user_api_req(user, op=op, changed_attrs=changed_attrs)
+                except Exception as e:
+                    c.logger.error("SCIM %s operation - user: %s - error: %s" % (op, user['userName'], e))
+                    resp = {'http_status': None, 'scim_user': {}}
+
+            _after_send_user(user, op, resp)
+
+    bulk = await client.get_bulk_config() if any(c.local_users_ops[op] for op in ['delete', 'update', 'add']) else None
+
+    for op in ['delete', 'update', 'add']:
+        if bulk is not None:
+            for users_round in _bulk_rounds(c.local_users_ops[op]):
+                # the hooks can change the users: called before the operations are serialized
+                if c.custom_plugin is not None:
+                    for user in users_round:
+                        c.custom_plugin.before_send_user(user, op=op)
+
+                chunks = sh.bulk_chunks([(user, op, _changed_attrs(op, user)) for user in users_round], 
+                                        client.scim_url, client.scim_users_url, bulk)
+                await asyncio.gather(*[_exec_chunk(chunk) for chunk in chunks])
+            continue
+
+        users_bykey = _group_users_bykey(c.local_users_ops[op])
+        await asyncio.gather(*[_exec_all(op, key_users) for key_users in users_bykey.values()])
+
+async def aio_auto_assign_mlde_groups(client):
+    """ Async auto_assign_mlde_groups: the platform users, groups and groups users are requested 
+        concurrently, then the groups assignments are executed concurrently
+
+        Args:
+            client: async_api.AsyncAPIClient
+
+        Returns:
+            True if executed, False if the Det API login fails
+    """
+    if not await client.det_login():
+        return False
+
+    _st = c.start_time()
+
+    (det_users_byid, det_users_byname), (det_groups_byid, det_groups_byname) = \
+        await asyncio.gather(client.det_get_users(), client.det_get_groups())
+
+    group_ids = list(det_groups_byid)
+    groups_users = await asyncio.gather(*[client.det_get_group_users_byid(group_id) for group_id in group_ids])
+    det_groups_users_bygroup_id = dict(zip(group_ids, groups_users))
+
+    det_group_add_user_ids, det_group_rm_user_ids = get_mlde_group_ops(det_users_byname, det_groups_byname, det_groups_users_bygroup_id,
+                                                                       by_name=c.sync_mode == 'plan')
+
+    if c.sync_mode == 'plan':
+        send_mlde_group_ops(det_group_add_user_ids, det_group_rm_user_ids)
     else:
-        # no login
+        await asyncio.gather(*[client.det_group_add_rm_users(group_id, add_user_ids=add_user_ids) 
+                               for group_id, add_user_ids in det_group_add_user_ids.items()])
+        await asyncio.gather(*[client.det_group_add_rm_users(group_id, rm_user_ids=rm_user_ids) 
+                               for group_id, rm_user_ids in det_group_rm_user_ids.items()])
+
+    await client.det_logout()
+    c.logger.debug("Execution time %s" % c.stop_time(_st, to_str=True))
+    return True
+
+async def aio_main_loop(client, changed_dns=None):
+    """ Async main_loop (scim_api.engine: async): the LDAP retrieval (synchronous python-ldap) runs in 
+        a worker thread concurrently with the SCIM user list request, the SCIM and Det API requests 
+        are executed concurrently on the event loop
+
+        Args:
+            client: async_api.AsyncAPIClient
+            changed_dns: (optional, default: None) if provided only the changed LDAP entries 
+                         are retrieved and mapped (targeted delta cycle)
+
+        Returns:
+            False if the sync plan cannot be written (plan mode), True otherwise
+    """
+    _sync_cycle_start(changed_dns)
+
+    # users on the platform index, filled as the SCIM users are received
+    curr_users_index = CurrUsersIndex()
+
+    ldap_get_users = asyncio.get_running_loop().run_in_executor(None, c.ldap_plugin.ldap_get_users)
+
+    if _scim_users_after_ldap():
+        ldap_ok = await ldap_get_users
+        resp = None
+    else:
+        ldap_ok, resp = await asyncio.gather(ldap_get_users, _aio_get_scim_users(client, curr_users_index))
+
+    if ldap_ok:
+        _map_ldap_users()
+
+        # few changed users: targeted lookups of the changed users only
+        lookup = resp is None and is_scim_lookup_cycle()
+        if lookup:
+            resp = await client.lookup_scim_users(c.local_users_delta, handle_users=curr_users_index.add)
+
+            if resp['http_status'] not in [200,201,202]:
+                # targeted lookups failed (e.g., filter not supported): full SCIM user list
+                _log_lookup_fallback(resp['http_status'])
+                lookup = False
+                curr_users_index = CurrUsersIndex()
+                resp = None
+
+        if resp is None:
+            resp = await _aio_get_scim_users(client, curr_users_index)
+
+        if _compare_scim_users_resp(resp, lookup, curr_users_index) and c.sync_mode != 'plan':
+            if c.custom_plugin is not None:
+                c.custom_plugin.before_send_all_users()
+
+            await aio_send_scim_update(client)
+
+            if c.custom_plugin is not None:
+                c.custom_plugin.after_send_all_users()
+
+        if _is_auto_assign_enabled():
+            await aio_auto_assign_mlde_groups(client)
+
+    return _sync_cycle_end(ldap_ok)
+
+async def _aio_get_scim_users(client, curr_users_index):
+    """ (priv) Async get_scim_users
+    """
+    resp = await client.get_scim_users(handle_users=curr_users_index.add)
+    if resp['http_status'] in [200,201,202]:
+        c.curr_users_total = len(c.curr_local_users)
+
+    return resp
+
+# sync cycle steps (shared by main_loop and aio_main_loop)
+
+def _sync_cycle_start(changed_dns):
+    """ (priv) Resets the computed operations and starts a full reconcile or a delta cycle 
+        (if incremental sync is enabled or targeted)
+    """
+    c.local_users_ops = {'add': [], 'update': [], 'delete': []}
+    c.local_users_changed_attrs = {}
+    c.local_groups_ops = {'add': {}, 'rm': {}}
+
+    lpc.incremental_cycle_start(changed_dns)
+
+def _scim_users_after_ldap():
+    """ (priv) Returns True if the users on the platform are requested after the LDAP retrieval: 
+        delta cycle with targeted lookups enabled, the changed users are known after it 
+        (see is_scim_lookup_cycle)
+    """
+    return c.ldap_delta_cycle and c.scim_config.get('lookup', {}).get('enabled', False)
+
+def _map_ldap_users():
+    """ (priv) Maps the LDAP users on the SCIM fields and merges the changed users in the full 
+        users view (if incremental sync is enabled)
+    """
+
+    # TODO remove
+    # if c.user_management_api == 'det':
+    #     # DET APIs
+        
+    #     # map the LDAP user fields on the MLDE DET fields
+    #     c.ldap_plugin.ldap_to_det_mapping()
+    #     #TODO c.ldap_plugin.ldap_to_det_mapping()
+
+    #     # get the users list form the platform using DET API
+    #     det_api_ok = get_det_users()
+         
+    #     if det_api_ok \
+    #         and c.curr_local_users is not None and len(c.local_users) > 0:
+    #         # for each user in LDAP derived user list define what to do on the DET API
+    #         compare_det_users()
+                
+    #         # then execute the changes on the platform user list
+    #         if c.custom_plugin is not None:
+    #             c.custom_plugin.before_send_all_users()
+            
+    #         send_det_update()
+            
+    #         if c.custom_plugin is not None:
+    #             c.custom_plugin.after_send_all_users()
+    # else:
+
+    # SCIM APIs
+
+    # map the LDAP user fields on the MLDE SCIM fields
+    c.ldap_plugin.ldap_to_scim_mapping()
+
+    # merge the changed users in the full users view (if incremental sync is enabled)
+    lpc.merge_incremental_users()
+
+def _compare_scim_users_resp(resp, lookup, curr_users_index):
+    """ (priv) Compares the LDAP users with the users on the platform (see compare_scim_users) if 
+        they are received
+
+        Args:
+            resp: SCIM user list (or targeted lookups) response
+            lookup: True if the users on the platform are the targeted lookups ones (no deletes)
+            curr_users_index: CurrUsersIndex of the users on the platform
+
+        Returns:
+            True if compared (operations to send)
+    """
+    scim_ok = resp['http_status'] in [200,201,202]
+
+    if not scim_ok or c.curr_local_users is None or len(c.local_users) == 0:
         return False
 
+    # for each user in LDAP derived user list define what to do on the SCIM API
+    if lookup:
+        compare_scim_users(c.local_users_delta, with_deletes=False, curr_users_index=curr_users_index)
+    else:
+        compare_scim_users(curr_users_index=curr_users_index)
+    return True
+
+def _is_auto_assign_enabled():
+    """ (priv) Returns True if the auto assign of MLDE groups is active
+    """
+    return 'auto_assign_mlde_groups' in c.det_config \
+        and 'enabled' in c.det_config['auto_assign_mlde_groups'] \
+        and c.det_config['auto_assign_mlde_groups']['enabled']
+
+def _sync_cycle_end(ldap_ok):
+    """ (priv) Ends the sync cycle: plan mode writes the computed operations in the sync plan file, 
+        stores the new watermark (if incremental sync is enabled) and the mapped users cache 
+        (if enabled)
+
+        Args:
+            ldap_ok: True if the LDAP users were retrieved
+
+        Returns:
+            False if the sync plan cannot be written (plan mode), True otherwise
+    """
+    plan_ok = True
+
+    if ldap_ok and c.sync_mode == 'plan':
+        plan_ok = plan.write(c.plan_filename, c.local_users_ops, c.local_users_changed_attrs,
+                             c.local_groups_ops['add'], c.local_groups_ops['rm'])
+
+    # plan mode: the changes are not applied yet, the watermark is not moved 
+    lpc.incremental_cycle_end(ldap_ok and c.sync_mode != 'plan')
 
+    # persist the mapped users cache (if enabled)
+    mc.save()
 
-def main_loop():
+    return plan_ok
+
+def main_loop(changed_dns=None):
     """ Main LDAP synchronization function get users from LDAP and sends to SCIM
-        deleting, changing, and creating users
+        deleting, changing, and creating users (plan mode: the operations are written in the 
+        sync plan). scim_api.engine: async runs the cycle by aio_main_loop.
         
         It also invokes plugin before/after functions. 
+
+        Args:
+            changed_dns: (optional, default: None) if provided only the changed LDAP entries 
+                         are retrieved and mapped (targeted delta cycle)
+
+        Returns:
+            False if the sync plan cannot be written (plan mode), True otherwise
     """
+    if c.scim_config.get('engine', 'sync') == 'async':
+        # async engine (httpx loaded only if used)
+        from libs import async_api
+        return async_api.run(aio_main_loop, changed_dns)
+
+    _sync_cycle_start(changed_dns)
 
     ldap_ok = c.ldap_plugin.ldap_get_users()
 
     if ldap_ok:
+        _map_ldap_users()
 
-        # TODO remove
-        # if c.user_management_api == 'det':
-        #     # DET APIs
-            
-        #     # map the LDAP user fields on the MLDE DET fields
-        #     c.ldap_plugin.ldap_to_det_mapping()
-        #     #TODO c.ldap_plugin.ldap_to_det_mapping()
-
-        #     # get the users list form the platform using DET API
-        #     det_api_ok = get_det_users()
-             
-        #     if det_api_ok \
-        #         and c.curr_local_users is not None and len(c.local_users) > 0:
-        #         # for each user in LDAP derived user list define what to do on the DET API
-        #         compare_det_users()
-                    
-        #         # then execute the changes on the platform user list
-        #         if c.custom_plugin is not None:
-        #             c.custom_plugin.before_send_all_users()
-                
-        #         send_det_update()
-                
-        #         if c.custom_plugin is not None:
-        #             c.custom_plugin.after_send_all_users()
-        # else:
+        # users on the platform index, filled as the SCIM users are received
+        curr_users_index = CurrUsersIndex()
 
-        # SCIM APIs
+        # get the users list form the platform using SCIM API 
+        # (few changed users: targeted lookups of the changed users only)
+        lookup = is_scim_lookup_cycle()
+        if lookup:
+            resp = lookup_scim_users(curr_users_index)
 
-        # map the LDAP user fields on the MLDE SCIM fields
-        c.ldap_plugin.ldap_to_scim_mapping()
+            if resp['http_status'] not in [200,201,202]:
+                # targeted lookups failed (e.g., filter not supported): full SCIM user list
+                _log_lookup_fallback(resp['http_status'])
+                lookup = False
+                curr_users_index = CurrUsersIndex()
 
-        # get the users list form the platform using SCIM API
-        resp = get_scim_users()
-        scim_ok = resp['http_status'] in [200,201,202]
+        if not lookup:
+            resp = get_scim_users(curr_users_index)
 
-        if scim_ok \
-            and c.curr_local_users is not None and len(c.local_users) > 0:
-
-            # for each user in LDAP derived user list define what to do on the SCIM API
-            compare_scim_users()
-                
+        if _compare_scim_users_resp(resp, lookup, curr_users_index) and c.sync_mode != 'plan':
             # then execute the changes on the platform user list
             if c.custom_plugin is not None:
                 c.custom_plugin.before_send_all_users()
@@ -332,8 +1175,7 @@ def main_loop():
                 c.custom_plugin.after_send_all_users()
 
         # verify if auto assign of MLDE group is active and execute it
-        if 'auto_assign_mlde_groups' in c.det_config \
-            and 'enabled' in c.det_config['auto_assign_mlde_groups'] \
-            and c.det_config['auto_assign_mlde_groups']['enabled']:
+        if _is_auto_assign_enabled():
             auto_assign_mlde_groups()
 
+    return _sync_cycle_end(ldap_ok)
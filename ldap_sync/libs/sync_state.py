@@ -0,0 +1,94 @@
+#
+# Sync state module
+# Local state file (JSON) persisted between sync cycles and restarts
+#
+
+import os
+
+from libs import common as c
+from libs import json_codec as jc
+
+STATE_FILE = "ldap_sync_state.json"  # default path relative to the main file
+
+state = {}          # current state
+state_filename = "" # state file full pathname
+
+def load(state_file_path=None):
+    """ Loads the state file
+
+        Args:
+            state_file_path: (optional str) full or relative (to the main file) pathname of the state file,
+            if not provided state file path: current dir + '/' + STATE_FILE
+
+        Returns:
+            True if the state file is loaded
+            False if the state file does not exist or in case of errors (empty state)
+    """
+    global state, state_filename
+
+    if state_file_path is not None and isinstance(state_file_path, str) and len(state_file_path) > 0:
+        if os.path.isabs(state_file_path):
+            state_filename = state_file_path
+        else:
+            state_filename = os.path.join(c.curr_dir, state_file_path)
+    else:
+        state_filename = os.path.join(c.curr_dir, STATE_FILE)
+
+    state = {} # reset
+
+    if not os.path.exists(state_filename):
+        c.logger.info("State file [%s] not found - empty state" % state_filename)
+        return False
+
+    try:
+        with open(state_filename, 'rb') as fd:
+            state = jc.loads(fd.read())
+
+        c.logger.info("State file [%s] loaded" % state_filename)
+        return True
+
+    except Exception as e:
+        c.logger.error("Error loading state file [%s] - error: %s - empty state" % (state_filename, e))
+        state = {}
+        return False
+
+def save():
+    """ Saves the state file (atomic replace)
+
+        Returns:
+            True if saved, False in case of errors
+    """
+    if not state_filename:
+        return False
+
+    try:
+        tmp_filename = state_filename + '.tmp'
+        with open(tmp_filename, 'wb') as fd:
+            fd.write(jc.dumps(state))
+        os.replace(tmp_filename, state_filename)
+        return True
+
+    except Exception as e:
+        c.logger.error("Error saving state file [%s] - error: %s" % (state_filename, e))
+        return False
+
+def get(key, default=None):
+    """ Gets a state value
+
+        Args:
+            key: state key
+            default: (optional, default: None) value returned if the key is not in the state
+
+        Returns:
+            state value
+    """
+    return state.get(key, default)
+
+def set(key, value):
+    """ Sets a state value (use save() to persist it)
+
+        Args:
+            key: state key
+            value: JSON serializable value
+    """
+    state[key] = value
@@ -4,18 +4,85 @@
 #
 # ref :https://learn.microsoft.com/en-us/troubleshoot/windows-server/identity/useraccountcontrol-manipulate-account-properties
 
-import sys
+import re
+import time
 import codecs
+import ldap
+
+from ldap.filter import escape_filter_chars
+from ldap.controls import RequestControl, ResponseControl, KNOWN_RESPONSE_CONTROLS
+from pyasn1.type import univ, namedtype
+from pyasn1.codec.ber import encoder, decoder
 
 from libs import ldap_helper as lh
 from libs import common as c
 from libs import ldap_plugin_common as lpc
+from libs import mapping_cache as mc
+
+# DirSync (ldap.dirsync)
+LDAP_SERVER_DIRSYNC_OID = '1.2.840.113556.1.4.841'
+LDAP_DIRSYNC_OBJECT_SECURITY = 0x00000001
+DIRSYNC_BACKLINK_ATTRS = ['memberOf']   # back-link attrs are not returned by DirSync
+LDAP_SERVER_SHOW_DELETED_OID = '1.2.840.113556.1.4.417'   # deleted objects (tombstones) returned by the search
+MEMBER_OF_CLAUSE_RE = re.compile(r'\(memberOf(?::[0-9.]+:)?=([^)]+)\)', re.IGNORECASE)    # groups of the users filter
+
+dirsync_cookie = b''        # DirSync cookie of the last cycle
+dirsync_entries = {}        # cached LDAP user entries by objectGUID (full view merged with the DirSync changes)
+dirsync_dns = {}            # DNs of the cached LDAP user entries by objectGUID
+dirsync_cycles = 0          # DirSync cycles since the last full refresh
+
+# change notifications (ldap.notify)
+LDAP_SERVER_NOTIFICATION_OID = '1.2.840.113556.1.4.528'
+NOTIFY_SCOPES = {'base': ldap.SCOPE_BASE, 'onelevel': ldap.SCOPE_ONELEVEL, 'subtree': ldap.SCOPE_SUBTREE}
+
+# group membership (det_api.auto_assign_mlde_groups.membership: group)
+LDAP_MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+group_members_cache = {}    # transitive members by group DN: {'whenChanged', 'time', 'members'}
+
+class _DirSyncValue(univ.Sequence):
+    """ DirSync control value (request: flags, max bytes, cookie - response: more results, unused, cookie)
+    """
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('flags', univ.Integer()),
+        namedtype.NamedType('maxBytes', univ.Integer()),
+        namedtype.NamedType('cookie', univ.OctetString()),
+    )
+
+class DirSyncControl(RequestControl, ResponseControl):
+    """ MS A/D DirSync control (LDAP_SERVER_DIRSYNC_OID)
+    """
+    controlType = LDAP_SERVER_DIRSYNC_OID
+
+    def __init__(self, criticality=True, flags=0, max_bytes=0x7FFFFFFF, cookie=b''):
+        self.criticality = criticality
+        self.flags = flags
+        self.max_bytes = max_bytes
+        self.cookie = cookie
+        self.more_results = False
+
+    def encodeControlValue(self):
+        value = _DirSyncValue()
+        value.setComponentByName('flags', self.flags)
+        value.setComponentByName('maxBytes', self.max_bytes)
+        value.setComponentByName('cookie', univ.OctetString(self.cookie))
+        return encoder.encode(value)
+
+    def decodeControlValue(self, encodedControlValue):
+        value, _ = decoder.decode(encodedControlValue, asn1Spec=_DirSyncValue())
+        self.more_results = bool(int(value.getComponentByName('flags')))
+        self.cookie = bytes(value.getComponentByName('cookie'))
+
+KNOWN_RESPONSE_CONTROLS[DirSyncControl.controlType] = DirSyncControl
 
 def init(*args, **kwargs):
-    """ Module init not implemented
+    """ Module init 
     """
     c.logger.debug("%s %s" % (args, kwargs))
 
+    if _is_dirsync_enabled() and lpc.is_incremental_enabled():
+        c.logger.warning("DirSync enabled - ldap.incremental is ignored by the DirSync retrieval")
+
 def main(*args, **kwargs):
     """ Module main not implemented
     """
@@ -30,18 +97,431 @@ def ldap_get_users():
 
     c.ldap_users = [] # reset
 
+    if c.ldap_config_users.get('streaming', False):
+        # streaming: entries are mapped on SCIM users while they are received
+        c.local_users = [] # reset
+        handler = c.ldap_plugin.ldap_user_scim_handler
+    else:
+        handler = c.ldap_plugin.ldap_user_handler
+
+    if _is_dirsync_enabled():
+        return _ldap_dirsync_users(handler)
+
     resp_ok = lh.ldap_retrieve_users(   c.ldap_config_auth['url'],
                                         c.ldap_config_auth['user'],
                                         c.ldap_config_auth['password'],
                                         c.ldap_config_users['dn'],
-                                        c.ldap_config_users['attr'],
-                                        c.ldap_config_users['filter'],
+                                        lpc.get_users_attrs(),
+                                        lpc.get_users_filter(),
                                         c.ldap_config_auth['tls'], 
-                                        handle_entry = c.ldap_plugin.ldap_user_handler
+                                        handle_entry = handler,
+                                        page_size = c.ldap_config_users.get('page_size', 0),
+                                        shard_attr = c.ldap_config_users.get('shard_by'),
+                                        max_workers = c.ldap_config_users.get('max_workers', 1),
+                                        range_batch_size = c.ldap_config_users.get('range_batch_size', 100)
                                         )
     
     return resp_ok
 
+def _is_dirsync_enabled():
+    """ (private) Checks if the DirSync retrieval is enabled in configuration (ldap.dirsync.enabled)
+    """
+    return 'dirsync' in c.ldap_config and c.ldap_config['dirsync'].get('enabled', False)
+
+def _guid_filter(guids):
+    """ (private) LDAP filter matching a list of binary objectGUIDs
+    """
+    return '(|%s)' % ''.join('(objectGUID=%s)' % ''.join('\\%02x' % b for b in guid) for guid in guids)
+
+def _filter_clause(search_filter):
+    """ (private) LDAP filter as a parenthesized clause (RFC 4515 filters can omit the outer parentheses)
+    """
+    search_filter = search_filter.strip()
+    return search_filter if search_filter.startswith('(') else '(%s)' % search_filter
+
+def _is_deleted(entry):
+    """ (private) Checks if a DirSync entry is a deleted object (tombstone)
+    """
+    return any(v.upper() == b'TRUE' for v in entry.get('isDeleted', []))
+
+def _filter_group_dns(search_filter):
+    """ (private) Groups of the memberOf clauses of an LDAP filter (in-chain clauses included)
+
+        Returns:
+            {lower case group DN: group DN as in the filter}
+    """
+    return {dn.lower(): dn for dn in MEMBER_OF_CLAUSE_RE.findall(search_filter)}
+
+def _dirsync_membership_changes(group_members):
+    """ (private) Compares the members of the changed filter groups with the cached view
+
+        Args:
+            group_members: {lower case group DN: list of member DNs} of the filter groups 
+                           returned by the DirSync search
+
+        Returns:
+            (GUIDs of the cached users removed from a group, 
+             GUIDs of the cached users added to a group, 
+             DNs of the members not in the cached view)
+    """
+    removed_guids = set()
+    added_guids = set()
+    cached_dns = set()
+
+    members_lower = {group_dn: {dn.lower() for dn in members} for group_dn, members in group_members.items()}
+
+    for guid, dn in dirsync_dns.items():
+        cached_dns.add(dn.lower())
+        member_of = {codecs.decode(v, 'utf-8').lower() for v in dirsync_entries[guid].get('memberOf', [])}
+
+        for group_dn, members in members_lower.items():
+            if dn.lower() in members:
+                if group_dn not in member_of:
+                    added_guids.add(guid)
+            elif group_dn in member_of:
+                removed_guids.add(guid)
+
+    new_dns = []
+    for members in group_members.values():
+        for dn in members:
+            if dn.lower() not in cached_dns:
+                cached_dns.add(dn.lower())
+                new_dns.append(dn)
+
+    return removed_guids, added_guids - removed_guids, new_dns
+
+def _ldap_dirsync_users(handle_entry):
+    """ (private) DirSync retrieval - gets the users changed since the last DirSync cookie, 
+        merges the changed attributes in the cached user entries and passes the full cached 
+        view to the handler (the SCIM diff sees the same users as a full retrieval).
+
+        Without a cached view (e.g., at start-up) or every ldap.dirsync.full_sync_every cycles 
+        the cookie is reset, so DirSync returns all the users.
+
+        DirSync returns only the changed attrs: the entries not in the cached view (new users or 
+        users that newly match the filter) are read in full by a base scope search of their DN.
+        The deleted users (tombstones) are requested by the show deleted control and an 
+        isDeleted filter clause, they are removed from the cached view.
+
+        DirSync does not return back-link attrs (memberOf), they are retrieved by a regular 
+        search of the changed users only. A user added/removed to/from a group does not change 
+        the user object: the groups of the users filter (memberOf clauses) are requested to 
+        DirSync too, if their members changed the cached users removed from a group are checked 
+        again against the users filter by a base scope search (the ones not matching anymore are 
+        removed from the cached view, so they are deactivated by the sync), the new members are 
+        read in full. The other group memberships are aligned by the full refresh.
+
+        Args:
+            handle_entry: LDAP entries' processing handler
+
+        Returns:
+            True if LDAP retrieval ok
+            False if error occurs 
+    """
+    global dirsync_cookie, dirsync_entries, dirsync_dns, dirsync_cycles
+
+    dirsync_config = c.ldap_config['dirsync']
+    full_sync_every = dirsync_config.get('full_sync_every', 24)
+
+    full_refresh = not dirsync_entries or (full_sync_every > 0 and dirsync_cycles >= full_sync_every)
+
+    if full_refresh:
+        c.logger.info("DirSync - full refresh")
+        dirsync_cookie = b''
+        dirsync_entries = {}
+        dirsync_dns = {}
+        dirsync_cycles = 0
+    else:
+        dirsync_cycles += 1
+
+    attrs = lpc.get_users_attrs()
+    dirsync_attrs = [a for a in attrs if a not in DIRSYNC_BACKLINK_ATTRS] + ['objectGUID', 'isDeleted']
+    backlink_attrs = [a for a in attrs if a in DIRSYNC_BACKLINK_ATTRS]
+
+    entry_attrs = [a for a in dirsync_attrs if a != 'isDeleted']
+
+    flags = LDAP_DIRSYNC_OBJECT_SECURITY if dirsync_config.get('object_security', True) else 0
+
+    # the tombstones lose most attributes (e.g., objectCategory), so they do not match the users filter
+    group_dns = _filter_group_dns(c.ldap_config_users['filter'])
+    group_clauses = ''.join('(distinguishedName=%s)' % dn for dn in group_dns.values())
+    dirsync_filter = '(|%s(isDeleted=TRUE)%s)' % (_filter_clause(c.ldap_config_users['filter']), group_clauses)
+    if group_dns:
+        dirsync_attrs.append('member')
+    show_deleted_ctrl = RequestControl(LDAP_SERVER_SHOW_DELETED_OID, criticality=False)
+
+    pool = lh.ldap_get_config_pool()
+
+    try:
+        with pool.connection() as l:
+
+            def _read_entry(dn):
+                # full entry if it matches the users filter (base scope search of its DN)
+                try:
+                    entries = list(lh.ldap_search_entries(l, dn, ldap.SCOPE_BASE, c.ldap_config_users['filter'], entry_attrs))
+                except ldap.NO_SUCH_OBJECT:
+                    entries = []    # moved or deleted after the DirSync search (next cycle)
+
+                return entries[0][1] if entries else None
+
+            changed_guids = set()
+            new_dns = {}    # DNs of the changed entries not in the cached view, by objectGUID
+            group_members = {}  # members of the changed filter groups
+            cookie = dirsync_cookie
+
+            while True:
+                dirsync_ctrl = DirSyncControl(flags=flags, cookie=cookie)
+                result_ctrls = []
+
+                # DirSync requires the root of the naming context as base DN
+                for dn, entry in lh.ldap_search_entries(l, dirsync_config['base_dn'], ldap.SCOPE_SUBTREE,
+                                                        dirsync_filter, dirsync_attrs,
+                                                        serverctrls=[dirsync_ctrl, show_deleted_ctrl], 
+                                                        result_ctrls=result_ctrls):
+                    if dn.lower() in group_dns:
+                        if 'member' in entry:
+                            c.logger.debug('DirSync - changed group members: %s' % dn)
+                            group_members[dn.lower()] = [codecs.decode(v, 'utf-8') for v in entry['member']]
+                        continue
+
+                    if 'objectGUID' not in entry:
+                        continue
+
+                    guid = entry['objectGUID'][0]
+
+                    if _is_deleted(entry):
+                        c.logger.debug('DirSync - deleted entry: %s' % dn)
+                        dirsync_entries.pop(guid, None)
+                        dirsync_dns.pop(guid, None)
+                        changed_guids.discard(guid)
+                        new_dns.pop(guid, None)
+                        continue
+
+                    changed_guids.add(guid)
+
+                    if not full_refresh and guid not in dirsync_entries:
+                        # only the changed attrs are returned, the full entry is read below
+                        c.logger.debug('DirSync - new entry: %s' % dn)
+                        new_dns[guid] = dn
+                        continue
+
+                    c.logger.debug('DirSync - changed entry: %s' % dn)
+                    dirsync_dns[guid] = dn
+                    cached = dirsync_entries.setdefault(guid, {})
+                    for k, e in entry.items():
+                        if e:
+                            cached[k] = e
+                        else:
+                            cached.pop(k, None)     # attr value removed
+
+                resp_ctrls = [ctrl for ctrl in result_ctrls if ctrl.controlType == LDAP_SERVER_DIRSYNC_OID]
+                if not resp_ctrls:
+                    c.logger.error('LDAP server ignored the DirSync control')
+                    return False
+
+                cookie = resp_ctrls[0].cookie
+                if not resp_ctrls[0].more_results:
+                    break
+
+            # full entries of the users not in the cached view
+            for guid, dn in new_dns.items():
+                entry = _read_entry(dn)
+                if entry is not None:
+                    dirsync_entries[guid] = entry
+                    dirsync_dns[guid] = dn
+                else:
+                    c.logger.debug('DirSync - entry not matching the users filter: %s' % dn)
+                    changed_guids.discard(guid)
+
+            # members of the changed filter groups
+            if group_members and not full_refresh:
+                removed_guids, added_guids, member_dns = _dirsync_membership_changes(group_members)
+
+                # users removed from a group: checked again against the users filter
+                for guid in removed_guids:
+                    entry = _read_entry(dirsync_dns[guid])
+                    if entry is not None:
+                        dirsync_entries[guid] = entry
+                        changed_guids.add(guid)
+                    else:
+                        c.logger.debug('DirSync - entry leaving the users filter: %s' % dirsync_dns[guid])
+                        dirsync_entries.pop(guid)
+                        dirsync_dns.pop(guid)
+                        changed_guids.discard(guid)
+
+                # cached users added to a group: memberOf updated below
+                changed_guids.update(added_guids)
+
+                # new members not in the cached view
+                for dn in member_dns:
+                    entry = _read_entry(dn)
+                    if entry is not None and 'objectGUID' in entry:
+                        c.logger.debug('DirSync - new group member: %s' % dn)
+                        guid = entry['objectGUID'][0]
+                        dirsync_entries[guid] = entry
+                        dirsync_dns[guid] = dn
+                        changed_guids.add(guid)
+
+            # back-link attrs of the changed users (all the users if full refresh)
+            if backlink_attrs and changed_guids:
+                if full_refresh:
+                    backlink_filters = [c.ldap_config_users['filter']]
+                else:
+                    guids = list(changed_guids)
+                    batch_size = dirsync_config.get('backlink_batch_size', 500)
+                    backlink_filters = [_guid_filter(guids[i:i+batch_size]) for i in range(0, len(guids), batch_size)]
+
+                backlink_entries = []
+                for backlink_filter in backlink_filters:
+                    backlink_entries.extend(item for base_dn, search_filter in lh.ldap_search_shards(c.ldap_config_users['dn'], backlink_filter)
+                                                 for item in lh.ldap_search_entries(l, base_dn, ldap.SCOPE_SUBTREE,
+                                                                                    search_filter, ['objectGUID'] + backlink_attrs,
+                                                                                    page_size=c.ldap_config_users.get('page_size', 0)))
+
+                # memberOf above 1500 values is returned by ranges
+                lh.ldap_resolve_ranged_attrs(l, [item for item in backlink_entries if lh.ldap_has_ranged_attrs(item[1])],
+                                             c.ldap_config_users.get('range_batch_size', 100))
+
+                for dn, entry in backlink_entries:
+                    cached = dirsync_entries.get(entry['objectGUID'][0])
+                    if cached is not None:
+                        for a in backlink_attrs:
+                            if a in entry:
+                                cached[a] = entry[a]
+                            else:
+                                cached.pop(a, None)
+
+    except ldap.INVALID_CREDENTIALS:
+        c.logger.error( "Incorrect LDAP credentials" )
+        return False
+
+    except ldap.LDAPError as e:
+        c.logger.error( e )
+        return False
+
+    # the cycle is completed - keep the new cookie for the next cycle
+    dirsync_cookie = cookie
+
+    c.logger.info("DirSync - changed users: %d - cached users: %d" % (len(changed_guids), len(dirsync_entries)))
+
+    for entry in dirsync_entries.values():
+        handle_entry(entry)
+
+    return True
+
+def ldap_get_group_members(group_names):
+    """ Group-centric membership - resolves the transitive members (nested groups included) of the 
+        LDAP groups with the given names (cn), by the LDAP_MATCHING_RULE_IN_CHAIN matching rule.
+
+        The members of each group are cached and resolved again only if the group whenChanged 
+        changes or after det_api.auto_assign_mlde_groups.cache_ttl seconds (a nested group 
+        change does not change the parent group whenChanged).
+        Groups are searched under det_api.auto_assign_mlde_groups.group_dn (default: ldap.users.dn),
+        the members are the users of ldap.users.dn matching ldap.users.filter (the synced users).
+
+        Args:
+            group_names: list of group names (e.g., the groups existing on the platform)
+
+        Returns:
+            dict {group name: set of userNames} (userName LDAP attr from scim_api.attr_mapping)
+            None if error occurs 
+    """
+    global group_members_cache
+
+    if not group_names:
+        return {}
+
+    assign_config = c.det_config['auto_assign_mlde_groups']
+    group_dn = assign_config.get('group_dn', c.ldap_config_users['dn'])
+    cache_ttl = assign_config.get('cache_ttl', 3600)
+    user_name_attr = lpc.get_ldap_field(c.scim_config['attr_mapping']['userName'])
+    page_size = c.ldap_config_users.get('page_size', 0)
+
+    pool = lh.ldap_get_config_pool()
+    now = time.time()
+
+    group_filter = '(&(objectClass=group)(|%s))' % ''.join('(cn=%s)' % escape_filter_chars(n) for n in group_names)
+
+    group_members = {}
+    cache = {}
+
+    try:
+        groups = list(lh.ldap_search_failover(pool, lh.ldap_search_shards(group_dn, group_filter), 
+                                              ldap.SCOPE_SUBTREE, ['cn', 'whenChanged'], page_size))
+
+        for dn, entry in groups:
+            group_name = codecs.decode(entry['cn'][0], 'utf-8')
+            when_changed = entry.get('whenChanged', [b''])[0]
+            cached = group_members_cache.get(dn)
+
+            if cached is None or cached['whenChanged'] != when_changed or now - cached['time'] > cache_ttl:
+                # resolve the transitive members
+                member_filter = '(&%s(memberOf:%s:=%s))' % (_filter_clause(c.ldap_config_users['filter']), 
+                                                             LDAP_MATCHING_RULE_IN_CHAIN, escape_filter_chars(dn))
+                members = set()
+
+                for _, user_entry in lh.ldap_search_failover(pool, lh.ldap_search_shards(c.ldap_config_users['dn'], member_filter), 
+                                                             ldap.SCOPE_SUBTREE, [user_name_attr], page_size):
+                    if user_name_attr in user_entry:
+                        members.add(codecs.decode(user_entry[user_name_attr][0], 'utf-8').strip())
+
+                cached = {'whenChanged': when_changed, 'time': now, 'members': members}
+                c.logger.debug("Group [%s] members resolved: %d" % (group_name, len(members)))
+
+            cache[dn] = cached
+            group_members.setdefault(group_name, set()).update(cached['members'])
+
+    except ldap.LDAPError as e:
+        c.logger.error( e )
+        return None
+
+    group_members_cache = cache     # groups not on the platform anymore are dropped
+
+    return group_members
+
+def ldap_watch_changes(base_dn, on_change):
+    """ MS A/D change notifications (LDAP_SERVER_NOTIFICATION_OID) - calls on_change(dn) for each 
+        object changed under base_dn. It runs on a dedicated connection (not pooled) until the 
+        server closes the notification search or an error occurs.
+        Scope from ldap.notify.scope: base, onelevel (default), subtree (MS A/D limits the subtree 
+        scope, see the LDAP_SERVER_NOTIFICATION_OID documentation).
+
+        Args:
+            base_dn: DN of the watched object/container
+            on_change: change handler, called with the changed object DN
+
+        Raises:
+            ldap.LDAPError exceptions 
+    """
+    scope = NOTIFY_SCOPES[c.ldap_config['notify'].get('scope', 'onelevel')]
+
+    pool = lh.ldap_get_config_pool()
+    url = pool.ranked_urls()[0]
+
+    # no operations timeout - the notification search waits for the changes
+    l = lh.ldap_connect(url, c.ldap_config_auth['user'], c.ldap_config_auth['password'], c.ldap_config_auth['tls'])
+
+    try:
+        notify_ctrl = RequestControl(LDAP_SERVER_NOTIFICATION_OID, True)
+        msgid = l.search_ext(base_dn, scope, '(objectClass=*)', ['objectClass'], serverctrls=[notify_ctrl])
+
+        while True:
+            rtype, rdata, _, _ = l.result3(msgid, all=0, timeout=-1)
+
+            if rtype == ldap.RES_SEARCH_RESULT:
+                c.logger.warning("LDAP change notifications [%s] - search closed by the server" % base_dn)
+                break
+
+            if rtype == ldap.RES_SEARCH_ENTRY:
+                for dn, _ in rdata:
+                    c.logger.debug("LDAP change notification: %s" % dn)
+                    on_change(dn)
+    finally:
+        try:
+            l.unbind_s()
+        except ldap.LDAPError:
+            pass
+
 def ldap_user_handler(entry):
     """ Process each LDAP entry creating an ldap_users[] item
 
@@ -52,8 +532,76 @@ def ldap_user_handler(entry):
     for k, e in entry.items():
         ldap_user[k] = e    # raw
 
+    lpc.track_watermark(ldap_user)
     c.ldap_users.append(ldap_user)
     c.logger.debug("Retrieved LDAP User info: %s" % ldap_user)     
+
+def ldap_user_scim_handler(entry):
+    """ Streaming mode - process each LDAP entry mapping it directly on a local_users[] SCIM user,
+        the raw LDAP entry is not stored in ldap_users[]
+
+        Args:
+            entry: LDAP user entry
+    """
+    c.logger.debug("Retrieved LDAP User info: %s" % entry)
+    lpc.track_watermark(entry)
+    c.local_users.append(ldap_user_to_scim(entry))
+
+def ldap_field_mappers():
+    """ MS A/D specific mappers of the compiled attr_mapping (see ldap_plugin_common.compile_attr_mapping)
+            - MS A/D LDAP: userAccount control -> SCIM: active
+            - MS A/D LDAP: memberOf -> SCIM memberOf
+
+        Returns:
+            {SCIM key: function(k, v) returning the mapper function or None (common mapping)}
+    """
+
+    def _active_mapper(k, v):
+        if not (isinstance(v, str) and v.lower() == '${useraccountcontrol}'):
+            return None
+
+        decode = lpc.compile_ldap_field_decoder(lpc.get_ldap_field(v))
+
+        def _map_active(ldap_user, scim_user):
+            # MS A/D specific userAccountControl binary flag (0x0002) => ACCOUNT DISABLE
+            # conversion to the SCIM 'active' filed spec (bool)
+            account_disable = bool( int(decode(ldap_user)) & 0x0002 )      # bit 2 ACCOUNTDISABLE
+            scim_user[k] = not account_disable
+
+        return _map_active
+
+    def _member_of_mapper(k, v):
+        if not (isinstance(v, str) and lpc.is_ldap_field(v)):
+            return None
+
+        f = lpc.get_ldap_field(v)
+
+        def _map_member_of(ldap_user, scim_user):
+            # MS A/D specific membersOf field (probably not the only in MS A/D) 
+            # memebersOf of is a list of groups DN
+            scim_user[k] = [codecs.decode(x, 'utf-8') for x in ldap_user.get(f, [])]  # list of groups
+
+        return _map_member_of
+
+    return {
+        'active': _active_mapper,
+        'memberOf': _member_of_mapper
+    }
+
+def ldap_user_to_scim(ldap_user):
+    """ Maps an LDAP user on a SCIM user by the compiled attr_mapping (see ldap_to_scim_mapping),
+        unchanged users are returned by the mapping cache (scim_api.mapping_cache)
+
+        Args:
+            ldap_user: LDAP user entry
+
+        Returns:
+            SCIM user record (scim.UserRecord)
+    """
+    scim_user = mc.map_user(ldap_user, lpc.map_ldap_user)
+
+    c.logger.debug("Mapping - SCIM User info: %s", scim_user)
+    return scim_user
  
 def ldap_to_scim_mapping():
     """ MS A/D LDAP to SCIM mapping function.
@@ -68,38 +616,18 @@ def ldap_to_scim_mapping():
             - MS A/D LDAP: mail -> SCIM: emails = [{value: <email addr>, type: 'work', primary: True}] = emails.work.value
             - MS A/D LDAP: first/last name (givenName/sn) -> SCIM: name: name = { givenName: <value>, familyName: <value> }
     """
+    if c.ldap_config_users.get('streaming', False):
+        # streaming: users already mapped by ldap_user_scim_handler during the LDAP retrieval
+        c.logger.debug("Mapping - SCIM Users count: %d (streaming)" % len(c.local_users))
+        return
+
     c.logger.debug("Mapping - LDAP Users count: %d" % len(c.ldap_users))
     
     c.local_users = [] # reset
 
     for ldap_user in c.ldap_users:
-        c.logger.debug("Mapping - LDAP User info: %s" % ldap_user)
-
-        scim_user = {}
-        
-        for k,v in c.scim_config['attr_mapping'].items():
-            # k = SCIM side, v = LDAP field or const
-
-            if k == 'active' and v.lower() == '${useraccountcontrol}':
-                # MS A/D specific userAccountControl binary flag (0x0002) => ACCOUNT DISABLE
-                # conversion to the SCIM 'active' filed spec (bool)
-                account_disable =  bool( int(lpc.get_config_mapping_value(v, ldap_user)) & 0x0002 )      # bit 2 ACCOUNTDISABLE
-                if account_disable:
-                    scim_user[k] = False
-                else:
-                    scim_user[k] = True
-
-            elif k == 'memberOf' and  lpc.is_ldap_field(v):
-                # MS A/D specific membersOf field (probably not the only in MS A/D) 
-                # memebersOf of is a list of groups DN
-                scim_user[k] = list(map(lambda x: codecs.decode(x, 'utf-8'), ldap_user[lpc.get_ldap_field(v)]))  # list of groups
-
-            else:
-                # SCIM common 
-                scim_user = lpc.scim_common_mapping(k, v, scim_user, ldap_user)
-
-        c.logger.debug("Mapping - SCIM User info: %s" % scim_user)
-        c.local_users.append(scim_user)
+        c.logger.debug("Mapping - LDAP User info: %s", ldap_user)
+        c.local_users.append(ldap_user_to_scim(ldap_user))
     
     c.logger.debug("Mapping - SCIM Users count: %d" % len(c.local_users))
 
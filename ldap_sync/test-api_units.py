@@ -0,0 +1,372 @@
+#
+# API helpers unit testing
+# Checks of the SCIM client, request/response helpers and rate limiter on stub HTTP sessions,
+# no SCIM or Det API service is contacted: python test-api_units.py (or python -m pytest test-api_units.py)
+#
+import json
+import time
+import logging
+import contextlib
+import requests
+
+from email.utils import formatdate
+
+from libs import common as c
+from libs import scim
+from libs import scim_helper as sh
+from libs import rate_limiter as rl
+
+SCIM_URL = 'http://localhost:8080/scim/v2'
+USERS_URL = SCIM_URL + scim.User.URI
+
+
+class StubResponse:
+    """ HTTP response of the stub session
+    """
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode() if body is not None else b''
+        self.text = self.content.decode()
+        self.headers = headers or {}
+
+class StubSession:
+    """ HTTP session returning the queued responses (or raising the queued exceptions),
+        the requests are recorded
+    """
+
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.requests = []      # (method, url, kwargs)
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        resp = self.responses.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+def _user(n, **fields):
+    user = {
+            "userName": "user%d@domain.internal" % n,
+            "displayName": "user %d" % n,
+            "name": {
+                "givenName"  : "User-First-Name",
+                "familyName" : "User-Last-Name",
+            },
+            "emails": [{
+                "value" : "user-%d@domain.internal" % n,
+                "type" : "work",
+                "primary" : True
+            }],
+            "active": True
+    }
+    user.update(fields)
+    return user
+
+@contextlib.contextmanager
+def _patched(obj, name, value):
+    saved = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, saved)
+
+@contextlib.contextmanager
+def _scim_client(responses, scim_config=None):
+    # SCIM client on a stub session (c.scim_client)
+    access = {'url': SCIM_URL, 'type': 'basic', 'headers': {'Content-Type': 'application/scim+json'}, 'credentials': ('user', 'pw')}
+    client = sh.SCIMClient(access, pool_size=2, timeout=(1, 2))
+    client.session = StubSession(responses)
+
+    with _patched(c, 'scim_client', client), _patched(c, 'scim_config', scim_config or {}):
+        yield client.session
+
+def test_scim_client():
+    created = dict(_user(1), id='id-1')
+
+    with _scim_client([StubResponse(201, created), StubResponse(200, created), requests.exceptions.Timeout()]) as session:
+        # the requests share the client session and timeouts
+        assert sh.exec_scim_user_api_req(scim.UserRecord(_user(1)), op='add') == {'http_status': 201, 'scim_user': created}
+        assert sh.exec_scim_user_api_req(created, op='get') == {'http_status': 200, 'scim_user': created}
+        assert sh.exec_scim_user_api_req(created, op='delete')['http_status'] is None     # PATCH: not retried
+
+        method, url, kwargs = session.requests[0]
+        assert (method, url, kwargs['timeout']) == ('POST', USERS_URL, (1, 2))
+        assert json.loads(kwargs['data'])['userName'] == 'user1@domain.internal'
+        assert session.requests[1][:2] == ('GET', USERS_URL + '/id-1')
+        assert session.requests[2][:2] == ('PATCH', USERS_URL + '/id-1')
+
+    # HTTP errors
+    with _scim_client([StubResponse(409, {'detail': 'conflict'})]):
+        assert sh.exec_scim_user_api_req(_user(1), op='add') == {'http_status': 409, 'scim_user': {}}
+
+def test_users_page_next():
+    users = [_user(1), _user(2)]
+
+    assert sh.users_page_next(1, 2, 5, users) == 3
+    assert sh.users_page_next(3, 2, 5, users) == 5
+    assert sh.users_page_next(5, 2, 5, users[:1]) is None    # last page
+    assert sh.users_page_next(1, 2, 2, users) is None        # single page
+    assert sh.users_page_next(1, 2, 5, []) is None           # empty page
+    assert sh.users_page_next(1, 0, 5, users) is None        # no pagination
+    assert sh.users_page_next(1, 5, 5, users) == 3           # page limited by the server
+
+def test_users_list_complete():
+    seen_ids = set()
+    page1 = sh.users_page_unique([{'id': '1'}, {'id': '2'}], seen_ids)
+    page2 = sh.users_page_unique([{'id': '2'}, {'id': '3'}], seen_ids)   # shifted offset
+    assert [u['id'] for u in page1 + page2] == ['1', '2', '3']
+
+    assert sh.users_list_complete([3, 3], len(seen_ids))
+    assert not sh.users_list_complete([3, 4], len(seen_ids))     # changed while paging
+    assert not sh.users_list_complete([4, 4], len(seen_ids))     # missing users
+
+def test_get_scim_users_retry():
+    users = [_user(n, id='id-%d' % n) for n in range(1, 5)]
+
+    def _page(total, page_users):
+        return StubResponse(200, {'totalResults': total, 'Resources': page_users})
+
+    # changed while paging: requested again (list_retries), then by a single unpaged request
+    responses = [_page(3, users[:2]), _page(4, users[2:]),      # user created
+                 _page(4, users[:2]), _page(3, users[3:]),      # user deleted
+                 _page(3, users[:3])]
+    indexed = []
+
+    with _scim_client(responses, {'page_size': 2, 'list_retries': 1}) as session:
+        resp = sh.get_scim_users(handle_users=indexed.extend)
+
+        assert resp['http_status'] == 200
+        assert [u['id'] for u in c.curr_local_users] == ['id-1', 'id-2', 'id-3']
+        assert indexed == c.curr_local_users        # the discarded lists are not passed to handle_users
+        assert [kwargs['params'] for _, _, kwargs in session.requests] == \
+            [{'startIndex': 1, 'count': 2}, {'startIndex': 3, 'count': 2}] * 2 + [None]
+
+    # unpaged list not complete: discarded, no partial lists
+    with _scim_client([_page(5, users[:2])], {'page_size': 0, 'list_retries': 0}) as session:
+        assert sh.get_scim_users() == {'http_status': None, 'scim_user_list': {}}
+        assert c.curr_local_users == []
+        assert len(session.requests) == 1
+
+def test_lookup_filter():
+    users = [{'userName': 'a"b\\c'}, {'userName': 'user2', 'externalId': 'F9168C5E'}]
+
+    assert sh.lookup_filter(users) == \
+        'userName eq "a\\"b\\\\c" or userName eq "user2" or externalId eq "F9168C5E"'
+
+def test_lookup_scim_users():
+    users = [_user(n, id='id-%d' % n, externalId='guid-%d' % n) for n in range(1, 4)]
+    scim_config = {'lookup': {'batch_size': 2}, 'max_concurrency': 1}
+
+    def _page(page_users):
+        return StubResponse(200, {'totalResults': len(page_users), 'Resources': page_users})
+
+    # batches of 'or' clauses, a user matched by more batches returned once
+    with _scim_client([_page(users[:2]), _page(users[2:] + users[:1])], scim_config) as session:
+        resp = sh.lookup_scim_users(users)
+
+        assert resp['http_status'] == 200
+        assert [u['id'] for u in c.curr_local_users] == ['id-1', 'id-2', 'id-3']
+        assert [kwargs['params'] for _, _, kwargs in session.requests] == \
+            [{'filter': sh.lookup_filter(users[:2]), 'count': 4}, {'filter': sh.lookup_filter(users[2:]), 'count': 2}]
+
+    # filter not supported: no partial lists (the sync falls back to the full list)
+    with _scim_client([_page(users[:2]), StubResponse(400, {'scimType': 'invalidFilter'})], scim_config):
+        assert sh.lookup_scim_users(users) == {'http_status': 400, 'scim_user_list': {}}
+        assert c.curr_local_users == []
+
+def test_bulk_chunks():
+    items = [(scim.UserRecord(_user(n)), 'add', None) for n in range(5)]
+
+    # operations limit
+    chunks = sh.bulk_chunks(items, SCIM_URL, USERS_URL, {'max_operations': 2, 'max_payload_size': 0})
+    assert [len(chunk_items) for chunk_items, _ in chunks] == [2, 2, 1]
+
+    bulk_ids = []
+    for chunk_items, body in chunks:
+        request = json.loads(body)
+        assert request['schemas'] == [sh.BULK_REQUEST_SCHEMA]
+        assert [op['bulkId'] for op in request['Operations']] == [item[3] for item in chunk_items]
+        assert all(op['method'] == 'POST' and op['path'] == scim.User.URI for op in request['Operations'])
+        bulk_ids += [item[3] for item in chunk_items]
+    assert len(set(bulk_ids)) == 5
+
+    # payload limit: each chunk fits, an operation larger than the limit is sent alone
+    one = sh.bulk_chunks(items[:1], SCIM_URL, USERS_URL, {'max_operations': 10, 'max_payload_size': 0})
+    max_payload_size = 2 * len(one[0][1])
+    chunks = sh.bulk_chunks(items, SCIM_URL, USERS_URL, {'max_operations': 10, 'max_payload_size': max_payload_size})
+    assert sum(len(chunk_items) for chunk_items, _ in chunks) == 5
+    assert all(len(body) <= max_payload_size for _, body in chunks)
+
+    chunks = sh.bulk_chunks(items[:2], SCIM_URL, USERS_URL, {'max_operations': 10, 'max_payload_size': 10})
+    assert [len(chunk_items) for chunk_items, _ in chunks] == [1, 1]
+
+def test_bulk_results():
+    chunk_items = [(_user(n), 'add', None, str(n)) for n in range(3)]
+
+    response = {'Operations': [
+        {'method': 'POST', 'bulkId': '1', 'status': '201', 'location': USERS_URL + '/id-1'},
+        {'method': 'POST', 'bulkId': '0', 'status': {'code': 201}, 'response': {'id': 'id-0'}},
+    ]}
+    results = sh.bulk_results(chunk_items, 200, json.dumps(response))
+
+    assert results[0] == {'http_status': 201, 'scim_user': {'id': 'id-0'}}
+    assert results[1] == {'http_status': 201, 'scim_user': {'id': 'id-1'}}
+    assert results[2] is None    # missing operation: single request
+
+    # not sent or rejected: single requests
+    assert sh.bulk_results(chunk_items, None, None) == [None] * 3
+    assert sh.bulk_results(chunk_items, 413, '') == [None] * 3
+
+    # unknown outcome: not sent again
+    assert sh.bulk_results(chunk_items, 500, '') == [{'http_status': 500, 'scim_user': {}}] * 3
+    assert sh.bulk_results(chunk_items, 200, 'not json') == [{'http_status': 200, 'scim_user': {}}] * 3
+
+def test_get_bulk_config():
+    config = {'schemas': ['urn:ietf:params:scim:schemas:core:2.0:ServiceProviderConfig'],
+              'bulk': {'supported': True, 'maxOperations': 100, 'maxPayloadSize': 1048576}}
+
+    # opt-in: not requested by default
+    with _scim_client([]) as session:
+        assert sh.get_bulk_config() is None
+        assert session.requests == []
+
+    # requested once per client, scim_api.bulk.max_operations lower than the server limit
+    with _scim_client([StubResponse(200, config)], {'bulk': {'enabled': True, 'max_operations': 10}}) as session:
+        assert sh.get_bulk_config() == {'max_operations': 10, 'max_payload_size': 1048576}
+        assert sh.get_bulk_config() == {'max_operations': 10, 'max_payload_size': 1048576}
+        assert [req[:2] for req in session.requests] == [('GET', SCIM_URL + sh.SERVICE_PROVIDER_CONFIG_URI)]
+
+    # not supported
+    with _scim_client([StubResponse(200, dict(config, bulk={'supported': False}))], {'bulk': {'enabled': True}}):
+        assert sh.get_bulk_config() is None
+
+def test_retry_after_seconds():
+    assert rl.retry_after_seconds(None) is None
+    assert rl.retry_after_seconds('5') == 5.0
+    assert rl.retry_after_seconds('-3') == 0.0
+    assert rl.retry_after_seconds('not a date') is None
+
+    # HTTP date
+    wait = rl.retry_after_seconds(formatdate(time.time() + 30, usegmt=True))
+    assert 25 <= wait <= 30
+    assert rl.retry_after_seconds(formatdate(time.time() - 30, usegmt=True)) == 0.0
+
+def test_limiter_window():
+    limiter = rl.AdaptiveLimiter('test', max_concurrency=8, max_retry_after=0)
+
+    # multiplicative decrease
+    limiter.acquire()
+    limiter.release(rl.THROTTLED, retry_after=0)
+    assert int(limiter.concurrency) == 4
+
+    limiter.acquire()
+    limiter.release(rl.THROTTLED)
+    assert int(limiter.concurrency) == 2
+
+    # additive increase: one request per window
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release(rl.OK)
+    assert int(limiter.concurrency) == 2
+    limiter.acquire()
+    limiter.release(rl.OK)
+    assert int(limiter.concurrency) == 3
+
+    # errors: limits unchanged
+    limiter.acquire()
+    limiter.release(rl.ERROR)
+    assert int(limiter.concurrency) == 3
+    assert limiter.in_flight == 0
+
+def test_limiter_timeouts():
+
+    class ReadTimeout(Exception):
+        pass
+
+    class ConnectTimeout(ReadTimeout):
+        pass
+
+    def _calls(method, error):
+        limiter = rl.AdaptiveLimiter('test', max_concurrency=8, max_retries=2, max_retry_after=0)
+        calls = []
+
+        def _send():
+            calls.append(method)
+            raise error()
+
+        try:
+            limiter.call(_send, ReadTimeout, method, ConnectTimeout)
+        except ReadTimeout:
+            pass
+        return len(calls), int(limiter.concurrency)
+
+    # non idempotent methods: not retried, the window is decreased anyway
+    assert _calls('POST', ReadTimeout) == (1, 4)
+    assert _calls('PATCH', ReadTimeout) == (1, 4)
+    # idempotent methods and connect timeouts (not sent): retried
+    assert _calls('GET', ReadTimeout) == (3, 1)
+    assert _calls('POST', ConnectTimeout) == (3, 1)
+
+def test_get_limiter():
+    saved = dict(rl._limiters)
+    rl._limiters.clear()
+    try:
+        # opt-in: the requests are sent directly by default
+        with _patched(c, 'scim_config', {}), _patched(c, 'det_config', {'rate_limit': {'enabled': False}}):
+            assert rl.get_limiter('scim') is None
+            assert rl.get_limiter('det') is None
+            assert rl.call('scim', '/Users', lambda: 'sent') == 'sent'
+
+        # API budget, endpoint budgets by the longest path prefix
+        rate_limit = {'enabled': True, 'max_concurrency': 8, 'endpoints': {'/Bulk': {'max_concurrency': 2}}}
+        with _patched(c, 'scim_config', {'rate_limit': rate_limit}):
+            limiter = rl.get_limiter('scim', '/Users/id-1')
+            assert int(limiter.concurrency) == 8
+            assert rl.get_limiter('scim', '/Users') is limiter
+            assert int(rl.get_limiter('scim', '/Bulk').concurrency) == 2
+    finally:
+        rl._limiters.clear()
+        rl._limiters.update(saved)
+
+def test_user_to_scim():
+    users = [
+        _user(1),
+        _user(2, externalId='F9168C5E', id='715509db'),
+        _user(3, department='R&D', employeeNumber='42', locked=False),
+        _user(4, schemas=[scim.User.CORE_USER_SCHEMA, scim.User.ENTERPRISE_USER_SCHEMA], manager='user1'),
+    ]
+
+    for user in users:
+        for u in [user, scim.UserRecord(user)]:
+            expected = json.loads(scim.User(u).to_json())
+            resource = scim.user_to_scim(u)
+
+            assert json.loads(json.dumps(resource)) == expected
+            assert list(resource) == list(expected)
+            assert resource['schemas'] == expected['schemas']
+
+
+def main_test():
+    logging.basicConfig(level=logging.INFO)
+
+    c.logger.info(80*"=")
+    c.logger.info("API helpers unit test - start")
+
+    tests = [test_scim_client, test_users_page_next, test_users_list_complete, test_get_scim_users_retry,
+             test_lookup_filter, test_lookup_scim_users, test_bulk_chunks, test_bulk_results, test_get_bulk_config,
+             test_retry_after_seconds, test_limiter_window, test_limiter_timeouts, test_get_limiter,
+             test_user_to_scim]
+
+    for test in tests:
+        c.logger.info(80*"-")
+        test()
+        c.logger.info("%s - OK" % test.__name__)
+
+    c.logger.info("API helpers unit test - end")
+
+
+if __name__ == "__main__":
+    main_test()
@@ -0,0 +1,735 @@
+#
+# LDAP helpers unit testing
+# Checks of the LDAP search, pool and plugin helpers on in-memory stub LDAP connections,
+# no LDAP server is contacted: python test-ldap_units.py (or python -m pytest test-ldap_units.py)
+#
+import os
+import re
+import time
+import uuid
+import logging
+import tempfile
+import contextlib
+import ldap
+
+from ldap.controls import SimplePagedResultsControl
+
+from libs import common as c
+from libs import ldap_helper as lh
+from libs import ldap_plugin_common as lpc
+from libs import sync_state as ss
+from libs import mapping_cache as mc
+from libs import sync_process as sp
+from plugins import ms_active_directory as ad
+
+BASE_DN = 'OU=Users,DC=domain,DC=internal'
+USER_FILTER = '(objectClass=user)'
+GROUP_DN = 'CN=DetGroup,OU=Groups,DC=domain,DC=internal'
+ATTR_MAPPING = {'userName': '${sAMAccountName}', 'displayName': '${cn}'}
+
+
+class StubConnection:
+    """ In-memory bound LDAP connection: entries by base DN, RFC 2696 paged results (the cookie
+        is the offset of the next page), one entry for each result3() call
+    """
+
+    def __init__(self, url='ldap://dc1', entries=None, match=None):
+        self.url = url
+        self.entries = entries or {}    # base DN -> list of (dn, entry)
+        self.match = match              # function(entry, filter) -> True if the entry matches (default: all)
+        self.searches = []              # (base DN, filter, page cookie) of each search_ext
+        self.abandoned = []             # msgids of the abandoned searches
+        self.bind_error = None          # exception raised by simple_bind_s
+        self.alive = True               # whoami_s result
+        self.unbound = False
+        self._results = {}
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, user, password):
+        if self.bind_error is not None:
+            raise self.bind_error
+
+    def search_s(self, base_dn, scope, search_filter, attrs):
+        return []
+
+    def whoami_s(self):
+        if not self.alive:
+            raise ldap.SERVER_DOWN()
+        return ''
+
+    def search_ext(self, base_dn, scope, search_filter, attrs, serverctrls=None):
+        page_ctrls = [ctrl for ctrl in serverctrls or [] if ctrl.controlType == SimplePagedResultsControl.controlType]
+        cookie = page_ctrls[0].cookie if page_ctrls else None
+        self.searches.append((base_dn, search_filter, cookie))
+
+        matched = [(dn, entry) for dn, entry in self.entries.get(base_dn, [])
+                   if self.match is None or self.match(entry, search_filter)]
+        resp_ctrls = []
+        if page_ctrls:
+            start = int(cookie or 0)
+            end = start + page_ctrls[0].size
+            next_cookie = str(end).encode() if end < len(matched) else b''
+            matched = matched[start:end]
+            resp_ctrls = [SimplePagedResultsControl(True, size=page_ctrls[0].size, cookie=next_cookie)]
+
+        msgid = len(self.searches)
+        self._results[msgid] = [(ldap.RES_SEARCH_ENTRY, [item], msgid, []) for item in matched]
+        self._results[msgid].append((ldap.RES_SEARCH_RESULT, [], msgid, resp_ctrls))
+        return msgid
+
+    def result3(self, msgid, all=1, timeout=-1):
+        return self._results[msgid].pop(0)
+
+    def abandon(self, msgid):
+        self.abandoned.append(msgid)
+        self._results.pop(msgid, None)
+
+    def unbind_s(self):
+        self.unbound = True
+
+def _entry(name, **attrs):
+    entry = {'sAMAccountName': [name.encode()], 'cn': [name.encode()]}
+    entry.update(attrs)
+    return 'CN=%s,%s' % (name, BASE_DN), entry
+
+@contextlib.contextmanager
+def _patched(obj, name, value):
+    saved = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, saved)
+
+@contextlib.contextmanager
+def _plugin_config(users_config, ldap_config=None):
+    # ms_active_directory plugin on the stub LDAP endpoint, attr_mapping compiled as at start-up
+    scim_mappers, ldap_mapping_attrs = lpc.compile_attr_mapping(ATTR_MAPPING, ad.ldap_field_mappers())
+    config = {
+        'ldap_plugin': ad,
+        'ldap_config': ldap_config or {},
+        'ldap_config_auth': {'url': 'ldap://dc1', 'user': 'user', 'password': 'password', 'tls': False},
+        'ldap_config_users': dict({'dn': BASE_DN, 'filter': USER_FILTER}, **users_config),
+        'scim_mappers': scim_mappers,
+        'ldap_mapping_attrs': ldap_mapping_attrs,
+        'ldap_users': [],
+        'local_users': [],
+        'local_users_cache': {},
+        'local_users_delta': [],
+        'ldap_delta_cycle': False,
+        'ldap_changed_dns': set(),
+    }
+    saved = {k: getattr(c, k) for k in config}
+    for k, v in config.items():
+        setattr(c, k, v)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            setattr(c, k, v)
+        lh._pools.clear()
+
+def test_paged_search():
+    entries = [_entry('user%d' % n) for n in range(5)]
+    l = StubConnection(entries={BASE_DN: entries})
+
+    # the cookie of each page is sent back until the server returns an empty one
+    received = list(lh.ldap_search_entries(l, BASE_DN, ldap.SCOPE_SUBTREE, USER_FILTER, ['cn'], page_size=2))
+    assert received == entries
+    assert [cookie for _, _, cookie in l.searches] == ['', b'2', b'4']
+
+    # not paged: a single search without the paged results control
+    l = StubConnection(entries={BASE_DN: entries})
+    assert list(lh.ldap_search_entries(l, BASE_DN, ldap.SCOPE_SUBTREE, USER_FILTER, ['cn'])) == entries
+    assert [cookie for _, _, cookie in l.searches] == [None]
+
+def test_paged_search_streaming():
+    l = StubConnection(entries={BASE_DN: [_entry('user%d' % n) for n in range(4)]})
+
+    # the entries of a page are returned before the next page is requested
+    entries = lh.ldap_search_entries(l, BASE_DN, ldap.SCOPE_SUBTREE, USER_FILTER, ['cn'], page_size=2)
+    next(entries)
+    assert len(l.searches) == 1
+    next(entries)
+    next(entries)
+    assert len(l.searches) == 2
+
+def test_retrieve_users_paged():
+    entries = [_entry('user%d' % n) for n in range(5)]
+    conns = []
+
+    def _connect(url, *args):
+        conns.append(StubConnection(url, {BASE_DN: entries}))
+        return conns[-1]
+
+    handled = []
+    try:
+        with _patched(lh, 'ldap_connect', _connect):
+            assert lh.ldap_retrieve_users('ldap://dc1', 'user', 'password', BASE_DN, ['cn'], USER_FILTER,
+                                          handle_entry=handled.append, page_size=2)
+    finally:
+        lh._pools.clear()
+
+    assert handled == [entry for _, entry in entries]
+    assert len(conns) == 1 and len(conns[0].searches) == 3
+
+def test_streaming_mapping():
+    entries = [_entry('user%d' % n) for n in range(3)]
+    mapped = []     # users already mapped at each result3() call
+
+    class _Connection(StubConnection):
+        def result3(self, msgid, all=1, timeout=-1):
+            mapped.append(len(c.local_users))
+            return super().result3(msgid, all, timeout)
+
+    # streaming: each entry is mapped before the next one is read, the raw entries are not stored
+    with _plugin_config({'streaming': True, 'page_size': 2}):
+        with _patched(lh, 'ldap_connect', lambda url, *args: _Connection(url, {BASE_DN: entries})):
+            assert ad.ldap_get_users()
+        ad.ldap_to_scim_mapping()
+
+        assert mapped == [0, 1, 2, 2, 3]    # page 1: 2 entries + result, page 2: 1 entry + result
+        assert c.ldap_users == []
+        assert [u['userName'] for u in c.local_users] == ['user0', 'user1', 'user2']
+
+    # not streaming: raw entries mapped after the retrieval, same users
+    mapped.clear()
+    with _plugin_config({'streaming': False, 'page_size': 2}):
+        with _patched(lh, 'ldap_connect', lambda url, *args: _Connection(url, {BASE_DN: entries})):
+            assert ad.ldap_get_users()
+        assert mapped == [0] * 5 and len(c.ldap_users) == 3
+
+        ad.ldap_to_scim_mapping()
+        assert [u['userName'] for u in c.local_users] == ['user0', 'user1', 'user2']
+
+def test_incremental_watermark():
+    entries = [_entry('user%d' % n, uSNChanged=[str(usn).encode()]) for n, usn in enumerate([12, 40, 7])]
+    incremental = {'incremental': {'enabled': True, 'attr': 'uSNChanged', 'full_sync_every': 2}}
+
+    def _cycle():
+        with _patched(lh, 'ldap_connect', lambda url, *args: StubConnection(url, {BASE_DN: entries})):
+            lpc.incremental_cycle_start()
+            user_filter = lpc.get_users_filter()
+            assert ad.ldap_get_users()
+            ad.ldap_to_scim_mapping()
+            lpc.merge_incremental_users()
+            lpc.incremental_cycle_end(True)
+        return user_filter
+
+    with tempfile.TemporaryDirectory() as tmp_dir, _plugin_config({}, incremental):
+        state_file = os.path.join(tmp_dir, 'state.json')
+        ss.load(state_file)
+
+        try:
+            # no watermark: full cycle, the highest uSNChanged is stored for the DC
+            assert _cycle() == USER_FILTER
+            assert not c.ldap_delta_cycle
+            ss.load(state_file)
+            assert ss.get('ldap_watermarks') == {'uSNChanged|ldap://dc1': 40}
+
+            # delta cycles: entries changed after the watermark, full reconcile every full_sync_every cycles
+            assert _cycle() == '(&%s(uSNChanged>=41))' % USER_FILTER
+            assert c.ldap_delta_cycle and len(c.local_users) == 3
+            assert _cycle() == '(&%s(uSNChanged>=41))' % USER_FILTER
+            assert _cycle() == USER_FILTER
+            assert ss.get('ldap_cycles_since_full') == 0
+
+        finally:
+            ss.state = {}
+            ss.state_filename = ""
+
+def test_dirsync_group_members():
+    users_filter = '(&%s(memberOf=%s))' % (USER_FILTER, GROUP_DN)
+    directory = {}  # DN -> entry
+    changes = []    # entries returned by the next DirSync search
+
+    def _user(n, member=True):
+        dn, entry = _entry('user%d' % n, objectGUID=[bytes([n]) * 16], memberOf=[GROUP_DN.encode()] if member else [])
+        directory[dn] = entry
+        return dn
+
+    def _match(entry, search_filter):
+        if search_filter.startswith('(|(objectGUID='):
+            return ad._guid_filter(entry['objectGUID'])[2:-1] in search_filter
+        return GROUP_DN.encode() in entry.get('memberOf', [])
+
+    def _group(*member_dns):
+        return GROUP_DN, {'objectGUID': [b'g' * 16], 'member': [dn.encode() for dn in member_dns]}
+
+    class _Connection(StubConnection):
+        def search_ext(self, base_dn, scope, search_filter, attrs, serverctrls=None):
+            if any(ctrl.controlType == ad.LDAP_SERVER_DIRSYNC_OID for ctrl in serverctrls or []):
+                # DirSync: the changed attrs only (no back-link attrs)
+                self.searches.append((base_dn, search_filter, None))
+                msgid = len(self.searches)
+                self._results[msgid] = [(ldap.RES_SEARCH_ENTRY, [(dn, {k: v for k, v in entry.items() if k != 'memberOf'})], msgid, [])
+                                        for dn, entry in changes]
+                self._results[msgid].append((ldap.RES_SEARCH_RESULT, [], msgid, [ad.DirSyncControl(cookie=b'cookie')]))
+                return msgid
+
+            self.entries = {dn: [(dn, entry)] for dn, entry in directory.items()}
+            self.entries[BASE_DN] = list(directory.items())
+            return super().search_ext(base_dn, scope, search_filter, attrs, serverctrls)
+
+    def _cycle():
+        with _patched(lh, 'ldap_connect', lambda url, *args: _Connection(url, match=_match)):
+            assert ad.ldap_get_users()
+        users = {entry['sAMAccountName'][0].decode(): entry for entry in c.ldap_users}
+        c.ldap_users = []
+        return users
+
+    dirsync_config = {'dirsync': {'enabled': True, 'base_dn': 'DC=domain,DC=internal', 'full_sync_every': 0}}
+
+    with _plugin_config({'filter': users_filter, 'attr': ['memberOf']}, dirsync_config), \
+         _patched(ad, 'dirsync_entries', {}), _patched(ad, 'dirsync_dns', {}), _patched(ad, 'dirsync_cookie', b''):
+
+        # full refresh
+        user1, user2, user3 = _user(1), _user(2), _user(3, member=False)
+        changes[:] = [(user1, directory[user1]), (user2, directory[user2]), _group(user1, user2)]
+        users = _cycle()
+        assert sorted(users) == ['user1', 'user2']
+        assert users['user2']['memberOf'] == [GROUP_DN.encode()]
+
+        # delta: user2 removed from the group, user3 added, the user objects are not changed
+        _user(2, member=False)
+        _user(3)
+        changes[:] = [_group(user1, user3)]
+        users = _cycle()
+        assert sorted(users) == ['user1', 'user3']
+        assert users['user3']['memberOf'] == [GROUP_DN.encode()]
+        assert sorted(ad.dirsync_dns.values()) == [user1, user3]
+
+        # delta: no changes
+        changes[:] = []
+        assert sorted(_cycle()) == ['user1', 'user3']
+
+def _shard_match(entry, search_filter):
+    # sharded filters only: (&<filter>(attr=<char>*)) or the remainder (&<filter>(!(|(attr=<char>*)...)))
+    prefixes = re.findall(r'\((\w+)=(\w)\*\)', search_filter)
+    if not prefixes:
+        return True
+
+    found = any(entry.get(attr, [b''])[0].decode().lower().startswith(ch) for attr, ch in prefixes)
+    return not found if '(!(|' in search_filter else found
+
+def test_search_shards():
+    shards = lh.ldap_search_shards(['OU=A,' + BASE_DN, 'OU=B,' + BASE_DN], USER_FILTER, 'sAMAccountName')
+    assert len(shards) == 2 * (len(lh.SHARD_CHARS) + 1)
+    assert shards[0] == ('OU=A,' + BASE_DN, '(&%s(sAMAccountName=a*))' % USER_FILTER)
+
+    # every entry is in one shard only
+    for name in ['alice', 'Bob', '9lives', '_svc', '']:
+        entry = {'sAMAccountName': [name.encode()]}
+        assert sum(_shard_match(entry, f) for base_dn, f in shards if base_dn.startswith('OU=A')) == 1
+
+    assert lh.ldap_search_shards(BASE_DN, USER_FILTER) == [(BASE_DN, USER_FILTER)]
+
+def test_parallel_search_dedup():
+    entries = [_entry(name) for name in ['alice', 'bob', 'carol', '_svc', '42']]
+    other_dn = 'OU=Other,DC=domain,DC=internal'
+
+    # overlapping base DNs: the entries of both are returned once
+    conns = []
+
+    def _connect(url, *args):
+        conns.append(StubConnection(url, {BASE_DN: entries, other_dn: entries[:2]}, _shard_match))
+        return conns[-1]
+
+    for max_workers in [1, 4]:
+        handled = []
+        try:
+            with _patched(lh, 'ldap_connect', _connect):
+                assert lh.ldap_retrieve_users('ldap://dc1', 'user', 'password', [BASE_DN, other_dn], ['cn'], USER_FILTER,
+                                              handle_entry=handled.append, shard_attr='sAMAccountName', max_workers=max_workers)
+        finally:
+            lh._pools.clear()
+
+        assert sorted(entry['cn'][0] for entry in handled) == sorted(entry['cn'][0] for _, entry in entries)
+        assert sum(len(l.searches) for l in conns) == 2 * (len(lh.SHARD_CHARS) + 1)
+        conns.clear()
+
+def test_connect_bind_error():
+    conns = []
+
+    def _initialize(url):
+        conns.append(StubConnection(url))
+        conns[-1].bind_error = ldap.INVALID_CREDENTIALS()
+        return conns[-1]
+
+    # the connection of a failed bind is closed
+    with _patched(ldap, 'initialize', _initialize):
+        try:
+            lh.ldap_connect('ldap://dc1', 'user', 'password', timeout=5)
+            assert False
+        except ldap.INVALID_CREDENTIALS:
+            pass
+
+    assert len(conns) == 1 and conns[0].unbound
+
+def test_pool_reuse():
+    conns = []
+
+    def _connect(url, *args):
+        conns.append(StubConnection(url, {BASE_DN: [_entry('user%d' % n) for n in range(3)]}))
+        return conns[-1]
+
+    with _patched(lh, 'ldap_connect', _connect):
+        pool = lh.LDAPConnectionPool('ldap://dc1', 'user', 'password', max_size=2, idle_check=30)
+
+        # the released connection is reused
+        with pool.connection() as l1:
+            pass
+        with pool.connection() as l2:
+            assert l2 is l1
+        assert len(conns) == 1
+
+        # an idle connection dropped by the server is replaced (health check)
+        pool.idle_check = 0
+        l1.alive = False
+        with pool.connection() as l3:
+            assert l3 is not l1 and l1.unbound
+        assert len(conns) == 2
+
+        # failover errors: the connection is discarded
+        try:
+            with pool.connection() as l4:
+                raise ldap.SERVER_DOWN()
+        except ldap.SERVER_DOWN:
+            pass
+        assert l4.unbound and pool._idle == []
+
+        pool.close()
+
+def test_pool_search_closed():
+    conns = []
+
+    def _connect(url, *args):
+        conns.append(StubConnection(url, {BASE_DN: [_entry('user%d' % n) for n in range(3)]}))
+        return conns[-1]
+
+    with _patched(lh, 'ldap_connect', _connect):
+        pool = lh.LDAPConnectionPool('ldap://dc1', 'user', 'password', max_size=1)
+
+        # search completed: the connection is returned to the pool
+        assert len(list(lh.ldap_search_failover(pool, [(BASE_DN, USER_FILTER)], ldap.SCOPE_SUBTREE, ['cn']))) == 3
+        assert len(pool._idle) == 1 and not conns[0].unbound
+
+        # generator closed before the end of the search: search abandoned, connection discarded
+        entries = lh.ldap_search_failover(pool, [(BASE_DN, USER_FILTER)], ldap.SCOPE_SUBTREE, ['cn'])
+        next(entries)
+        entries.close()
+        assert conns[0].abandoned == [2] and conns[0].unbound
+        assert pool._idle == []
+
+        # the pool slot is released
+        with pool.connection() as l:
+            assert l is conns[1]
+
+def test_pool_ranking():
+    pool = lh.LDAPConnectionPool(['ldap://dc1', 'ldap://dc2', 'ldap://dc3'], 'user', 'password')
+
+    # DCs never measured first, then by latency, the failed ones last
+    pool._record_latency('ldap://dc1', 0.5)
+    assert pool.ranked_urls() == ['ldap://dc2', 'ldap://dc3', 'ldap://dc1']
+    pool._record_latency('ldap://dc2', 0.1)
+    pool._record_latency('ldap://dc3', 0.2)
+    assert pool.ranked_urls() == ['ldap://dc2', 'ldap://dc3', 'ldap://dc1']
+    pool.mark_failed('ldap://dc2')
+    assert pool.ranked_urls() == ['ldap://dc3', 'ldap://dc1', 'ldap://dc2']
+
+    # pinned DC preferred while healthy
+    pool.pin('ldap://dc1')
+    assert pool._preferred_urls()[0] == 'ldap://dc1'
+    pool.pin('ldap://dc2')
+    assert pool._preferred_urls()[0] == 'ldap://dc3'
+
+def test_pool_failover():
+    entries = [_entry('user%d' % n) for n in range(3)]
+    down_urls = set()       # DCs refusing the connections
+    conns = []
+
+    class _Connection(StubConnection):
+        def result3(self, msgid, all=1, timeout=-1):
+            # the first DC goes down during the search
+            if self.url == 'ldap://dc1' and len(self._results[msgid]) <= len(entries):
+                raise ldap.SERVER_DOWN()
+            return super().result3(msgid, all, timeout)
+
+    def _connect(url, *args):
+        if url in down_urls:
+            raise ldap.SERVER_DOWN()
+        conns.append(_Connection(url, {BASE_DN: entries}))
+        return conns[-1]
+
+    with _patched(lh, 'ldap_connect', _connect):
+        pool = lh.LDAPConnectionPool(['ldap://dc1', 'ldap://dc2'], 'user', 'password')
+        pool.pin('ldap://dc1')
+
+        # search restarted on the next DC, the entries of the restarted search are returned again
+        served_urls = set()
+        received = list(lh.ldap_search_failover(pool, [(BASE_DN, USER_FILTER)], ldap.SCOPE_SUBTREE, ['cn'], served_urls=served_urls))
+        assert received == entries[:1] + entries
+        assert served_urls == {'ldap://dc1', 'ldap://dc2'}
+        assert pool.is_failed('ldap://dc1')
+        assert conns[0].unbound
+
+        # connection failover: a DC down is skipped
+        pool = lh.LDAPConnectionPool(['ldap://dc1', 'ldap://dc2'], 'user', 'password')
+        down_urls.add('ldap://dc2')
+        pool.pin('ldap://dc2')
+        with pool.connection() as l:
+            assert pool.url_of(l) == 'ldap://dc1'
+        assert pool.is_failed('ldap://dc2')
+
+        # all the DCs down
+        down_urls.add('ldap://dc1')
+        pool = lh.LDAPConnectionPool(['ldap://dc1', 'ldap://dc2'], 'user', 'password')
+        try:
+            list(lh.ldap_search_failover(pool, [(BASE_DN, USER_FILTER)], ldap.SCOPE_SUBTREE, ['cn']))
+            assert False
+        except ldap.SERVER_DOWN:
+            pass
+
+class RangedConnection(StubConnection):
+    """ Stub connection returning the memberOf values by ranges of RANGE_SIZE values (MS A/D MaxValRange)
+    """
+    RANGE_SIZE = 2
+
+    def __init__(self, url='ldap://dc1', groups=None):
+        super().__init__(url)
+        self.groups = groups or {}  # DN -> memberOf values
+        self.pending = 0            # searches sent and not read
+        self.max_pending = 0
+
+    def ranged(self, dn, low):
+        values = self.groups[dn][low:low + self.RANGE_SIZE]
+        high = '*' if low + self.RANGE_SIZE >= len(self.groups[dn]) else str(low + self.RANGE_SIZE - 1)
+        return {'memberOf;range=%d-%s' % (low, high): values}
+
+    def search_ext(self, base_dn, scope, search_filter, attrs, serverctrls=None):
+        low = int(lh.RANGE_ATTR_RE.match(attrs[0]).group(2))
+        self.entries = {base_dn: [(base_dn, self.ranged(base_dn, low))]}
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        return super().search_ext(base_dn, scope, search_filter, attrs, serverctrls)
+
+    def result3(self, msgid, all=1, timeout=-1):
+        self.pending -= 1
+        return super().result3(msgid, all, timeout)
+
+def test_ranged_attrs():
+    groups = {'CN=user%d,%s' % (n, BASE_DN): [('CN=group%d' % g).encode() for g in range(n)] for n in range(1, 6)}
+    l = RangedConnection(groups=groups)
+
+    entries = [(dn, dict(l.ranged(dn, 0), cn=[dn.encode()])) for dn in groups]
+    assert [lh.ldap_has_ranged_attrs(entry) for _, entry in entries] == [True] * 5
+
+    lh.ldap_resolve_ranged_attrs(l, entries, batch_size=2)
+
+    for dn, entry in entries:
+        assert entry['memberOf'] == groups[dn]
+        assert not lh.ldap_has_ranged_attrs(entry)
+
+    # the next ranges of a batch are requested before reading the results
+    assert l.max_pending == 2
+    assert len(l.searches) == 0 + 0 + 1 + 1 + 2  # ranges after the first one
+
+def test_group_members_cache():
+    groups_dn = 'OU=Groups,DC=domain,DC=internal'
+    groups = {'CN=DetGroup,%s' % groups_dn: {'cn': [b'DetGroup'], 'whenChanged': [b'20240101000000.0Z']}}
+    members = {'CN=DetGroup,%s' % groups_dn: ['user1', 'user2']}
+    member_searches = []
+
+    def _match(entry, search_filter):
+        if search_filter.startswith('(&(objectClass=group)'):
+            return 'cn' in entry and '(cn=%s)' % entry['cn'][0].decode() in search_filter
+        return any(search_filter.endswith(':=%s))' % group_dn) and entry['sAMAccountName'][0].decode() in names
+                   for group_dn, names in members.items())
+
+    class _Connection(StubConnection):
+        def search_ext(self, base_dn, scope, search_filter, attrs, serverctrls=None):
+            if base_dn == BASE_DN:
+                member_searches.append(search_filter)
+            return super().search_ext(base_dn, scope, search_filter, attrs, serverctrls)
+
+    def _connect(url, *args):
+        return _Connection(url, {groups_dn: list(groups.items()),
+                                 BASE_DN: [_entry('user%d' % n) for n in range(4)]}, _match)
+
+    assign_config = {'auto_assign_mlde_groups': {'group_dn': groups_dn, 'cache_ttl': 3600}}
+
+    with _plugin_config({}), _patched(c, 'det_config', assign_config), \
+         _patched(c, 'scim_config', {'attr_mapping': ATTR_MAPPING}), \
+         _patched(ad, 'group_members_cache', {}), _patched(lh, 'ldap_connect', _connect):
+
+        # transitive members of the synced users only (users base DN and filter)
+        assert ad.ldap_get_group_members(['DetGroup', 'Other']) == {'DetGroup': {'user1', 'user2'}}
+        assert member_searches == ['(&%s(memberOf:%s:=CN=DetGroup,%s))' % (USER_FILTER, ad.LDAP_MATCHING_RULE_IN_CHAIN, groups_dn)]
+
+        # unchanged group: cached members
+        members['CN=DetGroup,%s' % groups_dn].append('user3')
+        assert ad.ldap_get_group_members(['DetGroup']) == {'DetGroup': {'user1', 'user2'}}
+        assert len(member_searches) == 1
+
+        # group changed or cache expired: resolved again
+        groups['CN=DetGroup,%s' % groups_dn]['whenChanged'] = [b'20240102000000.0Z']
+        assert ad.ldap_get_group_members(['DetGroup']) == {'DetGroup': {'user1', 'user2', 'user3'}}
+        members['CN=DetGroup,%s' % groups_dn].remove('user1')
+        ad.group_members_cache['CN=DetGroup,%s' % groups_dn]['time'] = time.time() - 3601
+        assert ad.ldap_get_group_members(['DetGroup']) == {'DetGroup': {'user2', 'user3'}}
+        assert len(member_searches) == 3
+
+def test_watch_changes():
+    changed_dns = [_entry('user%d' % n)[0] for n in range(3)]
+    conns = []
+
+    def _connect(url, *args):
+        conns.append(StubConnection(url, {BASE_DN: [(dn, {'objectClass': [b'user']}) for dn in changed_dns]}))
+        return conns[-1]
+
+    notified = []
+    with _plugin_config({}, {'notify': {'enabled': True, 'scope': 'onelevel'}}), _patched(lh, 'ldap_connect', _connect):
+        ad.ldap_watch_changes(BASE_DN, notified.append)
+
+        # notify search closed by the server: the dedicated connection is closed
+        assert notified == changed_dns
+        assert conns[-1].unbound and lh.ldap_get_config_pool()._idle == []
+
+        # targeted delta cycle: the changed entries only
+        c.local_users_cache = {'user0': {'userName': 'user0'}}
+        lpc.incremental_cycle_start(set(notified[:2]))
+        assert c.ldap_delta_cycle
+        assert lpc.get_users_filter() == '(&%s(|(distinguishedName=%s)(distinguishedName=%s)))' % ((USER_FILTER,) + tuple(notified[:2]))
+
+def test_notify_debounce():
+    cycles = []
+    notify_config = {'notify': {'enabled': True, 'debounce': 0.1, 'max_targeted': 2}}
+
+    with _patched(c, 'ldap_config', notify_config), _patched(sp, 'main_loop', lambda *args: cycles.append(args)):
+        # notifications coalesced in the debounce window, one targeted cycle
+        for dn in ['dn1', 'dn2', 'dn1']:
+            sp._ldap_changes.put(dn)
+        sp.sync_ldap_changes(0.3)
+        assert cycles == [({'dn1', 'dn2'},)]
+
+        # more than max_targeted changed entries: regular cycle
+        for dn in ['dn1', 'dn2', 'dn3']:
+            sp._ldap_changes.put(dn)
+        sp.sync_ldap_changes(0.3)
+        assert cycles[1:] == [()]
+
+        # no notifications: no cycles
+        sp.sync_ldap_changes(0.1)
+        assert len(cycles) == 2
+
+def test_compile_attr_mapping():
+    attr_mapping = {
+        'id': None,
+        'userName': '${userPrincipalName}',
+        'externalId': '${objectGUID}',
+        'emails.work.value': '${mail}',
+        'active': '${userAccountControl}',
+        'name.givenName': '${givenName}',
+        'name.familyName': '${sn}',
+        'displayName': '${cn}',
+        'preferredLanguage': 'en_US',
+        'memberOf': '${memberOf}',
+    }
+    guid = uuid.uuid4()
+    ldap_user = {
+        'userPrincipalName': [b'user1@domain.internal'], 'objectGUID': [guid.bytes], 'mail': [b'user1@domain.internal '],
+        'userAccountControl': [b'514'], 'givenName': [b'User'], 'sn': [b'One'], 'cn': [b'User One'],
+        'memberOf': [GROUP_DN.encode(), b'CN=Other,OU=Groups,DC=domain,DC=internal'],
+    }
+
+    mappers, ldap_attrs = lpc.compile_attr_mapping(attr_mapping, ad.ldap_field_mappers())
+    assert ldap_attrs == ['userPrincipalName', 'objectGUID', 'mail', 'userAccountControl', 'givenName', 'sn', 'cn', 'memberOf']
+
+    with _patched(c, 'scim_mappers', mappers):
+        scim_user = lpc.map_ldap_user(ldap_user)
+
+    assert scim_user['externalId'] == str(guid)
+    assert scim_user['emails'] == [{'value': 'user1@domain.internal', 'type': 'work', 'primary': True}]
+    assert scim_user['name'] == {'givenName': 'User', 'familyName': 'One'}
+    assert scim_user['active'] is False     # ACCOUNTDISABLE flag
+    assert scim_user['memberOf'] == [GROUP_DN, 'CN=Other,OU=Groups,DC=domain,DC=internal']
+    assert scim_user['preferredLanguage'] == 'en_US'
+
+    # same result of the interpreted common mapping
+    common_keys = ['id', 'userName', 'externalId', 'emails.work.value', 'name.givenName', 'name.familyName',
+                   'displayName', 'preferredLanguage']
+    expected = {}
+    for k in common_keys:
+        lpc.scim_common_mapping(k, attr_mapping[k], expected, ldap_user)
+    assert {k: scim_user[k] for k in expected} == expected
+
+def test_mapping_cache():
+    mappers, ldap_attrs = lpc.compile_attr_mapping(ATTR_MAPPING, ad.ldap_field_mappers())
+    mapped = []
+
+    def _map(ldap_user):
+        mapped.append(ldap_user['cn'][0])
+        return lpc.map_ldap_user(ldap_user)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+         _patched(c, 'scim_mappers', mappers), _patched(c, 'ldap_mapping_attrs', ldap_attrs):
+        cache_config = {'enabled': True, 'max_size': 2, 'file': os.path.join(tmp_dir, 'cache.json')}
+
+        try:
+            mc.init(cache_config, ATTR_MAPPING)
+            _, user1 = _entry('user1')
+            _, user2 = _entry('user2')
+
+            # unchanged entries are not mapped again, the returned users are copies
+            scim_user = mc.map_user(user1, _map)
+            scim_user['displayName'] = 'changed'
+            assert mc.map_user(dict(user1, whenChanged=[b'1']), _map)['displayName'] == 'user1'
+            assert mapped == [b'user1']
+
+            # changed mapping attrs: mapped again
+            assert mc.map_user(dict(user1, cn=[b'User 1']), _map)['displayName'] == 'User 1'
+            assert mapped == [b'user1', b'User 1']
+
+            # LRU eviction (max_size), persisted cache reloaded
+            mc.map_user(user2, _map)
+            assert mc.save()
+            mc.init(cache_config, ATTR_MAPPING)
+            assert len(mc.cache) == 2
+            mc.map_user(user2, _map)
+            mc.map_user(user1, _map)
+            assert mapped == [b'user1', b'User 1', b'user2', b'user1']
+
+            # attr_mapping changed: persisted cache discarded
+            mc.init(cache_config, dict(ATTR_MAPPING, displayName='${sn}'))
+            assert len(mc.cache) == 0
+
+        finally:
+            mc.init(None, {})
+
+
+def main_test():
+    logging.basicConfig(level=logging.INFO)
+
+    c.logger.info(80*"=")
+    c.logger.info("LDAP helpers unit test - start")
+
+    tests = [test_paged_search, test_paged_search_streaming, test_retrieve_users_paged,
+             test_streaming_mapping, test_incremental_watermark, test_dirsync_group_members,
+             test_search_shards, test_parallel_search_dedup,
+             test_connect_bind_error, test_pool_reuse, test_pool_search_closed,
+             test_pool_ranking, test_pool_failover, test_ranged_attrs, test_group_members_cache,
+             test_watch_changes, test_notify_debounce, test_compile_attr_mapping,
+             test_mapping_cache]
+
+    for test in tests:
+        c.logger.info(80*"-")
+        test()
+        c.logger.info("%s - OK" % test.__name__)
+
+    c.logger.info("LDAP helpers unit test - end")
+
+
+if __name__ == "__main__":
+    main_test()
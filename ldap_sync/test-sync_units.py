@@ -0,0 +1,463 @@
+#
+# Sync process unit testing
+# Checks of the user records, comparison, plan and send helpers of the sync process, no LDAP, SCIM
+# or Det API service is contacted: python test-sync_units.py (or python -m pytest test-sync_units.py)
+#
+import os
+import types
+import logging
+import tempfile
+import threading
+import contextlib
+
+from libs import common as c
+from libs import scim
+from libs import scim_helper as sh
+from libs import det_api_helper as det
+from libs import sync_plan as plan
+from libs import sync_state as ss
+from libs import sync_process as sp
+
+SCIM_URL = 'http://localhost:8080/scim/v2'
+USERS_URL = SCIM_URL + scim.User.URI
+GROUP_DN = 'CN=DetGroup,OU=Groups,DC=domain,DC=internal'
+ATTR_MAPPING = {
+    'id': None,
+    'userName': '${userPrincipalName}',
+    'externalId': '${objectGUID}',
+    'emails.work.value': '${mail}',
+    'active': '${userAccountControl}',
+    'name.givenName': '${givenName}',
+    'name.familyName': '${sn}',
+    'displayName': '${cn}',
+    'memberOf': '${memberOf}',
+}
+
+
+def _user(n, **fields):
+    user = {
+            "userName": "user%d@domain.internal" % n,
+            "externalId": "guid-%d" % n,
+            "displayName": "user %d" % n,
+            "name": {
+                "givenName"  : "User-First-Name",
+                "familyName" : "User-Last-Name",
+            },
+            "emails": [{
+                "value" : "user-%d@domain.internal" % n,
+                "type" : "work",
+                "primary" : True
+            }],
+            "memberOf": [GROUP_DN],
+            "active": True
+    }
+    user.update(fields)
+    return user
+
+@contextlib.contextmanager
+def _sync_config(**values):
+    # sync process globals (c.*) of the test, restored at the end
+    config = dict({
+        'scim_config': {'attr_mapping': ATTR_MAPPING},
+        'custom_plugin': None,
+        'local_users': [],
+        'curr_local_users': [],
+        'local_users_ops': {'add': [], 'update': [], 'delete': []},
+        'local_users_changed_attrs': {},
+    }, **values)
+    saved = {k: getattr(c, k) for k in config}
+    for k, v in config.items():
+        setattr(c, k, v)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            setattr(c, k, v)
+
+@contextlib.contextmanager
+def _patched(obj, name, value):
+    saved = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, saved)
+
+def _records(users):
+    return [scim.UserRecord(user) for user in users]
+
+def test_user_record():
+    user = _user(1, title='Engineer')
+    record = scim.UserRecord(user)
+
+    # dict interface, fields not in the slots stored in extra
+    assert record == user and record.to_dict() == user
+    assert record['userName'] == user['userName'] and record.get('id') is None
+    assert 'title' in record and record.extra == {'title': 'Engineer'}
+    assert set(record.keys()) == set(user)
+
+    # projection
+    assert scim.UserRecord(user, keys={'userName', 'active'}).to_dict() == {'userName': user['userName'], 'active': True}
+
+    # read-only nested values, the whole field can be set
+    for change in [lambda: record['name'].update(givenName='x'), lambda: record['emails'].append({}),
+                   lambda: record['emails'][0].update(value='x'), lambda: record['memberOf'].append('x')]:
+        try:
+            change()
+            assert False
+        except TypeError:
+            pass
+    record['name'] = {'givenName': 'Other', 'familyName': 'User'}
+    assert record['name'] == {'givenName': 'Other', 'familyName': 'User'}
+
+    # copies share the nested values, the fields are independent
+    copy = record.copy()
+    assert copy['emails'] is record['emails']
+    copy['displayName'] = 'changed'
+    copy['title'] = 'Manager'
+    assert record['displayName'] == 'user 1' and record['title'] == 'Engineer'
+    assert copy.pop('title') == 'Manager' and 'title' not in copy
+    assert copy.pop('title', None) is None
+
+    # the group DNs are shared between the records
+    other = scim.UserRecord(_user(2, memberOf=[GROUP_DN.encode().decode()]))
+    assert other['memberOf'][0] is record['memberOf'][0]
+
+def test_user_record_digest():
+    fields = ('active', 'displayName', 'emails', 'name', 'userName')
+    record = scim.UserRecord(_user(1))
+    digest = record.digest(fields)
+
+    # same values, different nested order: same digest
+    reordered = scim.UserRecord(dict(_user(1), name={'familyName': 'User-Last-Name', 'givenName': 'User-First-Name'}))
+    assert reordered.digest(fields) == digest
+    assert scim.user_digest(_user(1), fields) == digest
+
+    # cached, reset when a field (but id) changes
+    record['id'] = 'id-1'
+    assert record._digest is not None
+    record['displayName'] = 'changed'
+    assert record._digest is None
+    assert record.digest(fields) != digest
+    assert scim.changed_fields(record, reordered, fields) == ['displayName']
+
+def test_compare_index():
+    curr_users = _records([
+        _user(1, id='id-1'),
+        _user(2, id='id-2'),
+        _user(3, id='id-3'),
+        _user(4, id='id-4'),
+        _user(5, id='id-5', active=False),
+        _user(7, id='id-7'),
+    ])
+    local_users = _records([
+        _user(1),
+        _user(2, displayName='changed'),
+        _user(3, userName='renamed@domain.internal'),    # renamed on LDAP (same externalId)
+        _user(6),
+        _user(8, externalId='guid-7'),                   # externalId of a user matched by userName
+        _user(7),
+    ])
+
+    with _sync_config(local_users=local_users, curr_local_users=curr_users):
+        sp.compare_scim_users(curr_users_index=sp.CurrUsersIndex(curr_users))
+
+        ops = c.local_users_ops
+        assert [u['userName'] for u in ops['add']] == ['user6@domain.internal', 'user8@domain.internal']
+        assert [(u['id'], u['userName']) for u in ops['update']] == [('id-2', 'user2@domain.internal'), ('id-3', 'renamed@domain.internal')]
+        assert ops['delete'] == [{'id': 'id-4', 'userName': 'user4@domain.internal'}]   # inactive users not deleted again
+        assert local_users[0]['id'] == 'id-1'
+
+        # partial platform list (targeted lookups): no deletes
+        sp.compare_scim_users(with_deletes=False)
+        assert c.local_users_ops['delete'] == [] and len(c.local_users_ops['update']) == 2
+
+    # renamed user whose old userName is still used on LDAP: not matched by externalId
+    curr_users = _records([_user(1, id='id-1')])
+    local_users = _records([_user(1, externalId='guid-new'), _user(9, externalId='guid-1')])
+    with _sync_config(local_users=local_users, curr_local_users=curr_users):
+        sp.compare_scim_users()
+        assert [u['userName'] for u in c.local_users_ops['add']] == ['user9@domain.internal']
+        assert [u['id'] for u in c.local_users_ops['update']] == ['id-1']
+
+def test_compare_digest_fields():
+    with _sync_config():
+        fields, subkeys = sp.get_scim_digest_fields()
+    assert fields == ('active', 'displayName', 'emails', 'externalId', 'memberOf', 'name', 'userName')
+    assert subkeys['name'] == {'givenName', 'familyName'} and subkeys['emails'] == scim.EMAIL_DIGEST_KEYS
+
+    # fields not returned by the platform and nested keys not mapped are not compared
+    curr_user = _user(1, id='id-1', emails=[dict(_user(1)['emails'][0], display='User 1')],
+                      name=dict(_user(1)['name'], formatted='User 1'))
+    del curr_user['memberOf']
+    curr_users = _records([curr_user, _user(2, id='id-2')])
+    local_users = _records([_user(1, memberOf=['CN=Other']), _user(2, memberOf=[], preferredLanguage='en_US')])
+
+    with _sync_config(local_users=local_users, curr_local_users=curr_users):
+        sp.compare_scim_users()
+        assert [u['id'] for u in c.local_users_ops['update']] == ['id-2']
+        assert c.local_users_changed_attrs == {'id-2': ['memberOf']}
+
+        # the digests are cached in the records
+        assert local_users[0]._digest is not None and curr_users[0]._digest is not None
+
+def test_patch_or_put():
+    curr_users = _records([_user(n, id='id-%d' % n) for n in range(1, 4)])
+    local_users = _records([
+        _user(1, active=False, name={'givenName': 'New', 'familyName': 'User-Last-Name'}),     # PATCH fields only
+        _user(2, displayName='changed', active=False),                                          # PUT field
+        _user(3, emails=[{'value': 'new@domain.internal', 'type': 'work', 'primary': True}]),
+    ])
+
+    with _sync_config(local_users=local_users, curr_local_users=curr_users):
+        sp.compare_scim_users()
+        requests = [sh.user_request(user.copy(), 'update', USERS_URL, sp._changed_attrs('update', user))
+                    for user in c.local_users_ops['update']]
+
+    # field-level PATCH of the changed fields only
+    op, method, url, body = requests[0]
+    assert (method, url) == ('PATCH', USERS_URL + '/id-1')
+    assert body['Operations'] == [{'op': 'replace', 'value': {'active': False, 'name': local_users[0]['name']}}]
+
+    # a changed field not supported by PATCH: full PUT
+    op, method, url, body = requests[1]
+    assert (method, url) == ('PUT', USERS_URL + '/id-2')
+    assert body['displayName'] == 'changed' and body['userName'] == 'user2@domain.internal'
+
+    op, method, url, body = requests[2]
+    assert method == 'PATCH' and list(body['Operations'][0]['value']) == ['emails']
+
+    # no changed fields known: PUT - delete: soft delete by PATCH
+    assert sh.user_request(local_users[0].copy(), 'update', USERS_URL)[1] == 'PUT'
+    op, method, url, body = sh.user_request({'id': 'id-4', 'userName': 'user4'}, 'delete', USERS_URL)
+    assert (method, body['Operations']) == ('PATCH', [{'op': 'replace', 'value': {'active': False}}])
+
+def test_plan_round_trip():
+    users_ops = {
+        'add': _records([_user(1), _user(2, title='Engineer')]),
+        'update': _records([_user(3, id='id-3'), _user(4, id='id-4')]),
+        'delete': [{'id': 'id-5', 'userName': 'user5@domain.internal'}],
+    }
+    changed_attrs = {'id-3': ['active', 'name']}
+    group_add = {'g1': ['user1@domain.internal', 'user3@domain.internal']}
+    group_rm = {'g1': ['user5@domain.internal'], 'g2': ['user4@domain.internal']}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'plan.ndjson')
+        assert plan.write(filename, users_ops, changed_attrs, group_add, group_rm)
+        assert plan.read(filename) == ({op: [dict(u.items()) for u in users] for op, users in users_ops.items()},
+                                       changed_attrs, group_add, group_rm)
+
+        # unsupported version, missing file, write error
+        with open(filename) as fd:
+            lines = fd.readlines()
+        with open(filename, 'w') as fd:
+            fd.writelines([lines[0].replace('"version":%d' % plan.PLAN_VERSION, '"version":1')] + lines[1:])
+        assert plan.read(filename) is None
+        assert plan.read(os.path.join(tmp_dir, 'missing.ndjson')) is None
+        assert not plan.write(os.path.join(tmp_dir, 'missing', 'plan.ndjson'), users_ops, changed_attrs, group_add, group_rm)
+
+def test_apply_plan():
+    users_ops = {'add': _records([_user(1)]), 'update': _records([_user(2, id='id-2')]), 'delete': []}
+    group_add = {'g1': ['user1@domain.internal', 'user2@domain.internal', 'unknown@domain.internal']}
+    group_rm = {'g2': ['user2@domain.internal']}
+    sent = []
+    group_calls = []
+
+    def _send():
+        sent.append({op: [u['userName'] for u in users] for op, users in c.local_users_ops.items()})
+
+    # the planned userNames are resolved after the users operations (users created by the plan included)
+    det_users = {'user1@domain.internal': {'id': 11}, 'user2@domain.internal': {'id': 12}}
+
+    with tempfile.TemporaryDirectory() as tmp_dir, _sync_config(), \
+         _patched(sp, 'send_scim_update', _send), _patched(det, 'login', lambda: True), _patched(det, 'logout', lambda: None), \
+         _patched(det, 'get_users', lambda: ({}, det_users)), \
+         _patched(det, 'group_add_rm_users', lambda group_id, **kwargs: group_calls.append((group_id, kwargs))):
+
+        filename = os.path.join(tmp_dir, 'plan.ndjson')
+        assert plan.write(filename, users_ops, {'id-2': ['active']}, group_add, group_rm)
+        assert sp.apply_plan(filename)
+
+        assert sent == [{'add': ['user1@domain.internal'], 'update': ['user2@domain.internal'], 'delete': []}]
+        assert c.local_users_changed_attrs == {'id-2': ['active']}
+        assert group_calls == [('g1', {'add_user_ids': [11, 12]}), ('g2', {'rm_user_ids': [12]})]
+
+        assert not sp.apply_plan(os.path.join(tmp_dir, 'missing.ndjson'))
+
+def test_threaded_sends():
+    users = [_user(1, id='id-1'), _user(2, id='id-2'), _user(1, id='id-1', displayName='again'), _user(3, id='id-3')]
+    lock = threading.Lock()
+    in_flight = set()
+    sent = []
+
+    def _exec(user, op, changed_attrs=None):
+        with lock:
+            assert user['id'] not in in_flight      # the operations on the same user are serialized
+            in_flight.add(user['id'])
+        try:
+            if user['id'] == 'id-2':
+                raise RuntimeError('failed')
+            return {'http_status': 200, 'scim_user': {'id': user['id']}}
+        finally:
+            with lock:
+                in_flight.discard(user['id'])
+                sent.append(user['displayName'])
+
+    before = []
+    after = []
+    plugin = types.SimpleNamespace(before_send_user=lambda user, op: before.append(user['id']),
+                                   after_send_user=lambda user, op, resp: after.append((user['id'], resp['http_status'])))
+
+    with _sync_config(custom_plugin=plugin), _patched(sh, 'get_bulk_config', lambda: None), \
+         _patched(sh, 'exec_scim_user_api_req', _exec):
+
+        for max_concurrency in [1, 4]:
+            del before[:], after[:], sent[:]
+            sp._send_scim_ops('update', users, max_concurrency)
+
+            # after_send_user for each user of before_send_user, the failed operation with an error resp
+            assert sorted(before) == ['id-1', 'id-1', 'id-2', 'id-3']
+            assert sorted(after) == [('id-1', 200), ('id-1', 200), ('id-2', None), ('id-3', 200)]
+            assert sent.index('user 1') < sent.index('again')
+
+        # plugins defined as after_send_user(user, op): called without the operation result
+        def after_send_user(user, op):
+            after.append(user['id'])
+
+        plugin.after_send_user = after_send_user
+        del after[:]
+        sp._send_scim_ops('delete', users[:2], 4)
+        assert sorted(after) == ['id-1', 'id-2']
+
+def test_main_loop():
+    platform_users = [dict(_user(1), id='id-1'), dict(_user(2), id='id-2'), dict(_user(4), id='id-4')]
+    ldap_users = [_user(1), _user(2, displayName='renamed'), _user(3)]
+    sent = []
+
+    def _get_scim_users(handle_users=None):
+        c.curr_local_users = _records(platform_users)
+        handle_users(c.curr_local_users)
+        return {'http_status': 200, 'scim_user_list': {}}
+
+    def _send():
+        sent.append({op: [u['userName'] for u in users] for op, users in c.local_users_ops.items()})
+
+    ldap_plugin = types.SimpleNamespace(ldap_get_users=lambda: True,
+                                        ldap_to_scim_mapping=lambda: setattr(c, 'local_users', _records(ldap_users)))
+    expected = {'add': ['user3@domain.internal'], 'update': ['user2@domain.internal'], 'delete': ['user4@domain.internal']}
+
+    with tempfile.TemporaryDirectory() as tmp_dir, _sync_config(ldap_plugin=ldap_plugin, ldap_config={}, det_config={}, 
+                                                                sync_mode='sync', plan_filename=os.path.join(tmp_dir, 'plan.ndjson')), \
+         _patched(sh, 'get_scim_users', _get_scim_users), _patched(sp, 'send_scim_update', _send):
+
+        assert sp.main_loop()
+        assert sent == [expected]
+        assert c.local_users_changed_attrs == {'id-2': ['displayName']}
+
+        # plan mode: the operations are written in the sync plan, not sent
+        c.sync_mode = 'plan'
+        assert sp.main_loop()
+        assert sent == [expected]
+        users_ops = plan.read(c.plan_filename)[0]
+        assert {op: [u['userName'] for u in users] for op, users in users_ops.items()} == expected
+
+def test_lookup_cycle():
+    platform_users = [dict(_user(1), id='id-1'), dict(_user(2), id='id-2'), dict(_user(4), id='id-4')]
+    changed = [_user(2, displayName='renamed')]
+    lookups = []
+    sent = []
+
+    def _cycle_start(changed_dns=None):
+        c.ldap_delta_cycle = True
+
+    def _mapping():
+        c.local_users = _records([_user(1)]) + _records(changed)
+        c.local_users_delta = c.local_users[1:]
+
+    def _lookup(users, handle_users=None):
+        lookups.append([u['userName'] for u in users])
+        if len(lookups) > 1:
+            return {'http_status': 400, 'scim_user_list': {}}
+        c.curr_local_users = _records(platform_users[1:2])
+        handle_users(c.curr_local_users)
+        return {'http_status': 200, 'scim_user_list': {}}
+
+    def _get_scim_users(handle_users=None):
+        c.curr_local_users = _records(platform_users)
+        handle_users(c.curr_local_users)
+        return {'http_status': 200, 'scim_user_list': {}}
+
+    def _send():
+        sent.append({op: [u['userName'] for u in users] for op, users in c.local_users_ops.items() if users})
+
+    ldap_plugin = types.SimpleNamespace(ldap_get_users=lambda: True, ldap_to_scim_mapping=_mapping)
+
+    with _sync_config(ldap_plugin=ldap_plugin, ldap_config={}, det_config={}, sync_mode='sync', curr_users_total=100,
+                      scim_config={'attr_mapping': ATTR_MAPPING, 'lookup': {'enabled': True}}), \
+         _patched(sp.lpc, 'incremental_cycle_start', _cycle_start), _patched(sh, 'lookup_scim_users', _lookup), \
+         _patched(sh, 'get_scim_users', _get_scim_users), _patched(sp, 'send_scim_update', _send):
+
+        # few changed users: only the changed users are looked up and compared (no deletes)
+        assert sp.main_loop()
+        assert lookups == [['user2@domain.internal']]
+        assert sent == [{'update': ['user2@domain.internal']}]
+
+        # targeted lookups failed: full SCIM user list
+        assert sp.main_loop()
+        assert len(lookups) == 2
+        assert sent[1] == {'update': ['user2@domain.internal'], 'delete': ['user4@domain.internal']}
+
+def test_bulk_rounds():
+    user1 = {'id': '1', 'userName': 'user1'}
+    user1_again = {'id': '1', 'userName': 'user1'}
+    user2 = {'userName': 'user2'}
+    user2_again = {'userName': 'user2'}
+    user3 = {'id': '3', 'userName': 'user3'}
+
+    rounds = sp._bulk_rounds([user1, user2, user1_again, user3, user2_again])
+
+    assert rounds == [[user1, user2, user3], [user1_again, user2_again]]
+    assert rounds[1][0] is user1_again     # the operations on the same user in order
+
+def test_state_round_trip():
+    with tempfile.TemporaryDirectory() as tmp_dir, _patched(ss, 'state', {}), _patched(ss, 'state_filename', ''):
+        filename = os.path.join(tmp_dir, 'state.json')
+
+        assert not ss.load(filename)        # not found: empty state
+        ss.set('ldap_watermarks', {'ldap://dc1.domain.internal': '20240101000000.0Z'})
+        ss.set('ldap_cycles_since_full', 3)
+        assert ss.save()
+
+        assert ss.load(filename)
+        assert ss.get('ldap_watermarks') == {'ldap://dc1.domain.internal': '20240101000000.0Z'}
+        assert ss.get('ldap_cycles_since_full') == 3
+
+        # corrupted file: empty state
+        with open(filename, 'w') as fd:
+            fd.write('{"ldap_cycles')
+        assert not ss.load(filename)
+        assert ss.get('ldap_cycles_since_full') is None
+
+
+def main_test():
+    logging.basicConfig(level=logging.INFO)
+
+    c.logger.info(80*"=")
+    c.logger.info("Sync process unit test - start")
+
+    tests = [test_user_record, test_user_record_digest, test_compare_index,
+             test_compare_digest_fields, test_patch_or_put, test_plan_round_trip, test_apply_plan,
+             test_threaded_sends, test_main_loop, test_lookup_cycle,
+             test_bulk_rounds, test_state_round_trip]
+
+    for test in tests:
+        c.logger.info(80*"-")
+        test()
+        c.logger.info("%s - OK" % test.__name__)
+
+    c.logger.info("Sync process unit test - end")
+
+
+if __name__ == "__main__":
+    main_test()